@@ -0,0 +1,181 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Generates train_aug.tsv with GloVe and batched masked-LM word replacements."""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import csv
+import logging
+import multiprocessing
+import os
+import random
+import sys
+
+import torch
+from tqdm import tqdm
+
+from pytorch_pretrained_bert.augmentation import GloveNeighbours, MaskedLMAugmenter, plan_augmentation
+from pytorch_pretrained_bert.modeling import BertForPreTraining
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt='%m/%d/%Y %H:%M:%S',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Columns of train.tsv holding text, and whether the file starts with a header line.
+TEXT_COLUMNS = {
+    "cola": ([3], False),
+    "mnli": ([8, 9], True),
+    "mrpc": ([3, 4], True),
+    "sst-2": ([0], True),
+    "sts-b": ([7, 8], True),
+    "qqp": ([3, 4], True),
+    "qnli": ([1, 2], True),
+    "rte": ([1, 2], True),
+    "wnli": ([1, 2], True),
+}
+
+_worker = {}
+
+
+def _init_worker(tokenizer, glove_file, num_candidates, args):
+    _worker['tokenizer'] = tokenizer
+    _worker['glove'] = GloveNeighbours(glove_file, num_candidates=num_candidates) if glove_file else None
+    _worker['args'] = args
+
+
+def _plan_line(job):
+    """Plans `num_aug` augmentations of every text column of one TSV line."""
+    line_index, row = job
+    args = _worker['args']
+    plans = []
+    for aug_index in range(args.num_aug):
+        for column in args.text_columns:
+            rng = random.Random("{}-{}-{}-{}".format(args.seed, line_index, aug_index, column))
+            plans.append(plan_augmentation(_worker['tokenizer'], row[column], rng,
+                                           mask_prob=args.mask_prob, glove=_worker['glove'],
+                                           max_seq_length=args.max_seq_length))
+    return line_index, row, plans
+
+
+def _flush(pending, augmenter, writer, args):
+    plans, rngs = [], []
+    for line_index, _, line_plans in pending:
+        plans.extend(line_plans)
+        for aug_index in range(args.num_aug):
+            for column in args.text_columns:
+                rngs.append(random.Random("{}-{}-{}-{}-mlm".format(args.seed, line_index, aug_index, column)))
+    sentences = iter(augmenter.fill(plans, rngs))
+    for _, row, _ in pending:
+        writer.write("\t".join(row) + "\n")
+        for _ in range(args.num_aug):
+            new_row = list(row)
+            for column in args.text_columns:
+                new_row[column] = next(sentences)
+            writer.write("\t".join(new_row) + "\n")
+    writer.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data_dir", default=None, type=str, required=True,
+                        help="The input data dir. Should contain train.tsv.")
+    parser.add_argument("--task_name", default=None, type=str, required=True,
+                        help="The name of the task whose train.tsv is augmented.")
+    parser.add_argument("--bert_model", default="bert-base-uncased", type=str,
+                        help="Pre-trained masked LM used to propose replacements.")
+    parser.add_argument("--glove_file", default=None, type=str,
+                        help="GloVe text file used for words made of several word pieces.")
+    parser.add_argument("--output_file", default=None, type=str,
+                        help="Defaults to <data_dir>/train_aug.tsv.")
+    parser.add_argument("--do_lower_case", action='store_true',
+                        help="Set this flag if you are using an uncased model.")
+    parser.add_argument("--num_aug", default=20, type=int,
+                        help="Augmented copies written after each original line.")
+    parser.add_argument("--mask_prob", default=0.4, type=float,
+                        help="Probability of replacing each word.")
+    parser.add_argument("--num_candidates", default=40, type=int,
+                        help="Replacements are drawn uniformly from this many best candidates.")
+    parser.add_argument("--max_seq_length", default=128, type=int,
+                        help="Words past this many word pieces are never masked.")
+    parser.add_argument("--batch_size", default=64, type=int,
+                        help="Sequences per masked-LM forward.")
+    parser.add_argument("--lines_per_flush", default=256, type=int,
+                        help="Input lines buffered before their augmentations are written.")
+    parser.add_argument("--num_workers", default=None, type=int,
+                        help="CPU processes used for tokenization (0 runs in-process). Defaults to all cores.")
+    parser.add_argument("--no_cuda", action='store_true',
+                        help="Whether not to use CUDA when available")
+    parser.add_argument('--seed', type=int, default=42,
+                        help="Augmentations only depend on the seed and the line number.")
+    args = parser.parse_args()
+
+    task_name = args.task_name.lower()
+    if task_name not in TEXT_COLUMNS:
+        raise ValueError("Task not found: %s" % (task_name))
+    args.text_columns, has_header = TEXT_COLUMNS[task_name]
+    if args.output_file is None:
+        args.output_file = os.path.join(args.data_dir, "train_aug.tsv")
+    if args.num_workers is None:
+        args.num_workers = os.cpu_count() or 1
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+    if args.glove_file:
+        # Builds the cached neighbour table once before the workers memory-map it.
+        GloveNeighbours(args.glove_file, num_candidates=args.num_candidates)
+    model = BertForPreTraining.from_pretrained(args.bert_model)
+    model.to(device)
+    model.eval()
+    augmenter = MaskedLMAugmenter(model, tokenizer, num_candidates=args.num_candidates,
+                                  batch_size=args.batch_size, device=device)
+
+    worker_args = argparse.Namespace(**vars(args))
+    csv.field_size_limit(sys.maxsize)
+    with open(os.path.join(args.data_dir, "train.tsv"), "r", encoding='utf-8') as reader, \
+            open(args.output_file + ".tmp", "w", encoding='utf-8') as writer:
+        rows = csv.reader(reader, delimiter="\t", quotechar=None)
+        if has_header:
+            writer.write("\t".join(next(rows)) + "\n")
+        jobs = enumerate(rows)
+        if args.num_workers > 0:
+            pool = multiprocessing.Pool(args.num_workers, initializer=_init_worker,
+                                        initargs=(tokenizer, args.glove_file, args.num_candidates, worker_args))
+            planned = pool.imap(_plan_line, jobs, chunksize=16)
+        else:
+            pool = None
+            _init_worker(tokenizer, args.glove_file, args.num_candidates, worker_args)
+            planned = map(_plan_line, jobs)
+
+        pending = []
+        for item in tqdm(planned, desc="Augmenting"):
+            pending.append(item)
+            if len(pending) >= args.lines_per_flush:
+                _flush(pending, augmenter, writer, args)
+                pending = []
+        if pending:
+            _flush(pending, augmenter, writer, args)
+        if pool is not None:
+            pool.close()
+            pool.join()
+    os.replace(args.output_file + ".tmp", args.output_file)
+    logger.info("wrote augmented data to {}".format(args.output_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Exports a compressed student saved by run_finetune.py as a frozen TorchScript module.
+
+The export runs without this code:
+    model = torch.jit.load('student.pt')
+    logits = model(input_ids, token_type_ids, attention_mask)
+The ranks kept for every projection and the check against the Python model are written next
+to it, as student.json.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import run_predict  # noqa: E402
+from pytorch_pretrained_bert.export import export_torchscript  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+def latency_ms(function, inputs, repeats):
+    with torch.no_grad():
+        function(*inputs)
+        start = time.perf_counter()
+        for _ in range(repeats):
+            function(*inputs)
+    return (time.perf_counter() - start) / repeats * 1000.
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_dir",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="Directory of the student: bert_config.json and pytorch_model.bin.")
+    parser.add_argument("--task_name",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The name of the task, which gives the number of labels.")
+    parser.add_argument("--output_file",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The TorchScript file written.")
+    parser.add_argument("--p_type",
+                        default='svd',
+                        type=str,
+                        help="Projection backend of every encoder projection (see `set_projections`).")
+    parser.add_argument("--p_rate",
+                        default=1.,
+                        type=float,
+                        help="Fraction of the rank ('svd') or of the weights ('sparse') kept.")
+    parser.add_argument("--max_seq_length",
+                        default=128,
+                        type=int,
+                        help="Sequence length of the example the student is traced and checked on.")
+    parser.add_argument("--batch_size",
+                        default=1,
+                        type=int,
+                        help="Batch size of the example the student is traced and checked on.")
+    parser.add_argument("--check_repeats",
+                        default=20,
+                        type=int,
+                        help="Number of forwards timed for the Python model and the export (0: no timing).")
+    args = parser.parse_args()
+
+    task_name = args.task_name.lower()
+    if task_name not in run_predict.PROCESSORS:
+        raise ValueError("Task not found: %s" % (task_name))
+    num_labels = len(run_predict.PROCESSORS[task_name]().get_labels())
+    model = run_predict.load_student(args.model_dir, num_labels, torch.device("cpu"))
+    model.set_projections(args.p_type, args.p_rate)
+    scripted, ranks = export_torchscript(model, args.output_file, batch_size=args.batch_size,
+                                         seq_length=args.max_seq_length)
+
+    # Checks the export on random inputs, with padding.
+    input_ids = torch.randint(0, model.config.vocab_size, (args.batch_size, args.max_seq_length))
+    token_type_ids = torch.zeros_like(input_ids)
+    attention_mask = torch.ones_like(input_ids)
+    attention_mask[:, args.max_seq_length // 2:] = 0
+    inputs = (input_ids, token_type_ids, attention_mask)
+    with torch.no_grad():
+        expected = model(*inputs)[0]
+        logits = scripted(*inputs)
+    info = {'p_type': args.p_type,
+            'p_rate': args.p_rate,
+            'ranks': ranks,
+            'max_abs_diff': (expected - logits).abs().max().item()}
+    if args.check_repeats:
+        info['python_ms'] = latency_ms(lambda *x: model(*x)[0], inputs, args.check_repeats)
+        info['torchscript_ms'] = latency_ms(scripted, inputs, args.check_repeats)
+    with open(os.path.splitext(args.output_file)[0] + '.json', 'w') as f:
+        json.dump(info, f, indent=2)
+    logger.info("max abs diff of the logits: %g", info['max_abs_diff'])
+    if args.check_repeats:
+        logger.info("latency of a [%d, %d] batch: %.2f ms (python), %.2f ms (torchscript)", args.batch_size,
+                    args.max_seq_length, info['python_ms'], info['torchscript_ms'])
+
+
+if __name__ == "__main__":
+    main()
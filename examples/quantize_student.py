@@ -0,0 +1,153 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Post-training dynamic int8 quantization of a compressed student saved by run_finetune.py.
+
+The encoder projections are frozen at their final ranks (see `freeze_student`) and quantized
+(see `quantize_student`). The dev set of the task is run with the fp32 student, the frozen fp32
+student and the int8 one (each warmed up on a batch first), and their metrics, accuracy delta,
+dev-set latency and speedup are written to --report_file. --output_file also exports the int8
+student as TorchScript.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import run_finetune  # noqa: E402
+import run_predict  # noqa: E402
+from pytorch_pretrained_bert.export import export_torchscript, freeze_student, quantize_student  # noqa: E402
+from pytorch_pretrained_bert.tokenization import BertTokenizer  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+def timed_evaluate(model, dataloader, args, p_type, p_rate):
+    """The dev metrics of `model` (see `run_finetune.evaluate`) with the seconds they took, after
+    an untimed forward of the first batch, so that no model pays for the lazy setup of its kernels
+    and buffers."""
+    input_ids, input_mask, segment_ids, _ = next(iter(dataloader))
+    model.eval()
+    with torch.no_grad():
+        model(input_ids, segment_ids, input_mask, p_type=p_type, p_rate=p_rate)
+    start = time.perf_counter()
+    metrics = run_finetune.evaluate(model, dataloader, torch.device("cpu"), args, p_type, p_rate)
+    metrics['seconds'] = time.perf_counter() - start
+    metrics['examples_per_second'] = len(dataloader.dataset) / max(metrics['seconds'], 1e-9)
+    return metrics
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_dir",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="Directory of the student: bert_config.json and pytorch_model.bin.")
+    parser.add_argument("--data_dir",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The input data dir, with the dev.tsv of the task.")
+    parser.add_argument("--bert_model", default=None, type=str, required=True,
+                        help="Bert pre-trained model of the vocabulary, as in run_finetune.py.")
+    parser.add_argument("--task_name",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The name of the task.")
+    parser.add_argument("--report_file",
+                        default=None,
+                        type=str,
+                        help="JSON report written (default: quantization.json in model_dir).")
+    parser.add_argument("--output_file",
+                        default=None,
+                        type=str,
+                        help="Also exports the int8 student as TorchScript to this file.")
+    parser.add_argument("--max_seq_length",
+                        default=128,
+                        type=int,
+                        help="The maximum total input sequence length after WordPiece tokenization.")
+    parser.add_argument("--do_lower_case",
+                        action='store_true',
+                        help="Set this flag if you are using an uncased model.")
+    parser.add_argument("--eval_batch_size",
+                        default=32,
+                        type=int,
+                        help="Batch size of the dev set.")
+    parser.add_argument("--p_type",
+                        default='svd',
+                        type=str,
+                        help="Projection backend of every encoder projection (see `set_projections`).")
+    parser.add_argument("--p_rate",
+                        default=1.,
+                        type=float,
+                        help="Fraction of the rank ('svd') or of the weights ('sparse') kept.")
+    parser.add_argument("--threads",
+                        default=0,
+                        type=int,
+                        help="Number of CPU threads (0: the torch default).")
+    args = parser.parse_args()
+    args.bf16 = False  # read by `run_finetune.evaluate`
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    task_name = args.task_name.lower()
+    if task_name not in run_predict.PROCESSORS:
+        raise ValueError("Task not found: %s" % (task_name))
+    args.task_name = task_name
+    processor = run_predict.PROCESSORS[task_name]()
+    label_list = processor.get_labels()
+    output_mode = "regression" if label_list[0] is None else "classification"
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+    eval_features = run_finetune.convert_examples_to_features(
+        processor.get_dev_examples(args.data_dir), label_list, args.max_seq_length, tokenizer, output_mode)
+    eval_dataloader = run_finetune.sequential_dataloader(
+        run_finetune.features_to_dataset(eval_features, output_mode), args)
+
+    model = run_predict.load_student(args.model_dir, len(label_list), torch.device("cpu"))
+    model.set_projections(args.p_type, args.p_rate)
+    frozen, _ = freeze_student(model)
+    quantized, ranks = quantize_student(model)
+
+    report = {'p_type': args.p_type, 'p_rate': args.p_rate, 'threads': torch.get_num_threads(), 'ranks': ranks}
+    report['fp32'] = timed_evaluate(model, eval_dataloader, args, args.p_type, args.p_rate)
+    report['frozen_fp32'] = timed_evaluate(frozen, eval_dataloader, args, None, None)
+    report['int8'] = timed_evaluate(quantized, eval_dataloader, args, None, None)
+    metric = 'acc' if output_mode == "classification" else 'corr'
+    report['metric'] = metric
+    report['delta'] = report['int8'][metric] - report['fp32'][metric]
+    report['speedup'] = report['fp32']['seconds'] / max(report['int8']['seconds'], 1e-9)
+    report['speedup_vs_frozen_fp32'] = report['frozen_fp32']['seconds'] / max(report['int8']['seconds'], 1e-9)
+
+    report_file = args.report_file or os.path.join(args.model_dir, 'quantization.json')
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info("dev %s: %.4f (fp32), %.4f (frozen fp32), %.4f (int8), delta %+.4f", metric, report['fp32'][metric],
+                report['frozen_fp32'][metric], report['int8'][metric], report['delta'])
+    logger.info("dev latency: %.2fs (fp32), %.2fs (frozen fp32), %.2fs (int8), speedup %.2fx", report['fp32']['seconds'],
+                report['frozen_fp32']['seconds'], report['int8']['seconds'], report['speedup'])
+
+    if args.output_file:
+        export_torchscript(model, args.output_file, seq_length=args.max_seq_length, quantize=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,9 +26,8 @@ import sys
 
 import numpy as np
 import torch
-from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
+from torch.utils.data import (DataLoader, SequentialSampler,
                               TensorDataset)
-from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 
 from torch.nn import CrossEntropyLoss, MSELoss, BCELoss
@@ -36,21 +35,31 @@ from scipy.stats import pearsonr, spearmanr
 from sklearn.metrics import matthews_corrcoef, f1_score
 
 from pytorch_pretrained_bert.file_utils import PYTORCH_PRETRAINED_BERT_CACHE
-from pytorch_pretrained_bert.modeling_ori_dis import BertForSequenceClassification, BertConfig, WEIGHTS_NAME, CONFIG_NAME
+from pytorch_pretrained_bert.modeling_ori_dis import BertConfig, WEIGHTS_NAME, CONFIG_NAME
+import pytorch_pretrained_bert.modeling_ori_dis as modeling_ori
 #import pytorch_pretrained_bert.modeling_fast_dis as modeling_fast
 import pytorch_pretrained_bert.modeling_both as modeling_fast
+from pytorch_pretrained_bert.checkpoint import (AsyncCheckpointWriter, ResumableRandomSampler, get_rng_state,
+                                                load_training_state, set_rng_state, snapshot_state_dict)
+from pytorch_pretrained_bert.metrics import StreamingMetrics
+from pytorch_pretrained_bert.factorization import factorize_word_embeddings, init_svd_factors
 from pytorch_pretrained_bert.tokenization import BertTokenizer
-from pytorch_pretrained_bert.optimization import BertAdam, warmup_linear
+from pytorch_pretrained_bert.optimization import BertAdam, SparseBertAdam, warmup_linear
+from pytorch_pretrained_bert.profiling import DeviceAccumulator, StepTimer, profiler_window
 
 import time
 import copy
 import json
+import queue
+import traceback
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt='%m/%d/%Y %H:%M:%S',
                     level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+TRAINING_STATE_NAME = 'training_state.bin'
+
 wr_target = None
 
 split = None
@@ -701,22 +710,344 @@ def do_sparse(w, ratio, param_tensor, model):
     # topk_cpu = topk.cpu()
     # indices_cpu = indices.cpu()
     # w = torch.nn.Parameter(w.detach().scatter_(0, indices, torch.cuda.FloatTensor(k,d2).fill_(0)))
-    w = w.detach().scatter_(0, indices, torch.cuda.FloatTensor(k, d2).fill_(0))
+    w = w.detach().scatter_(0, indices, w.new_zeros(k, d2))
     w = w.reshape(d1_old, d2_old)
     return w
     # print((w==0).sum())
     # model.state_dict()[param_tensor] = w
 
 
-def svd(mat, rank):
-    U, sigma, VT = np.linalg.svd(mat)
-    diag = np.sqrt(np.diag(sigma[:rank]))
-    return torch.nn.Parameter(torch.from_numpy(np.matmul(U[:, :rank], diag)).float().cuda()), torch.nn.Parameter(
-        torch.from_numpy(np.matmul(diag, VT[:rank, :])).float().cuda())
+def autocast(args, device):
+    """bfloat16 autocast context for --bf16, a no-op otherwise."""
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=args.bf16)
+
+
+def word_embedding_params(model):
+    """The dense word table, or both factors of factorized word embeddings."""
+    word_embeddings = model.bert.embeddings.word_embeddings
+    if isinstance(word_embeddings, modeling_fast.FactorizedEmbedding):
+        return [word_embeddings.emat1, word_embeddings.emat2]
+    return [word_embeddings.weight]
+
+
+def prune_student(model, embd_r, target_prune_rate, wr_now, split):
+    """Prunes, in place, the word embeddings and the SVD factors of every encoder layer, the
+    factors of projection slot s of layer l towards target_prune_rate[l * 4 + s] as wr_now reaches
+    split. Factorized word embeddings lose components instead (see `set_embedding_rank`), their
+    rank going towards 1 - embd_r of the full rank. Returns the pruned parameters."""
+    pruned = word_embedding_params(model)
+    word_embeddings = model.bert.embeddings.word_embeddings
+    if isinstance(word_embeddings, modeling_fast.FactorizedEmbedding):
+        full_rank = word_embeddings.emat1.size(1)
+        rank = max(1, int(round(full_rank * (1. - embd_r) ** (1. * wr_now / split))))
+        model.set_embedding_rank(rank)
+        # Zeroed (and masked by the optimizer), the dropped components make a full-rank reload
+        # compute the same.
+        word_embeddings.emat1.data[:, rank:] = 0
+        word_embeddings.emat2.data[rank:] = 0
+    else:
+        for embd in pruned:
+            do_sparse(embd, embd_r, None, model)
+    for layer_now, layer in enumerate(model.bert.encoder.layer):
+        for slot, module in enumerate(layer.projection_modules()):
+            r = 1 - target_prune_rate[layer_now * 4 + slot] ** (
+                    1. * wr_now / split)  # 1-target_r^{sr_now/split} for each layer
+            for prefix in (['qmat', 'kmat', 'vmat'] if slot == 0 else ['dmat']):
+                for mat in (getattr(module, prefix + '1'), getattr(module, prefix + '2')):
+                    do_sparse(mat, r, None, model)
+                    pruned.append(mat)
+    return pruned
+
+
+def is_main_process():
+    return not torch.distributed.is_initialized() or torch.distributed.get_rank() == 0
+
+
+def report_throughput(args, device, num_examples, train_time):
+    """Sums the training examples of every rank and writes the throughput to
+    output_dir/throughput.json (on rank 0), with the scaling efficiency against the
+    throughput.json of a single-process run given by --scaling_baseline."""
+    world_size = 1
+    examples = torch.tensor([float(num_examples)], dtype=torch.float64, device=device)
+    seconds = torch.tensor([train_time], dtype=torch.float64, device=device)
+    if torch.distributed.is_initialized():
+        world_size = torch.distributed.get_world_size()
+        torch.distributed.all_reduce(examples)
+        torch.distributed.all_reduce(seconds, op=torch.distributed.ReduceOp.MAX)
+    examples, seconds = examples.item(), seconds.item()
+    report = {'world_size': world_size,
+              'threads_per_proc': torch.get_num_threads(),
+              'examples': int(examples),
+              'train_seconds': seconds,
+              'examples_per_second': examples / max(seconds, 1e-9)}
+    report['examples_per_second_per_process'] = report['examples_per_second'] / world_size
+    if args.scaling_baseline:
+        with open(args.scaling_baseline) as f:
+            baseline = json.load(f)
+        report['scaling_efficiency'] = report['examples_per_second'] / (
+                world_size * baseline['examples_per_second'])
+    if is_main_process():
+        with open(os.path.join(args.output_dir, 'throughput.json'), 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info("Throughput: %s", report)
+    return report
+
+
+def evaluate(model, dataloader, device, args, p_type, p_rate):
+    """Metrics of `model` on a labelled dataloader, accumulated on the device (see `StreamingMetrics`)."""
+    model.eval()
+    metrics = None
+    for input_ids, input_mask, segment_ids, label_ids in tqdm(dataloader, desc="Evaluating"):
+        input_ids = input_ids.to(device)
+        input_mask = input_mask.to(device)
+        segment_ids = segment_ids.to(device)
+        label_ids = label_ids.to(device)
+
+        with torch.no_grad(), autocast(args, device):
+            logits, _, _ = model(input_ids, segment_ids, input_mask, p_type=p_type, p_rate=p_rate)
+
+        if metrics is None:
+            metrics = StreamingMetrics(logits.size(-1), device)
+        metrics.update(logits.float(), label_ids)
+    return metrics.compute()
+
+
+def length_sorted_batches(data, batch_size):
+    """Yields (indices, (input_ids, input_mask, segment_ids)) batches of a `TensorDataset` of padded
+    inputs, the examples sorted by decreasing length and every batch trimmed to its longest
+    sequence, so that short examples are not run with the padding of `max_seq_length`."""
+    lengths = data.tensors[1].sum(dim=1)
+    order = torch.argsort(lengths, descending=True, stable=True)
+    for start in range(0, len(order), batch_size):
+        indices = order[start:start + batch_size]
+        length = int(lengths[indices[0]])
+        yield indices, tuple(tensor[indices, :length] for tensor in data.tensors[:3])
+
+
+def predict(model, data, device, args, p_type, p_rate):
+    """Predictions of `model` on an unlabelled `TensorDataset`, in the order of `data`: label
+    indices, or scores for regression. The batches are length-sorted (see `length_sorted_batches`)."""
+    model.eval()
+    preds, order = [], []
+    num_batches = (len(data) + args.eval_batch_size - 1) // args.eval_batch_size
+    for indices, (input_ids, input_mask, segment_ids) in tqdm(length_sorted_batches(data, args.eval_batch_size),
+                                                              desc="test", total=num_batches):
+        input_ids = input_ids.to(device)
+        input_mask = input_mask.to(device)
+        segment_ids = segment_ids.to(device)
+
+        with torch.no_grad(), autocast(args, device):
+            logits, _, _ = model(input_ids, segment_ids, input_mask, p_type=p_type, p_rate=p_rate)
+
+        preds.append(logits.argmax(dim=-1) if logits.size(-1) > 1 else logits.view(-1).float())
+        order.append(indices)
+    if not preds:
+        return np.array([])
+    preds = torch.cat(preds).cpu()
+    ans = torch.empty_like(preds)
+    ans[torch.cat(order)] = preds
+    return ans.numpy()
+
+
+def format_predictions(label_list, ans, start=0):
+    """The 'index\tprediction' lines of predictions `ans` (see `predict`), numbered from `start`."""
+    if label_list[0] is None:  # regression
+        return ''.join('{}\t{:.3f}\n'.format(start + i, float(pred)) for i, pred in enumerate(ans))
+    return ''.join('{}\t{}\n'.format(start + i, label_list[int(pred)]) for i, pred in enumerate(ans))
+
+
+def write_predictions(args, label_list, ans, file_name):
+    """Writes test predictions to `file_name` in output_dir and, unless `args.predictions_in_cwd`
+    is False (see run_sweep.py), in the working directory."""
+    if args.task_name == 'cola':
+        ans = ans[1:]  # the CoLA test examples start with the header line
+    lines = 'index\tprediction\n' + format_predictions(label_list, ans)
+    paths = [os.path.join(args.output_dir, file_name)]
+    if getattr(args, 'predictions_in_cwd', True):
+        paths.append(file_name)
+    for path in paths:
+        with open(path, 'w') as f:
+            f.write(lines)
+
+
+def eval_and_test(model, step, p_type, p_rate, best_acc, args, device, label_list, eval_dataloader,
+                  test_sets, report):
+    """Evaluates `model` on the dev set and hands the result to `report`; when the accuracy (the
+    mean of the Pearson and Spearman correlations for regression) improves on `best_acc`, then
+    writes the predictions of every test set."""
+    metrics = evaluate(model, eval_dataloader, device, args, p_type, p_rate)
+    eval_accuracy = metrics['acc'] if 'acc' in metrics else metrics['corr']
+    result = dict(metrics, eval_accuracy=eval_accuracy, step=step, is_best=eval_accuracy > best_acc)
+    report(result)
+    if result['is_best']:  # below is the output of test dataset
+        for file_name, data in test_sets:
+            write_predictions(args, label_list, predict(model, data, device, args, p_type, p_rate), file_name)
+    return result
+
+
+def sequential_dataloader(data, args):
+    return DataLoader(data, sampler=SequentialSampler(data), batch_size=args.eval_batch_size)
+
+
+def features_to_dataset(features, output_mode=None):
+    """`TensorDataset` of input ids, input mask, segment ids and, unless `output_mode` is None, labels."""
+    all_input_ids = torch.tensor([f.input_ids for f in features], dtype=torch.long)
+    all_input_mask = torch.tensor([f.input_mask for f in features], dtype=torch.long)
+    all_segment_ids = torch.tensor([f.segment_ids for f in features], dtype=torch.long)
+    if output_mode is None:
+        return TensorDataset(all_input_ids, all_input_mask, all_segment_ids)
+    if output_mode == "classification":
+        all_label_ids = torch.tensor([f.label_id for f in features], dtype=torch.long)
+    elif output_mode == "regression":
+        all_label_ids = torch.tensor([f.label_id for f in features], dtype=torch.float)
+    return TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
+
+
+def featurize_task(args, processor, label_list, output_mode):
+    """Reads and featurizes the task. Returns the train and dev `TensorDataset`s and the
+    (prediction file, test `TensorDataset`) pairs."""
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+
+    train_examples = processor.get_train_examples(args.data_dir)
+    train_features = convert_examples_to_features(
+        train_examples, label_list, args.max_seq_length, tokenizer, output_mode)
+    train_data = features_to_dataset(train_features, output_mode)
+
+    eval_examples = processor.get_dev_examples(args.data_dir)
+    eval_features = convert_examples_to_features(
+        eval_examples, label_list, args.max_seq_length, tokenizer, output_mode)
+    eval_data = features_to_dataset(eval_features, output_mode)
+
+    test_examples = processor.get_test_examples(args.data_dir)
+    test_features = convert_examples_to_features(
+        test_examples, label_list, args.max_seq_length, tokenizer, output_mode)
+    test_sets = [('tst.tsv', features_to_dataset(test_features))]
+    if args.task_name == 'mnli':
+        test_examples = processor.get_testmm_examples(args.data_dir)
+        test_features = convert_examples_to_features(
+            test_examples, label_list, args.max_seq_length, tokenizer, output_mode)
+        test_sets.append(('tstmm.tsv', features_to_dataset(test_features)))
+    return train_data, eval_data, test_sets
+
+
+class Evaluator(object):
+    """Evaluates the student in the training process; training waits for it.
+
+    `submit` evaluates the model of a step (and predicts the test sets when the dev accuracy
+    improves), `poll` returns the new (result, state_dict) pairs, the state_dict being given for
+    the best results only.
+    """
+    def __init__(self, args, label_list, device, eval_data, test_sets, best_acc=0):
+        self.args = args
+        self.label_list = label_list
+        self.device = device
+        self.eval_dataloader = sequential_dataloader(eval_data, args)
+        self.test_sets = test_sets
+        self.best_acc = best_acc
+        self.results = []
+
+    def submit(self, model, step, p_type, p_rate):
+        reported = []
+        result = eval_and_test(model, step, p_type, p_rate, self.best_acc, self.args, self.device,
+                               self.label_list, self.eval_dataloader, self.test_sets, reported.append)
+        self.best_acc = max(self.best_acc, result['eval_accuracy'])
+        self.results.append((reported[0], model.state_dict() if result['is_best'] else None))
+        model.train()
+
+    def poll(self):
+        results, self.results = self.results, []
+        return results
+
+    def close(self):
+        return self.poll()
+
+
+def eval_worker(args, config, num_labels, label_list, device, eval_data, test_sets, best_acc, jobs, results):
+    """Body of the `AsyncEvaluator` process: evaluates the weight snapshots received on `jobs`,
+    with its own `args.eval_threads` threads, and puts the results on `results`."""
+    torch.set_num_threads(args.eval_threads)
+    with modeling_fast.no_init_weights():
+        model = modeling_fast.BertForSequenceClassification(config, num_labels=num_labels)
+    modeling_fast.materialize(model, device)
+    eval_dataloader = sequential_dataloader(eval_data, args)
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        step, state_dict, p_type, p_rate = job
+        try:
+            model.load_state_dict(state_dict)
+            result = eval_and_test(model, step, p_type, p_rate, best_acc, args, device, label_list,
+                                   eval_dataloader, test_sets, results.put)
+            best_acc = max(best_acc, result['eval_accuracy'])
+        except Exception:
+            results.put({'step': step, 'error': traceback.format_exc()})
+
+
+class AsyncEvaluator(object):
+    """`Evaluator` running in a separate process while training continues.
+
+    `submit` snapshots the weights to CPU and queues them (it only blocks when the worker is
+    more than one evaluation behind); the worker evaluates and tests them exactly as `Evaluator`
+    and `poll` returns the results received so far with the snapshot of the best ones.
+    """
+    def __init__(self, args, config, num_labels, label_list, device, eval_data, test_sets, best_acc=0):
+        context = torch.multiprocessing.get_context('spawn')
+        self.jobs = context.Queue(maxsize=1)
+        self.results = context.Queue()
+        self.snapshots = {}
+        self.process = context.Process(target=eval_worker, name='eval-worker',
+                                       args=(args, config, num_labels, label_list, device, eval_data,
+                                             test_sets, best_acc, self.jobs, self.results))
+        self.process.daemon = True
+        self.process.start()
+
+    def submit(self, model, step, p_type, p_rate):
+        snapshot = snapshot_state_dict(model.state_dict())
+        self.snapshots[step] = snapshot
+        self.jobs.put((step, snapshot, list(p_type), list(p_rate)))
+
+    def _result(self, result):
+        if 'error' in result:
+            raise RuntimeError("Evaluation of step {} failed:\n{}".format(result['step'], result['error']))
+        snapshot = self.snapshots.pop(result['step'], None)
+        return result, snapshot if result['is_best'] else None
+
+    def poll(self):
+        results = []
+        while self.snapshots and not self.results.empty():
+            results.append(self._result(self.results.get()))
+        return results
+
+    def close(self):
+        """Waits for the pending evaluations, stops the worker and returns the last results."""
+        results = []
+        while self.snapshots:
+            if not self.process.is_alive() and self.results.empty():
+                raise RuntimeError("The evaluation worker exited with code {}".format(self.process.exitcode))
+            try:
+                results.append(self._result(self.results.get(timeout=1.)))
+            except queue.Empty:
+                pass
+        self.jobs.put(None)
+        self.process.join()
+        return results
+
+
+def load_classifier(modeling_module, config, weights_file, num_labels):
+    """Builds `modeling_module.BertForSequenceClassification` without random initialization
+    and loads `weights_file` (memory-mapped when possible) into it."""
+    with modeling_module.no_init_weights():
+        model = modeling_module.BertForSequenceClassification(config, num_labels=num_labels)
+    modeling_module.materialize(model)
+    state_dict = modeling_module.load_state_dict_file(weights_file)
+    model.load_state_dict(state_dict, strict=False)
+    model.init_missing_weights([key for key in model.state_dict().keys() if key not in state_dict])
+    return model
 
 
 class prune_function:
-    def __init__(self, args):
+    def __init__(self, args, shared=None):
         self.args = args
         processors = {
             "cola": ColaProcessor,
@@ -743,17 +1074,26 @@ class prune_function:
             "wnli": "classification",
         }
 
-        if args.local_rank == -1 or args.no_cuda:
+        if args.local_rank == -1:
             device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
             n_gpu = torch.cuda.device_count()
+        elif args.no_cuda or not torch.cuda.is_available():
+            # One CPU process per rank (see `cpu_worker`), each with its share of the cores.
+            device = torch.device("cpu")
+            n_gpu = 0
+            local_world_size = int(os.environ.get('LOCAL_WORLD_SIZE', os.environ.get('WORLD_SIZE', 1)))
+            torch.set_num_threads(args.threads_per_proc or max(1, (os.cpu_count() or 1) // local_world_size))
+            if not torch.distributed.is_initialized():
+                torch.distributed.init_process_group(backend='gloo')
         else:
             torch.cuda.set_device(args.local_rank)
             device = torch.device("cuda", args.local_rank)
             n_gpu = 1
             # Initializes the distributed backend which will take care of sychronizing nodes/GPUs
-            torch.distributed.init_process_group(backend='nccl')
-        logger.info("device: {} n_gpu: {}, distributed training: {}, 16-bits training: {}".format(
-            device, n_gpu, bool(args.local_rank != -1), args.fp16))
+            if not torch.distributed.is_initialized():
+                torch.distributed.init_process_group(backend='nccl')
+        logger.info("device: {} n_gpu: {}, distributed training: {}, 16-bits training: {}, threads: {}".format(
+            device, n_gpu, bool(args.local_rank != -1), args.fp16, torch.get_num_threads()))
         self.device = device
 
         if args.gradient_accumulation_steps < 1:
@@ -788,73 +1128,34 @@ class prune_function:
         self.label_list = label_list
         num_labels = len(label_list)
 
-        tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
-
-        train_examples = None
-        num_train_optimization_steps = None
-        if args.do_train:
-            train_examples = processor.get_train_examples(args.data_dir)
-            self.num_train_optimization_steps = int(
-                len(train_examples) / args.train_batch_size / args.gradient_accumulation_steps) * args.num_train_epochs
-            if args.local_rank != -1:
-                self.num_train_optimization_steps = num_train_optimization_steps // torch.distributed.get_world_size()
-        output_eval_file = os.path.join(args.output_dir, "eval_results.txt")
-        # f = open(output_eval_file, "w")
-        train_features = convert_examples_to_features(
-            train_examples, label_list, args.max_seq_length, tokenizer, output_mode)
+        if shared is None:
+            train_data, eval_data, test_sets = featurize_task(args, processor, label_list, output_mode)
+        else:
+            train_data, eval_data, test_sets = shared['train_data'], shared['eval_data'], shared['test_sets']
+        self.train_data = train_data
+        self.eval_data = eval_data
+        # (prediction file, unlabelled data) pairs written when the dev accuracy improves
+        self.test_sets = test_sets
+
+        self.num_train_optimization_steps = int(
+            len(train_data) / args.train_batch_size / args.gradient_accumulation_steps) * args.num_train_epochs
+        if args.local_rank != -1:
+            self.num_train_optimization_steps = self.num_train_optimization_steps // torch.distributed.get_world_size()
         logger.info("***** Running training *****")
-        logger.info("  Num examples = %d", len(train_examples))
+        logger.info("  Num examples = %d", len(train_data))
         logger.info("  Batch size = %d", args.train_batch_size)
         logger.info("  Num steps = %d", self.num_train_optimization_steps)
-        all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-
-        if output_mode == "classification":
-            all_label_ids = torch.tensor([f.label_id for f in train_features], dtype=torch.long)
-        elif output_mode == "regression":
-            all_label_ids = torch.tensor([f.label_id for f in train_features], dtype=torch.float)
-
-        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
+        # Seeded per epoch, so that a resumed run continues with the same batches.
         if args.local_rank == -1:
-            train_sampler = RandomSampler(train_data)
+            train_sampler = ResumableRandomSampler(train_data, seed=args.seed)
         else:
-            train_sampler = DistributedSampler(train_data)
+            train_sampler = ResumableRandomSampler(train_data, seed=args.seed,
+                                                   num_replicas=torch.distributed.get_world_size(),
+                                                   rank=torch.distributed.get_rank())
+        self.train_sampler = train_sampler
         self.train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
-
-        eval_examples = processor.get_dev_examples(args.data_dir)
-        eval_features = convert_examples_to_features(
-            eval_examples, label_list, args.max_seq_length, tokenizer, output_mode)
-        all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
-        all_label_ids = torch.tensor([f.label_id for f in eval_features], dtype=torch.long)
-        eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label_ids)
         # Run prediction for full data
-        eval_sampler = SequentialSampler(eval_data)
-        self.eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
-
-        test_examples = processor.get_test_examples(args.data_dir)
-        test_features = convert_examples_to_features(
-            test_examples, label_list, args.max_seq_length, tokenizer, output_mode)
-        all_input_ids = torch.tensor([f.input_ids for f in test_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in test_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in test_features], dtype=torch.long)
-        test_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids)
-        # Run prediction for full data
-        test_sampler = SequentialSampler(test_data)
-        self.test_dataloader = DataLoader(test_data, sampler=test_sampler, batch_size=args.eval_batch_size)
-        if args.task_name == 'mnli':
-            test_examples = processor.get_testmm_examples(args.data_dir)
-            test_features = convert_examples_to_features(
-                test_examples, label_list, args.max_seq_length, tokenizer, output_mode)
-            all_input_ids = torch.tensor([f.input_ids for f in test_features], dtype=torch.long)
-            all_input_mask = torch.tensor([f.input_mask for f in test_features], dtype=torch.long)
-            all_segment_ids = torch.tensor([f.segment_ids for f in test_features], dtype=torch.long)
-            test_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids)
-            # Run prediction for full data
-            test_sampler = SequentialSampler(test_data)
-            self.testmm_dataloader = DataLoader(test_data, sampler=test_sampler, batch_size=args.eval_batch_size)
+        self.eval_dataloader = sequential_dataloader(eval_data, args)
 
         '''cache_dir = args.cache_dir if args.cache_dir else os.path.join(str(PYTORCH_PRETRAINED_BERT_CACHE),
                                                                        'distributed_{}'.format(args.local_rank))
@@ -863,7 +1164,6 @@ class prune_function:
                                                               num_labels=num_labels)'''
 
         if args.bert_model == 'bert-base-uncased':
-            layer_num = 12  # others not implemented
             new_dim = 256
 
         if args.svd_weight_dir is None:
@@ -872,32 +1172,18 @@ class prune_function:
             model = modeling_fast.BertForSequenceClassification.from_pretrained(args.bert_model,
                                                                                 cache_dir=cache_dir,
                                                                                 num_labels=num_labels)
-            for i in range(layer_num):
-                pt = model.bert.encoder.layer[i].attention.self
-                pt.qmat1, pt.qmat2 = svd(pt.query.weight.detach().cpu().numpy(), new_dim)
-                pt.kmat1, pt.kmat2 = svd(pt.key.weight.detach().cpu().numpy(), new_dim)
-                pt.vmat1, pt.vmat2 = svd(pt.value.weight.detach().cpu().numpy(), new_dim)
-                pt = model.bert.encoder.layer[i].attention.output
-                pt.dmat1, pt.dmat2 = svd(pt.dense.weight.detach().cpu().numpy(), new_dim)
-                pt = model.bert.encoder.layer[i].intermediate
-                pt.dmat1, pt.dmat2 = svd(pt.dense.weight.detach().cpu().numpy(), new_dim)
-                pt = model.bert.encoder.layer[i].output
-                pt.dmat1, pt.dmat2 = svd(pt.dense.weight.detach().cpu().numpy(), new_dim)
-                print('init weight finish')
+            init_svd_factors(model, new_dim, method=args.svd_method, num_workers=args.svd_workers,
+                             cache_dir=os.path.join(cache_dir, 'svd_factors'))
+            if args.embd_rank is not None:
+                factorize_word_embeddings(model, args.embd_rank, method=args.svd_method,
+                                          cache_dir=os.path.join(cache_dir, 'svd_factors'))
+            print('init weight finish')
 
             model_to_save = model.module if hasattr(model, 'module') else model  # Only save the model it-self
-            output_model_file = os.path.join(args.output_dir, WEIGHTS_NAME)
-            statedict = model_to_save.state_dict()
-            torch.save(statedict, output_model_file)
-            #torch.save(statedict, '/home/yayaming/maoyh/mnli_svd_weight_184/'+WEIGHTS_NAME)
             output_config_file = os.path.join(args.output_dir, CONFIG_NAME)
             f1 = open(output_config_file, 'w+')
             f1.write(model_to_save.config.to_json_string())
             f1.close()
-            # Load a trained model and config that you have fine-tuned
-            config = modeling_fast.BertConfig(output_config_file)
-            model = modeling_fast.BertForSequenceClassification(config, num_labels=num_labels)
-            model.load_state_dict(torch.load(output_model_file))
         else:
             if args.bert_model == 'bert-base-uncased':
                 svd_weight = args.svd_weight_dir
@@ -908,13 +1194,23 @@ class prune_function:
                 if args.cont_model!='':
                     output_model_file=os.path.join(args.cont_model, WEIGHTS_NAME)
             config = modeling_fast.BertConfig(output_config_file)
-            model = modeling_fast.BertForSequenceClassification(config, num_labels=num_labels)
-            model.load_state_dict(torch.load(output_model_file), strict=False)
+            model = load_classifier(modeling_fast, config, output_model_file, num_labels)
+            if args.embd_rank is not None and getattr(config, 'embedding_rank', None) is None:
+                factorize_word_embeddings(model, args.embd_rank, method=args.svd_method)
+            # The checkpoints written to output_dir go with this config.
+            f1 = open(os.path.join(args.output_dir, CONFIG_NAME), 'w+')
+            f1.write(model.config.to_json_string())
+            f1.close()
 
+        if args.checkpoint_every:
+            model.set_gradient_checkpointing(args.checkpoint_every)
         if args.fp16:
             model.half()
         model.to(device)
-        if args.local_rank != -1:
+        if args.local_rank != -1 and device.type == 'cpu':
+            # The dense weights are unused by the 'svd' projections.
+            model = torch.nn.parallel.DistributedDataParallel(model, find_unused_parameters=True)
+        elif args.local_rank != -1:
             try:
                 from apex.parallel import DistributedDataParallel as DDP
             except ImportError:
@@ -930,16 +1226,29 @@ class prune_function:
         self.n_gpu = n_gpu
 
         # model_t
-        distill_weight = args.distill_dir
-        distill_weight_file = os.path.join(distill_weight, WEIGHTS_NAME)
-        config = BertConfig(output_config_file)
-        model_t = BertForSequenceClassification(config, num_labels=num_labels)
+        if shared is None:
+            distill_weight = args.distill_dir
+            distill_weight_file = os.path.join(distill_weight, WEIGHTS_NAME)
+            config = BertConfig(output_config_file)
+            model_t = load_classifier(modeling_ori, config, distill_weight_file, num_labels)
+        else:
+            model_t = shared['model_t']
         model_t.eval()
-        model_t.load_state_dict(torch.load(distill_weight_file), strict=False)
-        model_t.cuda()
+        model_t.to(device)
         self.model_t = model_t
         print('init finish')
 
+    def shared_state(self):
+        """The featurized data and the teacher (on CPU), moved to shared memory, from which
+        `prune_function(args, shared)` is built without reading the data or the teacher again
+        (e.g. in the worker processes of run_sweep.py)."""
+        for data in [self.train_data, self.eval_data] + [data for _, data in self.test_sets]:
+            for tensor in data.tensors:
+                tensor.share_memory_()
+        self.model_t.cpu().share_memory()
+        return {'train_data': self.train_data, 'eval_data': self.eval_data, 'test_sets': self.test_sets,
+                'model_t': self.model_t}
+
     def eval_after_train(self, prune_type, target_prune_rate):
         args = self.args
         device = self.device
@@ -948,11 +1257,21 @@ class prune_function:
         n_gpu = self.n_gpu
 
         now_step = 0
-        layer_num = 12
 
         model = self.model  # copy.deepcopy(self.model)
         model_t = self.model_t
+        raw_model = model.module if hasattr(model, 'module') else model
         param_optimizer = list(model.named_parameters())
+        word_table = word_embedding_params(raw_model)[0]
+        embedding_optimizer = None
+        if args.sparse_embeddings:
+            # The word table (the lookup factor when factorized) gets row-sparse gradients and its own optimizer.
+            raw_model.bert.embeddings.word_embeddings.sparse = True
+            param_optimizer = [(n, p) for n, p in param_optimizer if p is not word_table]
+            embedding_optimizer = SparseBertAdam([word_table],
+                                                 lr=args.learning_rate,
+                                                 warmup=args.warmup_proportion,
+                                                 t_total=self.num_train_optimization_steps)
         no_decay = ['bias', 'LayerNorm.bias', 'LayerNorm.weight']
         optimizer_grouped_parameters = [
             {'params': [p for n, p in param_optimizer if not any(nd in n for nd in no_decay)],
@@ -980,11 +1299,15 @@ class prune_function:
             optimizer = BertAdam(optimizer_grouped_parameters,
                                  lr=args.learning_rate,
                                  warmup=args.warmup_proportion,
-                                 t_total=self.num_train_optimization_steps)
+                                 t_total=self.num_train_optimization_steps,
+                                 global_grad_norm=args.global_grad_norm,
+                                 compact_state=args.compact_optimizer_state,
+                                 state_bits=args.optimizer_state_bits)
+
+        checkpoint_writer = AsyncCheckpointWriter(args.output_dir, best_name=WEIGHTS_NAME,
+                                                  keep_last=args.keep_checkpoints)
 
         global_step = 0
-        nb_tr_steps = 0
-        tr_loss = 0
         model.train()
 
         best_acc = 0
@@ -992,73 +1315,34 @@ class prune_function:
         f = open(output_eval_file, "a")
 
         global wr_now, intv
+        # With BertAdam the pruning masks are handed to the optimizer; FusedAdam re-prunes every step.
+        mask_pruned = not args.fp16
+        pruned_wr = None
         loss_mse = MSELoss()
+        timer = StepTimer(enabled=args.timing_interval > 0, synchronize=args.timing_sync, device=device,
+                          path=os.path.join(args.output_dir, 'step_times.jsonl') if is_main_process() else None,
+                          interval=args.timing_interval)
         def soft_cross_entropy(predicts, targets):
             student_likelihood = torch.nn.functional.log_softmax(predicts, dim=-1)
             targets_prob = torch.nn.functional.softmax(targets, dim=-1)
             return (- targets_prob * student_likelihood).mean()
 
-        for epoch_i in trange(int(args.num_train_epochs), desc="Epoch"):
-            tr_loss = 0.
-            tr_att_loss = 0.
-            tr_rep_loss = 0.
-            tr_cls_loss = 0.
-            nb_tr_examples, nb_tr_steps = 0, 0
-            start = time.time()
-            for step, batch in enumerate(tqdm(self.train_dataloader, desc="Iteration")):
-                if False and global_step > 0 and global_step % 50 == 0:
-
-                    model.eval()
-                    eval_loss, eval_accuracy = 0, 0
-                    eval_mc = 0
-                    nb_eval_steps, nb_eval_examples = 0, 0
-
-                    for input_ids, input_mask, segment_ids, label_ids in tqdm(self.eval_dataloader, desc="Evaluating"):
-                        input_ids = input_ids.to(device)
-                        input_mask = input_mask.to(device)
-                        segment_ids = segment_ids.to(device)
-                        label_ids = label_ids.to(device)
-
-                        with torch.no_grad():
-                            tmp_eval_loss = model(input_ids, segment_ids, input_mask, label_ids,
-                                                  p_type=prune_type, p_rate=prune_rate)
-                            logits = model(input_ids, segment_ids, input_mask, p_type=prune_type, p_rate=prune_rate)
-
-                        logits = logits.detach().cpu().numpy()
-                        label_ids = label_ids.to('cpu').numpy()
-                        tmp_eval_accuracy, mc = accuracy(logits, label_ids)
-
-                        eval_loss += tmp_eval_loss.mean().item()
-                        eval_accuracy += tmp_eval_accuracy
-                        eval_mc += mc
-
-                        nb_eval_examples += input_ids.size(0)
-                        nb_eval_steps += 1
-
-                    eval_loss = eval_loss / nb_eval_steps
-                    eval_accuracy = eval_accuracy / nb_eval_examples
+        def distill_losses(input_ids, input_mask, segment_ids, label_ids, prune_rate, bf16=args.bf16):
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=bf16):
+                with timer.phase('student_forward'):
+                    student_logits, student_atts, student_reps = model(input_ids, segment_ids, input_mask,
+                                                                            p_type=prune_type, p_rate=prune_rate)
 
-                if epoch_i == 0:
-                    if wr_now < step // intv and wr_now < split:  # sr_now, wr_now are increased here
-                        if wr_now < wr_target:
-                            wr_now += 1
-                else:
-                    wr_now = wr_target
-                prune_rate = [1.]*48# sr's temporary prune rate is assigned here, unused
-
-                batch = tuple(t.to(device) for t in batch)
-                input_ids, input_mask, segment_ids, label_ids = batch
+                with timer.phase('teacher_forward'), torch.no_grad():
+                    teacher_logits, teacher_atts, teacher_reps = model_t(input_ids, segment_ids, input_mask)
+            with timer.phase('loss'):
+                # The losses are computed in fp32.
+                student_logits, teacher_logits = student_logits.float(), teacher_logits.float()
 
                 att_loss = 0.
                 rep_loss = 0.
                 cls_loss = 0.
 
-                student_logits, student_atts, student_reps = model(input_ids, segment_ids, input_mask,
-                                                                        p_type=prune_type, p_rate=prune_rate)
-
-                with torch.no_grad():
-                    teacher_logits, teacher_atts, teacher_reps = model_t(input_ids, segment_ids, input_mask)
-
                 # if not args.pred_distill:
                 teacher_layer_num = len(teacher_atts)
                 student_layer_num = len(student_atts)
@@ -1068,6 +1352,7 @@ class prune_function:
                                     for i in range(student_layer_num)]
 
                 for student_att, teacher_att in zip(student_atts, new_teacher_atts):
+                    student_att, teacher_att = student_att.float(), teacher_att.float()
                     student_att = torch.where(student_att <= -1e2, torch.zeros_like(student_att).to(device),
                                               student_att)
                     teacher_att = torch.where(teacher_att <= -1e2, torch.zeros_like(teacher_att).to(device),
@@ -1079,120 +1364,100 @@ class prune_function:
                 new_teacher_reps = [teacher_reps[i * layers_per_block] for i in range(student_layer_num)]
                 new_student_reps = student_reps
                 for student_rep, teacher_rep in zip(new_student_reps, new_teacher_reps):
-                    tmp_loss = loss_mse(student_rep, teacher_rep)
+                    tmp_loss = loss_mse(student_rep.float(), teacher_rep.float())
                     rep_loss += tmp_loss
 
-                loss = rep_loss + att_loss
-                tr_att_loss += att_loss.item()
-                tr_rep_loss += rep_loss.item()
                 # else:
                 if output_mode == "classification":
                     cls_loss = soft_cross_entropy(student_logits / 1,#args.temperature,
                                                   teacher_logits / 1)#args.temperature)
                 elif output_mode == "regression":
-                    loss_mse = MSELoss()
                     cls_loss = loss_mse(student_logits.view(-1), label_ids.view(-1))
-
-                loss += cls_loss
-                tr_cls_loss += cls_loss.item()
-
-
-                if n_gpu > 1:
-                    loss = loss.mean()  # mean() to average on multi-gpu.
-                if args.gradient_accumulation_steps > 1:
-                    loss = loss / args.gradient_accumulation_steps
-
-                if args.fp16:
-                    optimizer.backward(loss)
-                else:
-                    loss.backward()
-
-                tr_loss += loss.item()
-                nb_tr_examples += input_ids.size(0)
-                nb_tr_steps += 1
-                if (step + 1) % args.gradient_accumulation_steps == 0:
-                    if args.fp16:
-                        # modify learning rate with special warm up BERT uses
-                        # if args.fp16 is False, BertAdam is used that handles this automatically
-                        lr_this_step = args.learning_rate * warmup_linear(
-                            global_step / self.num_train_optimization_steps,
-                            args.warmup_proportion)
-                        for param_group in optimizer.param_groups:
-                            param_group['lr'] = lr_this_step
-                    optimizer.step()
-                    optimizer.zero_grad()
-                    global_step += 1
-                # sparse
-                if step > 0:  # weight pruning is done here
-                    # prune embd
-                    r = args.embd_r
-                    embd = model.bert.embeddings.word_embeddings.weight
-                    do_sparse(embd, r, None, model)
-
-                    for layer_now in range(layer_num):
-                        svd_ch = [model.bert.encoder.layer[layer_now].attention.self.qmat1[:,
-                                  :model.bert.encoder.layer[layer_now].attention.self.to_dim],
-                                  model.bert.encoder.layer[layer_now].attention.self.qmat2[
-                                  :model.bert.encoder.layer[layer_now].attention.self.to_dim, :],
-                                  model.bert.encoder.layer[layer_now].attention.self.kmat1[:,
-                                  :model.bert.encoder.layer[layer_now].attention.self.to_dim],
-                                  model.bert.encoder.layer[layer_now].attention.self.kmat2[
-                                  :model.bert.encoder.layer[layer_now].attention.self.to_dim, :],
-                                  model.bert.encoder.layer[layer_now].attention.self.vmat1[:,
-                                  :model.bert.encoder.layer[layer_now].attention.self.to_dim],
-                                  model.bert.encoder.layer[layer_now].attention.self.vmat2[
-                                  :model.bert.encoder.layer[layer_now].attention.self.to_dim, :],
-                                  model.bert.encoder.layer[layer_now].attention.output.dmat1[:,
-                                  :model.bert.encoder.layer[layer_now].attention.output.to_dim],
-                                  model.bert.encoder.layer[layer_now].attention.output.dmat2[
-                                  :model.bert.encoder.layer[layer_now].attention.output.to_dim, :],
-                                  model.bert.encoder.layer[layer_now].intermediate.dmat1[:,
-                                  :model.bert.encoder.layer[layer_now].intermediate.to_dim],
-                                  model.bert.encoder.layer[layer_now].intermediate.dmat2[
-                                  :model.bert.encoder.layer[layer_now].intermediate.to_dim, :],
-                                  model.bert.encoder.layer[layer_now].output.dmat1[:,
-                                  :model.bert.encoder.layer[layer_now].output.to_dim],
-                                  model.bert.encoder.layer[layer_now].output.dmat2[
-                                  :model.bert.encoder.layer[layer_now].output.to_dim, :]]
-                        svd_ch_temp = [model.bert.encoder.layer[layer_now].attention.self.qmat1,
-                                       model.bert.encoder.layer[layer_now].attention.self.qmat2,
-                                       model.bert.encoder.layer[layer_now].attention.self.kmat1,
-                                       model.bert.encoder.layer[layer_now].attention.self.kmat2,
-                                       model.bert.encoder.layer[layer_now].attention.self.vmat1,
-                                       model.bert.encoder.layer[layer_now].attention.self.vmat2,
-                                       model.bert.encoder.layer[layer_now].attention.output.dmat1,
-                                       model.bert.encoder.layer[layer_now].attention.output.dmat2,
-                                       model.bert.encoder.layer[layer_now].intermediate.dmat1,
-                                       model.bert.encoder.layer[layer_now].intermediate.dmat2,
-                                       model.bert.encoder.layer[layer_now].output.dmat1,
-                                       model.bert.encoder.layer[layer_now].output.dmat2]
-                        id = [0, 0, 0, 0, 0, 0, 1, 1, 2, 2, 3, 3]
-                        for i in range(12):
-                            r = 1 - target_prune_rate[layer_now * 4 + id[i]] ** (
-                                    1. * wr_now / split)  # 1-target_r^{sr_now/split} for each layer
-                            svd_ch_temp[i] = torch.nn.Parameter(do_sparse(svd_ch_temp[i], r, None, model))
-
-                            '''print(i, (model.bert.encoder.layer[layer_now].attention.self.qmat1[:,
-                                      :model.bert.encoder.layer[layer_now].attention.self.to_dim] == 0).sum())
-                            print(i, (model.bert.encoder.layer[layer_now].attention.self.qmat2[
-                                      :model.bert.encoder.layer[layer_now].attention.self.to_dim, :] == 0).sum())'''
-
-                        svd_ch_check = [model.bert.encoder.layer[layer_now].attention.self.qmat1,
-                                        model.bert.encoder.layer[layer_now].attention.self.qmat2,
-                                        model.bert.encoder.layer[layer_now].attention.self.kmat1,
-                                        model.bert.encoder.layer[layer_now].attention.self.kmat2,
-                                        model.bert.encoder.layer[layer_now].attention.self.vmat1,
-                                        model.bert.encoder.layer[layer_now].attention.self.vmat2,
-                                        model.bert.encoder.layer[layer_now].attention.output.dmat1,
-                                        model.bert.encoder.layer[layer_now].attention.output.dmat2,
-                                        model.bert.encoder.layer[layer_now].intermediate.dmat1,
-                                        model.bert.encoder.layer[layer_now].intermediate.dmat2,
-                                        model.bert.encoder.layer[layer_now].output.dmat1,
-                                        model.bert.encoder.layer[layer_now].output.dmat2]
-                now_step += 1
-                # if now_step == all_steps:
-                # break
-                if global_step%2000==0:
+            return att_loss, rep_loss, cls_loss
+
+        if args.bf16:
+            # Loss parity check: the bf16 losses of the first batch should match the fp32 ones.
+            model.eval()
+            batch = tuple(t.to(device) for t in next(iter(self.train_dataloader)))
+            with torch.no_grad():
+                fp32_losses = distill_losses(*batch, prune_rate=[1.]*48, bf16=False)
+                bf16_losses = distill_losses(*batch, prune_rate=[1.]*48, bf16=True)
+            model.train()
+            for name, fp32_loss, bf16_loss in zip(['att', 'rep', 'cls'], fp32_losses, bf16_losses):
+                fp32_loss, bf16_loss = float(fp32_loss), float(bf16_loss)
+                diff = abs(bf16_loss - fp32_loss) / max(abs(fp32_loss), 1e-12)
+                logger.info("bf16 loss parity (%s): fp32 %.6f, bf16 %.6f, relative difference %.4f",
+                            name, fp32_loss, bf16_loss, diff)
+                if diff > args.bf16_parity_tol:
+                    logger.warning("bf16 %s loss differs from fp32 by more than %s", name, args.bf16_parity_tol)
+            timer.reset()
+
+        start_epoch, start_step, resumed_losses = 0, 0, None
+        state_file = os.path.join(args.output_dir, TRAINING_STATE_NAME)
+        if args.resume and os.path.exists(state_file):
+            state = load_training_state(state_file)
+            raw_model.load_state_dict(state['model'])
+            optimizer.load_state_dict(state['optimizer'])
+            if embedding_optimizer is not None:
+                embedding_optimizer.load_state_dict(state['embedding_optimizer'])
+            global_step, best_acc = state['global_step'], state['best_acc']
+            wr_now, pruned_wr = state['wr_now'], state['pruned_wr']
+            start_epoch, start_step, resumed_losses = state['epoch'], state['step'], state['losses']
+            checkpoint_writer.best_metric = best_acc if best_acc > 0 else None
+            set_rng_state(state['rng'])
+            logger.info("resumed from %s: epoch %d, step %d, global step %d, wr_now %s, best accuracy %s",
+                        state_file, start_epoch, start_step, global_step, wr_now, best_acc)
+        elif args.resume:
+            logger.warning("--resume: no %s, training from the start", state_file)
+
+        def save_training_state(epoch, step, losses):
+            # Everything needed to continue after the `step` first batches of `epoch`.
+            state = {'model': raw_model.state_dict(),
+                     'optimizer': optimizer.state_dict(),
+                     'embedding_optimizer': embedding_optimizer.state_dict() if embedding_optimizer else None,
+                     'global_step': global_step,
+                     'best_acc': best_acc,
+                     'wr_now': wr_now,
+                     'pruned_wr': pruned_wr,
+                     'epoch': epoch,
+                     'step': step,
+                     'losses': (dict(losses.flush()), losses.count),
+                     'rng': get_rng_state()}
+            checkpoint_writer.save_state(state, global_step, TRAINING_STATE_NAME)
+
+        if args.async_eval and is_main_process():
+            evaluator = AsyncEvaluator(args, raw_model.config, num_labels, self.label_list, device,
+                                       self.eval_data, self.test_sets, best_acc=best_acc)
+        else:
+            evaluator = Evaluator(args, self.label_list, device, self.eval_data, self.test_sets, best_acc=best_acc)
+
+        def report_eval(result, state_dict):
+            if result.pop('is_best'):
+                # Written to WEIGHTS_NAME in the background.
+                checkpoint_writer.save(state_dict, result['step'], metric=result['eval_accuracy'])
+            logger.info("Eval Loss: %s", result)
+            f.write("Eval Loss: %s\n" % result)
+            f.flush()
+            return result['eval_accuracy']
+
+        profiler = profiler_window(args.profile_start, args.profile_steps, args.output_dir)
+        if profiler is not None:
+            profiler.start()
+        train_time, train_examples = 0., 0
+        for epoch_i in trange(start_epoch, int(args.num_train_epochs), desc="Epoch"):
+            first_step = start_step if epoch_i == start_epoch else 0
+            self.train_sampler.set_epoch(epoch_i, first_step * args.train_batch_size)
+            # Summed on the device; read back (one synchronization) every --loss_log_interval steps.
+            tr_losses = DeviceAccumulator(['loss', 'att_loss', 'rep_loss', 'cls_loss'], device,
+                                          flush_every=args.loss_log_interval)
+            if first_step and resumed_losses is not None:
+                tr_losses.totals.update(resumed_losses[0])
+                tr_losses.count = resumed_losses[1]
+            start = time.time()
+            for step, batch in enumerate(timer.iterate(tqdm(self.train_dataloader, desc="Iteration"), 'data'),
+                                         start=first_step):
+                step_start = time.time()
+                if False and global_step > 0 and global_step % 50 == 0:
 
                     model.eval()
                     eval_loss, eval_accuracy = 0, 0
@@ -1206,135 +1471,120 @@ class prune_function:
                         label_ids = label_ids.to(device)
 
                         with torch.no_grad():
-                            logits,_,_ = model(input_ids, segment_ids, input_mask, p_type=prune_type, p_rate=prune_rate)
+                            tmp_eval_loss = model(input_ids, segment_ids, input_mask, label_ids,
+                                                  p_type=prune_type, p_rate=prune_rate)
+                            logits = model(input_ids, segment_ids, input_mask, p_type=prune_type, p_rate=prune_rate)
 
-                        logits = logits.detach().cpu().numpy()
+                        logits = logits.detach().float().cpu().numpy()
                         label_ids = label_ids.to('cpu').numpy()
                         tmp_eval_accuracy, mc = accuracy(logits, label_ids)
 
+                        eval_loss += tmp_eval_loss.mean().item()
                         eval_accuracy += tmp_eval_accuracy
                         eval_mc += mc
 
                         nb_eval_examples += input_ids.size(0)
                         nb_eval_steps += 1
 
+                    eval_loss = eval_loss / nb_eval_steps
                     eval_accuracy = eval_accuracy / nb_eval_examples
-                    if eval_accuracy > best_acc:
-                        best_acc = eval_accuracy
-                        to_test = True
-                    else:
-                        to_test = False
-                    eval_mc = eval_mc / nb_eval_steps
-                    result = {'eval_accuracy': eval_accuracy,
-                              'mc': eval_mc,'step':global_step}
-                    logger.info("Eval Loss: %s", result)
-                    f.write("Eval Loss: %s\n" % result)
-                    f.close()
-                    f = open(output_eval_file, "a")
-
-                    if to_test:  # below is the output of test dataset
-                        model_to_save = model.module if hasattr(model,
-                                                                'module') else model  # Only save the model it-self
-                        output_model_file = os.path.join(args.output_dir, WEIGHTS_NAME)
-                        statedict = model_to_save.state_dict()
-                        torch.save(statedict, output_model_file)
-
-                        model.eval()
-                        ans = np.array([])
-                        for input_ids, input_mask, segment_ids in tqdm(self.test_dataloader, desc="test"):
-                            input_ids = input_ids.to(device)
-                            input_mask = input_mask.to(device)
-                            segment_ids = segment_ids.to(device)
-
-                            with torch.no_grad():
-                                logits,_,_ = model(input_ids, segment_ids, input_mask, p_type=prune_type, p_rate=prune_rate)
-
-                            logits = logits.detach().cpu().numpy()
-                            outputs = np.argmax(logits, axis=1)
-                            ans = np.concatenate((ans, outputs))
-
-                        if args.task_name == 'cola':
-                            f1 = open('tst.tsv', 'w')
-                            f1.write('index\tprediction\n')
-                            for i in range(1, ans.shape[0]):
-                                f1.write(str(i - 1) + '\t' + str(int(ans[i])) + '\n')
-                            f1.close()
-                            f1 = open(os.path.join(args.output_dir, 'tst.tsv'), "w")
-                            f1.write('index\tprediction\n')
-                            for i in range(1, ans.shape[0]):
-                                f1.write(str(i - 1) + '\t' + str(int(ans[i])) + '\n')
-                            f1.close()
-                        elif args.task_name == 'mnli':
-                            model.eval()
-                            ans = np.array([])
-                            for input_ids, input_mask, segment_ids in tqdm(self.test_dataloader, desc="test"):
-                                input_ids = input_ids.to(device)
-                                input_mask = input_mask.to(device)
-                                segment_ids = segment_ids.to(device)
-
-                                with torch.no_grad():
-                                    logits,_,_ = model(input_ids, segment_ids, input_mask, p_type=prune_type,
-                                                   p_rate=prune_rate)
-
-                                logits = logits.detach().cpu().numpy()
-                                outputs = np.argmax(logits, axis=1)
-                                ans = np.concatenate((ans, outputs))
-
-                            f1 = open('tst.tsv', 'w')
-                            f1.write('index\tprediction\n')
-                            for i in range(ans.shape[0]):
-                                f1.write(str(i) + '\t' + self.label_list[int(ans[i])] + '\n')
-                            f1.close()
-                            f1 = open(os.path.join(args.output_dir, 'tst.tsv'), "w")
-                            f1.write('index\tprediction\n')
-                            for i in range(ans.shape[0]):
-                                f1.write(str(i) + '\t' + self.label_list[int(ans[i])] + '\n')
-                            f1.close()
-
-                            model.eval()
-                            ans = np.array([])
-                            for input_ids, input_mask, segment_ids in tqdm(self.testmm_dataloader, desc="test"):
-                                input_ids = input_ids.to(device)
-                                input_mask = input_mask.to(device)
-                                segment_ids = segment_ids.to(device)
-
-                                with torch.no_grad():
-                                    logits,_,_ = model(input_ids, segment_ids, input_mask, p_type=prune_type,
-                                                   p_rate=prune_rate)
-
-                                logits = logits.detach().cpu().numpy()
-                                outputs = np.argmax(logits, axis=1)
-                                ans = np.concatenate((ans, outputs))
-
-                            f1 = open('tstmm.tsv', 'w')
-                            f1.write('index\tprediction\n')
-                            for i in range(ans.shape[0]):
-                                f1.write(str(i) + '\t' + self.label_list[int(ans[i])] + '\n')
-                            f1.close()
-                            f1 = open(os.path.join(args.output_dir, 'tstmm.tsv'), "w")
-                            f1.write('index\tprediction\n')
-                            for i in range(ans.shape[0]):
-                                f1.write(str(i) + '\t' + self.label_list[int(ans[i])] + '\n')
-                            f1.close()
-                        else:
-                            f1 = open('tst.tsv', 'w')
-                            f1.write('index\tprediction\n')
-                            for i in range(ans.shape[0]):
-                                f1.write(str(i) + '\t' + self.label_list[int(ans[i])] + '\n')
-                            f1.close()
-                            f1 = open(os.path.join(args.output_dir, 'tst.tsv'), "w")
-                            f1.write('index\tprediction\n')
-                            for i in range(ans.shape[0]):
-                                f1.write(str(i) + '\t' + self.label_list[int(ans[i])] + '\n')
-                            f1.close()
-            out = {'epoch': epoch_i, 'loss': tr_loss / (step + 1), 'time': time.time() - start}
-            logger.info("Train Loss: %s", out)
 
+                if epoch_i == 0:
+                    if wr_now < step // intv and wr_now < split:  # sr_now, wr_now are increased here
+                        if wr_now < wr_target:
+                            wr_now += 1
+                else:
+                    wr_now = wr_target
+                prune_rate = [1.]*48# sr's temporary prune rate is assigned here, unused
+
+                with timer.phase('h2d'):
+                    batch = tuple(t.to(device) for t in batch)
+                input_ids, input_mask, segment_ids, label_ids = batch
+
+                att_loss, rep_loss, cls_loss = distill_losses(input_ids, input_mask, segment_ids, label_ids,
+                                                              prune_rate)
+                loss = rep_loss + att_loss
+                loss += cls_loss
+
+                if n_gpu > 1:
+                    loss = loss.mean()  # mean() to average on multi-gpu.
+                if args.gradient_accumulation_steps > 1:
+                    loss = loss / args.gradient_accumulation_steps
 
+                with timer.phase('backward'):
+                    if args.fp16:
+                        optimizer.backward(loss)
+                    else:
+                        loss.backward()
+
+                if tr_losses.add(loss=loss, att_loss=att_loss, rep_loss=rep_loss, cls_loss=cls_loss):
+                    logger.info("Train Loss: %s", dict(tr_losses.means(), epoch=epoch_i, step=global_step))
+                if (step + 1) % args.gradient_accumulation_steps == 0:
+                    with timer.phase('optimizer'):
+                        if args.fp16:
+                            # modify learning rate with special warm up BERT uses
+                            # if args.fp16 is False, BertAdam is used that handles this automatically
+                            lr_this_step = args.learning_rate * warmup_linear(
+                                global_step / self.num_train_optimization_steps,
+                                args.warmup_proportion)
+                            for param_group in optimizer.param_groups:
+                                param_group['lr'] = lr_this_step
+                        optimizer.step()
+                        optimizer.zero_grad()
+                        if embedding_optimizer is not None:
+                            embedding_optimizer.step()
+                            embedding_optimizer.zero_grad()
+                        global_step += 1
+                # sparse
+                if step > 0 and pruned_wr != wr_now:  # weight pruning is done here
+                    with timer.phase('prune'):
+                        pruned = prune_student(raw_model, args.embd_r, target_prune_rate, wr_now, split)
+                        if torch.distributed.is_initialized():
+                            # Every rank keeps exactly the entries kept by rank 0.
+                            for param in pruned:
+                                torch.distributed.broadcast(param.data, 0)
+                        if mask_pruned:
+                            # BertAdam keeps the pruned entries at zero, so pruning again is only
+                            # needed when wr_now moves on.
+                            for param in pruned:
+                                if embedding_optimizer is not None and param is word_table:
+                                    embedding_optimizer.set_mask(param, param.data != 0)
+                                else:
+                                    optimizer.set_mask(param, param.data != 0)
+                            pruned_wr = wr_now
+                train_time += time.time() - step_start
+                train_examples += input_ids.size(0)
+                timer.step(epoch=epoch_i, step=global_step)
+                if profiler is not None:
+                    profiler.step()
+                now_step += 1
+                # if now_step == all_steps:
+                # break
+                if global_step%2000==0 and is_main_process():
+                    evaluator.submit(raw_model, global_step, prune_type, prune_rate)
+                for result, state_dict in evaluator.poll():
+                    best_acc = max(best_acc, report_eval(result, state_dict))
+                if args.save_state_steps and global_step % args.save_state_steps == 0 and \
+                        (step + 1) % args.gradient_accumulation_steps == 0 and is_main_process():
+                    save_training_state(epoch_i, step + 1, tr_losses)
+            out = dict(tr_losses.means(), epoch=epoch_i, time=time.time() - start)
+            logger.info("Train Loss: %s", out)
+            timer.dump(epoch=epoch_i, step=global_step, epoch_end=True)
+
+        if profiler is not None:
+            profiler.stop()
+        for result, state_dict in evaluator.close():
+            best_acc = max(best_acc, report_eval(result, state_dict))
+
+        checkpoint_writer.close()
+        if checkpoint_writer.latencies:
+            logger.info("checkpoint writes: %d, mean %.2fs, max %.2fs", len(checkpoint_writer.latencies),
+                        np.mean(checkpoint_writer.latencies), np.max(checkpoint_writer.latencies))
+        report_throughput(args, device, train_examples, train_time)
         return best_acc
 
 
-def main():
+def build_parser():
     parser = argparse.ArgumentParser()
 
     ## Required parameters
@@ -1465,53 +1715,193 @@ def main():
                         default=256,
                         type=int,
                         help="?/768")
-    args = parser.parse_args()
+    parser.add_argument("--svd_method",
+                        default="exact",
+                        choices=["randomized", "exact"],
+                        help="Truncated SVD used to initialize the factors when --svd_weight_dir is not given.")
+    parser.add_argument("--svd_workers",
+                        default=None,
+                        type=int,
+                        help="Threads factorizing weight matrices in parallel (default: one per CPU).")
+    parser.add_argument("--global_grad_norm",
+                        action='store_true',
+                        help="Clip gradients by their global norm instead of per parameter.")
+    parser.add_argument("--compact_optimizer_state",
+                        action='store_true',
+                        help="Store the Adam moments of pruned weights only for their surviving entries.")
+    parser.add_argument("--sparse_embeddings",
+                        action='store_true',
+                        help="Train the word embeddings with sparse gradients and SparseAdam (not with --fp16).")
+    parser.add_argument("--embd_rank",
+                        default=None,
+                        type=int,
+                        help="Factorize the word embeddings to this rank with a truncated SVD of the pretrained table. "
+                             "Pruning then cuts the rank towards --p_embd of it instead of zeroing entries.")
+    parser.add_argument("--optimizer_state_bits",
+                        default=32,
+                        type=int,
+                        choices=[32, 8],
+                        help="8 stores the BertAdam moments of large parameters block-wise quantized.")
+    parser.add_argument("--bf16",
+                        action='store_true',
+                        help="Run the student and teacher forwards under bfloat16 autocast (CPU or GPU), "
+                             "keeping fp32 weights and optimizer state.")
+    parser.add_argument("--bf16_parity_tol",
+                        default=0.05,
+                        type=float,
+                        help="Warn when a bf16 loss of the first batch differs from fp32 by more than this.")
+    parser.add_argument("--checkpoint_every",
+                        default=0,
+                        type=int,
+                        help="Recompute every k-th encoder layer of the student in the backward pass "
+                             "(activation checkpointing) to fit larger batches or sequences; 0 disables it.")
+    parser.add_argument("--cpu_procs",
+                        default=0,
+                        type=int,
+                        help="Spawn this many CPU training processes synchronized with gloo and "
+                             "DistributedDataParallel (multi-node: start the script with torchrun and --no_cuda).")
+    parser.add_argument("--threads_per_proc",
+                        default=0,
+                        type=int,
+                        help="Intra-op threads of each distributed CPU process (0: the cores split evenly).")
+    parser.add_argument("--scaling_baseline",
+                        default=None,
+                        type=str,
+                        help="throughput.json of a single-process run, to report the scaling efficiency.")
+    parser.add_argument("--loss_log_interval",
+                        default=100,
+                        type=int,
+                        help="Read the running training losses back from the device and log them every N steps "
+                             "(0: only at the end of each epoch).")
+    parser.add_argument("--timing_interval",
+                        default=0,
+                        type=int,
+                        help="Time the phases of every training step and append their percentiles to "
+                             "output_dir/step_times.jsonl every N steps and at the end of each epoch (0: off).")
+    parser.add_argument("--timing_sync",
+                        action='store_true',
+                        help="Synchronize the GPU around every timed phase (exact per-phase times, slower steps).")
+    parser.add_argument("--profile_start",
+                        default=10,
+                        type=int,
+                        help="First training step recorded by --profile_steps.")
+    parser.add_argument("--profile_steps",
+                        default=0,
+                        type=int,
+                        help="Record this many training steps with torch.profiler as a Chrome trace in output_dir.")
+    parser.add_argument("--async_eval",
+                        action='store_true',
+                        help="Evaluate (and predict the test sets) on weight snapshots in a separate process "
+                             "while training continues.")
+    parser.add_argument("--eval_threads",
+                        default=max(1, (os.cpu_count() or 4) // 4),
+                        type=int,
+                        help="Intra-op threads of the --async_eval process.")
+    parser.add_argument("--save_state_steps",
+                        default=0,
+                        type=int,
+                        help="Write the full training state (weights, optimizer, pruning schedule, RNG and data "
+                             "position) to output_dir/" + TRAINING_STATE_NAME + " every N optimization steps.")
+    parser.add_argument("--resume",
+                        action='store_true',
+                        help="Continue from output_dir/" + TRAINING_STATE_NAME + " when it exists.")
+    parser.add_argument("--keep_checkpoints",
+                        default=0,
+                        type=int,
+                        help="Also keep the last N improved checkpoints as checkpoint-<step>.bin "
+                             "(0: only the best one, as pytorch_model.bin).")
+    return parser
+
+
+def finalize_args(args):
+    """Derives the pruning targets from the parsed arguments and checks their combinations."""
     args.embd_r=1.-args.p_embd
     args.target_r=args.p_encoder
+    if args.bf16 and args.fp16:
+        raise ValueError("--bf16 and --fp16 are exclusive.")
+    if args.sparse_embeddings and args.fp16:
+        raise ValueError("--sparse_embeddings is not supported with --fp16.")
+    return args
 
-    def balance(prune_rate, target):
-        rate_all = 0
-        whole_param = [768 * args.svd_dim*2 * 3, 768 * args.svd_dim*2, args.svd_dim * (3072+768), args.svd_dim * (3072+768)]
-        rate_one = 0
-        for i in range(48):
-            rate_all += prune_rate[i] * whole_param[i % 4]
-            rate_one += whole_param[i % 4]
-        rate_all /= rate_one
-        for i in range(48):
-            prune_rate[i] = prune_rate[i] / rate_all * target
-        return prune_rate
-
-    to_test_sr = [args.svd_ratio]  # [16,18,20,22,24,26,28,30] # grid search of sr(svd ratio), given sr+wr=split
-    result = {}
 
-    global split, intv, psteps
+def main():
+    args = finalize_args(build_parser().parse_args())
+
+    if args.cpu_procs > 1 and args.local_rank == -1:
+        torch.multiprocessing.spawn(cpu_worker, args=(args,), nprocs=args.cpu_procs)
+        return
+    if args.local_rank == -1 and 'LOCAL_RANK' in os.environ:  # started by torchrun
+        args.local_rank = int(os.environ['LOCAL_RANK'])
+    run(args)
+
+
+def cpu_worker(local_rank, args):
+    """Entry point of one of the --cpu_procs processes spawned by `main`, training on CPU with gloo."""
+    os.environ.setdefault('MASTER_ADDR', '127.0.0.1')
+    os.environ.setdefault('MASTER_PORT', '29500')
+    os.environ['RANK'] = str(local_rank)
+    os.environ['WORLD_SIZE'] = os.environ['LOCAL_WORLD_SIZE'] = str(args.cpu_procs)
+    args.local_rank = local_rank
+    args.no_cuda = True
+    run(args)
+
+
+def balance(args, prune_rate, target):
+    rate_all = 0
+    whole_param = [768 * args.svd_dim*2 * 3, 768 * args.svd_dim*2, args.svd_dim * (3072+768), args.svd_dim * (3072+768)]
+    rate_one = 0
+    for i in range(48):
+        rate_all += prune_rate[i] * whole_param[i % 4]
+        rate_one += whole_param[i % 4]
+    rate_all /= rate_one
+    for i in range(48):
+        prune_rate[i] = prune_rate[i] / rate_all * target
+    return prune_rate
+
+
+def configure_pruning(args):
+    """Sets the pruning schedule (module globals) for `args` and returns the projection types and
+    target pruning rates of the 48 projections."""
+    global split, intv, psteps, sr_target, wr_target, wr_now
     task_step = {'mnli': 10000, 'sst-2': 2100, 'qnli': 3000, 'qqp': 10000, 'mrpc': 100, 'cola': 200}
-    psteps = task_step[args.task_name]
+    # The pruning schedule is in steps of one process; with N ranks an epoch has N times fewer.
+    psteps = task_step[args.task_name] // (int(os.environ.get('WORLD_SIZE', 1)) if args.local_rank != -1 else 1)
     split = args.split
     intv = psteps // (split + 1)
 
+    sr_target, wr_target = 0,64#tst, split - tst
+    wr_now = 1.  # `eval_after_train` moves it to wr_target, e.g. in a previous run of the process
+    if args.layerwise is None:
+        prune_type = ['svd'] * 48  # default: combine svd and weight pruning
+        prune_rate = [0.1]*48#[0.4,0.43,0.4,0.43] * 12
+        prune_rate = balance(args, prune_rate, args.target_r)
+    else:  # to use a given layerwise assignment of pruning ratio
+        filename = args.layerwise
+        sp = json.load(open(filename))
+        print("use layerwise ratio from: " + filename)
+        prune_rate = []
+        prune_type = ['svd'] * 48
+        for i in range(48):
+            prune_rate.append((sp['pr' + str(i)] - 0.3) / 0.4 * args.lw + 1.)
+        prune_rate = balance(args, prune_rate, args.target_r)
+    return prune_type, prune_rate
+
+
+def run(args):
+    """Fine-tunes and prunes the student, as configured by the parsed `args`."""
+    to_test_sr = [args.svd_ratio]  # [16,18,20,22,24,26,28,30] # grid search of sr(svd ratio), given sr+wr=split
+    result = {}
+
     for tst in to_test_sr:
-        global sr_target, wr_target
-        sr_target, wr_target = 0,64#tst, split - tst
+        prune_type, prune_rate = configure_pruning(args)
         if args.layerwise is None:
-            prune_type = ['svd'] * 48  # default: combine svd and weight pruning
-            prune_rate = [0.1]*48#[0.4,0.43,0.4,0.43] * 12
-            result['rate']=prune_rate
-            prune_rate = balance(prune_rate, args.target_r)
-        else:  # to use a given layerwise assignment of pruning ratio
-            filename = args.layerwise
-            sp = json.load(open(filename))
-            print("use layerwise ratio from: " + filename)
-            prune_rate = []
-            prune_type = ['svd'] * 48
-            for i in range(48):
-                prune_rate.append((sp['pr' + str(i)] - 0.3) / 0.4 * args.lw + 1.)
-            prune_rate = balance(prune_rate, args.target_r)
+            result['rate'] = prune_rate
         print(prune_rate, prune_type)
         func = prune_function(args)
         result[str(sr_target)] = func.eval_after_train(prune_type, prune_rate)
         print(result)
-        json.dump(result, open('result.json', 'a'))
+        if is_main_process():
+            json.dump(result, open('result.json', 'a'))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,190 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Predicts the labels of a TSV file (in the format of the test set of --task_name) with a
+compressed student saved by run_finetune.py.
+
+The input is read and featurized --chunk_size lines at a time; every chunk runs in
+length-sorted batches trimmed to their longest sequence, and its predictions are appended to
+--output_file in the order of the input before the next chunk is read.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import csv
+import json
+import logging
+import os
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import run_finetune  # noqa: E402
+from pytorch_pretrained_bert.modeling_ori_dis import WEIGHTS_NAME, CONFIG_NAME  # noqa: E402
+from pytorch_pretrained_bert.tokenization import BertTokenizer  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+PROCESSORS = {
+    "cola": run_finetune.ColaProcessor,
+    "mnli": run_finetune.MnliProcessor,
+    "mnli-mm": run_finetune.MnliMismatchedProcessor,
+    "mrpc": run_finetune.MrpcProcessor,
+    "sst-2": run_finetune.Sst2Processor,
+    "sts-b": run_finetune.StsbProcessor,
+    "qqp": run_finetune.QqpProcessor,
+    "qnli": run_finetune.QnliProcessor,
+    "rte": run_finetune.RteProcessor,
+    "wnli": run_finetune.WnliProcessor,
+}
+
+
+def read_chunks(input_file, processor, task_name, chunk_size):
+    """Yields the `InputExample`s of a test-format TSV file, `chunk_size` lines at a time."""
+    with open(input_file, "r", encoding='utf-8') as f:
+        reader = csv.reader(f, delimiter="\t", quotechar=None)
+        header = next(reader, None)
+        if header is None:
+            return
+        rows = []
+        for row in reader:
+            rows.append(row)
+            if len(rows) == chunk_size:
+                yield examples_of_rows(processor, task_name, header, rows)
+                rows = []
+        if rows:
+            yield examples_of_rows(processor, task_name, header, rows)
+
+
+def examples_of_rows(processor, task_name, header, rows):
+    # The processors expect the header line first.
+    examples = processor._create_examples([header] + rows, "test")
+    if task_name == 'cola':
+        examples = examples[1:]  # the CoLA processor keeps the header line
+    # Test files have no label column (some processors take a sentence or the index for one):
+    # the examples get a placeholder, as the requests of run_server.py.
+    label_list = processor.get_labels()
+    for example in examples:
+        example.label = 0. if label_list[0] is None else label_list[0]
+    return examples
+
+
+def load_student(model_dir, num_labels, device):
+    """The student of `model_dir` (its config and weights, as written by run_finetune.py)."""
+    config = run_finetune.modeling_fast.BertConfig(os.path.join(model_dir, CONFIG_NAME))
+    model = run_finetune.load_classifier(run_finetune.modeling_fast, config,
+                                         os.path.join(model_dir, WEIGHTS_NAME), num_labels)
+    model.to(device)
+    model.eval()
+    return model
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_dir",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="Directory of the student: bert_config.json and pytorch_model.bin.")
+    parser.add_argument("--bert_model", default=None, type=str, required=True,
+                        help="Bert pre-trained model of the vocabulary, as in run_finetune.py.")
+    parser.add_argument("--task_name",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The name of the task, which gives the labels and the columns of the input.")
+    parser.add_argument("--input_file",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="TSV file in the format of the test set of the task.")
+    parser.add_argument("--output_file",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The 'index\\tprediction' TSV file written.")
+    parser.add_argument("--max_seq_length",
+                        default=128,
+                        type=int,
+                        help="The maximum total input sequence length after WordPiece tokenization.")
+    parser.add_argument("--do_lower_case",
+                        action='store_true',
+                        help="Set this flag if you are using an uncased model.")
+    parser.add_argument("--eval_batch_size",
+                        default=64,
+                        type=int,
+                        help="Batch size for prediction.")
+    parser.add_argument("--chunk_size",
+                        default=4096,
+                        type=int,
+                        help="Number of input lines featurized, sorted by length and written at a time.")
+    parser.add_argument("--p_type",
+                        default='svd',
+                        type=str,
+                        help="Projection backend of every encoder projection (see `set_projections`).")
+    parser.add_argument("--p_rate",
+                        default=1.,
+                        type=float,
+                        help="Fraction of the rank ('svd') or of the weights ('sparse') kept.")
+    parser.add_argument("--bf16",
+                        action='store_true',
+                        help="Run the student under bfloat16 autocast.")
+    parser.add_argument("--threads",
+                        default=0,
+                        type=int,
+                        help="Number of CPU threads (0: the torch default).")
+    parser.add_argument("--no_cuda",
+                        action='store_true',
+                        help="Whether not to use CUDA when available")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    task_name = args.task_name.lower()
+    if task_name not in PROCESSORS:
+        raise ValueError("Task not found: %s" % (task_name))
+    args.task_name = task_name
+    processor = PROCESSORS[task_name]()
+    label_list = processor.get_labels()
+    output_mode = "regression" if label_list[0] is None else "classification"
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+    model = load_student(args.model_dir, len(label_list), device)
+
+    num_examples, predict_time = 0, 0.
+    start = time.time()
+    with open(args.output_file, 'w') as f:
+        f.write('index\tprediction\n')
+        for examples in read_chunks(args.input_file, processor, task_name, args.chunk_size):
+            features = run_finetune.convert_examples_to_features(
+                examples, label_list, args.max_seq_length, tokenizer, output_mode)
+            data = run_finetune.features_to_dataset(features)
+            predict_start = time.time()
+            ans = run_finetune.predict(model, data, device, args, args.p_type, args.p_rate)
+            predict_time += time.time() - predict_start
+            f.write(run_finetune.format_predictions(label_list, ans, start=num_examples))
+            f.flush()
+            num_examples += len(examples)
+    total_time = time.time() - start
+    report = {'examples': num_examples,
+              'seconds': total_time,
+              'examples_per_second': num_examples / max(total_time, 1e-9),
+              'model_seconds': predict_time,
+              'model_examples_per_second': num_examples / max(predict_time, 1e-9)}
+    logger.info("Predictions written to %s: %s", args.output_file, json.dumps(report))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,376 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Local HTTP inference server of a compressed student saved by run_finetune.py.
+
+    POST /predict  {"text_a": "...", "text_b": "..."} or {"instances": [{"text_a": ...}, ...]}
+                   -> {"predictions": [{"label": "1", "probabilities": [...]}, ...]}
+                      ({"score": ...} for regression tasks)
+    GET /metrics   latency percentiles, throughput, batch sizes and queue depth
+    GET /health
+
+Requests are tokenized in their own handler threads; a single batching thread runs the queued
+examples in micro-batches of at most --max_batch_size, waiting at most --max_wait_ms after the
+first one for the batch to fill up.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import run_finetune  # noqa: E402
+import run_predict  # noqa: E402
+from pytorch_pretrained_bert.tokenization import BertTokenizer  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+
+class DynamicBatcher(object):
+    """Runs the examples submitted by concurrent threads in micro-batches on one model.
+
+    `submit` queues the (unpadded) input and segment ids of one example and returns a `Future`
+    of its prediction. The batching thread takes the first queued example, then collects the
+    next ones until the batch holds `max_batch_size` examples or `max_wait_ms` have passed since
+    the first one was queued, and runs them in one forward padded to the longest. `close` runs
+    the examples already queued; the futures of the ones submitted after it fail.
+
+    Params:
+        model: the `BertForSequenceClassification` student, on `device`.
+        device: the device of the model.
+        label_list: the labels of the task ([None] for regression).
+        max_batch_size: maximum number of examples in a forward. Default: 32
+        max_wait_ms: maximum time an example waits for its batch to fill up. Default: 5
+        p_type, p_rate: projection backends and rates of the student, see `set_projections`.
+        bf16: run the forward under bfloat16 autocast. Default: False
+        window: number of the last requests and batches the metrics are computed on. Default: 1000
+    """
+    def __init__(self, model, device, label_list, max_batch_size=32, max_wait_ms=5., p_type='svd', p_rate=1.,
+                 bf16=False, window=1000):
+        self.model = model
+        self.device = device
+        self.label_list = label_list
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self.p_type = p_type
+        self.p_rate = p_rate
+        self.bf16 = bf16
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.batch_sizes = deque(maxlen=window)
+        self.forward_times = deque(maxlen=window)
+        self.num_requests = 0
+        self.num_batches = 0
+        self.start_time = time.time()
+        self.closed = False
+        self.closing = False
+        self.thread = threading.Thread(target=self._run, name='batcher')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, input_ids, segment_ids):
+        future = Future()
+        with self.lock:
+            if self.closing:
+                future.set_exception(RuntimeError("The batcher is closed"))
+            else:
+                self.queue.put((time.perf_counter(), input_ids, segment_ids, future))
+        return future
+
+    def close(self):
+        """Stops the batching thread once the queued examples are run."""
+        with self.lock:
+            # Under the lock, nothing is queued after the sentinel.
+            self.closing = True
+            self.queue.put(None)
+        self.thread.join()
+
+    def _collect(self):
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first[0] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                item = self.queue.get(timeout=remaining) if remaining > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.closed = True
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        self.model.eval()
+        while not self.closed:
+            batch = self._collect()
+            if batch is None:
+                break
+            self._run_batch(batch)
+        # `close` queues nothing after the sentinel; should anything be left, it is run all the same.
+        rest = []
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                rest.append(item)
+        for i in range(0, len(rest), self.max_batch_size):
+            self._run_batch(rest[i:i + self.max_batch_size])
+
+    def _run_batch(self, batch):
+        try:
+            predictions, forward_time = self._forward(batch)
+        except Exception as e:
+            for _, _, _, future in batch:
+                future.set_exception(e)
+            return
+        done = time.perf_counter()
+        with self.lock:
+            self.latencies.extend(done - queued for queued, _, _, _ in batch)
+            self.batch_sizes.append(len(batch))
+            self.forward_times.append(forward_time)
+            self.num_requests += len(batch)
+            self.num_batches += 1
+        for (_, _, _, future), prediction in zip(batch, predictions):
+            future.set_result(prediction)
+
+    def _forward(self, batch):
+        length = max(len(input_ids) for _, input_ids, _, _ in batch)
+        input_ids = torch.zeros(len(batch), length, dtype=torch.long)
+        segment_ids = torch.zeros(len(batch), length, dtype=torch.long)
+        input_mask = torch.zeros(len(batch), length, dtype=torch.long)
+        for i, (_, ids, segments, _) in enumerate(batch):
+            input_ids[i, :len(ids)] = torch.tensor(ids, dtype=torch.long)
+            segment_ids[i, :len(ids)] = torch.tensor(segments, dtype=torch.long)
+            input_mask[i, :len(ids)] = 1
+        start = time.perf_counter()
+        with torch.no_grad(), torch.autocast(device_type=self.device.type, dtype=torch.bfloat16, enabled=self.bf16):
+            logits, _, _ = self.model(input_ids.to(self.device), segment_ids.to(self.device),
+                                      input_mask.to(self.device), p_type=self.p_type, p_rate=self.p_rate)
+        logits = logits.float().cpu()
+        forward_time = time.perf_counter() - start
+        if self.label_list[0] is None:  # regression
+            return [{'score': score} for score in logits.view(-1).tolist()], forward_time
+        probabilities = logits.softmax(dim=-1)
+        return [{'label': self.label_list[label], 'probabilities': probs}
+                for label, probs in zip(logits.argmax(dim=-1).tolist(), probabilities.tolist())], forward_time
+
+    def metrics(self):
+        """Latency percentiles (from the queueing of an example to its prediction), batch sizes and
+        forward times over the last `window` requests and batches, throughput and queue depth."""
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000.
+            batch_sizes = np.array(self.batch_sizes)
+            forward_times = np.array(self.forward_times) * 1000.
+            num_requests, num_batches = self.num_requests, self.num_batches
+        uptime = time.time() - self.start_time
+        metrics = {'requests': num_requests,
+                   'batches': num_batches,
+                   'queue_depth': self.queue.qsize(),
+                   'uptime_s': uptime,
+                   'requests_per_second': num_requests / max(uptime, 1e-9)}
+        if len(latencies):
+            metrics['latency_ms'] = {'mean': float(latencies.mean()),
+                                     'p50': float(np.percentile(latencies, 50)),
+                                     'p90': float(np.percentile(latencies, 90)),
+                                     'p99': float(np.percentile(latencies, 99))}
+            metrics['batch_size'] = {'mean': float(batch_sizes.mean()), 'max': int(batch_sizes.max())}
+            metrics['forward_ms'] = {'mean': float(forward_times.mean()),
+                                     'p99': float(np.percentile(forward_times, 99))}
+        return metrics
+
+
+class Featurizer(object):
+    """Tokenizes a request instance into the (unpadded) input and segment ids of the student."""
+    def __init__(self, tokenizer, label_list, max_seq_length):
+        self.tokenizer = tokenizer
+        self.label_list = label_list
+        self.max_seq_length = max_seq_length
+        self.output_mode = "regression" if label_list[0] is None else "classification"
+
+    def __call__(self, instance):
+        if not isinstance(instance, dict) or not isinstance(instance.get('text_a'), str):
+            raise ValueError("Every instance needs a 'text_a' string")
+        example = run_finetune.InputExample(guid='request', text_a=instance['text_a'], text_b=instance.get('text_b'),
+                                            label=0. if self.output_mode == "regression" else self.label_list[0])
+        feature, = run_finetune.convert_examples_to_features(
+            [example], self.label_list, self.max_seq_length, self.tokenizer, self.output_mode)
+        length = sum(feature.input_mask)
+        return feature.input_ids[:length], feature.segment_ids[:length]
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    server_version = 'EAdaBERT'
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self._reply(200, self.server.batcher.metrics())
+        elif self.path == '/health':
+            self._reply(200, {'status': 'ok'})
+        else:
+            self._reply(404, {'error': 'Not found: {}'.format(self.path)})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self._reply(404, {'error': 'Not found: {}'.format(self.path)})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            instances = request['instances'] if isinstance(request, dict) and 'instances' in request else [request]
+            features = [self.server.featurize(instance) for instance in instances]
+        except (ValueError, KeyError, TypeError) as e:
+            self._reply(400, {'error': str(e)})
+            return
+        futures = [self.server.batcher.submit(input_ids, segment_ids) for input_ids, segment_ids in features]
+        try:
+            predictions = [future.result(timeout=self.server.request_timeout) for future in futures]
+        except Exception as e:
+            logger.error("prediction failed: %r", e)
+            self._reply(500, {'error': repr(e)})
+            return
+        self._reply(200, {'predictions': predictions})
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+
+class PredictionServer(ThreadingHTTPServer):
+    """A `ThreadingHTTPServer` whose listen backlog holds the connections of many concurrent
+    clients (with the default of 5, the kernel resets the ones beyond it)."""
+    request_queue_size = 128
+    daemon_threads = True
+
+
+def build_server(args):
+    """The `PredictionServer` of `args`, bound but not yet serving, with its `batcher`."""
+    device = torch.device("cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    task_name = args.task_name.lower()
+    if task_name not in run_predict.PROCESSORS:
+        raise ValueError("Task not found: %s" % (task_name))
+    label_list = run_predict.PROCESSORS[task_name]().get_labels()
+    tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+    model = run_predict.load_student(args.model_dir, len(label_list), device)
+
+    server = PredictionServer((args.host, args.port), PredictionHandler)
+    server.featurize = Featurizer(tokenizer, label_list, args.max_seq_length)
+    server.batcher = DynamicBatcher(model, device, label_list, max_batch_size=args.max_batch_size,
+                                    max_wait_ms=args.max_wait_ms, p_type=args.p_type, p_rate=args.p_rate,
+                                    bf16=args.bf16)
+    server.request_timeout = args.request_timeout
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_dir",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="Directory of the student: bert_config.json and pytorch_model.bin.")
+    parser.add_argument("--bert_model", default=None, type=str, required=True,
+                        help="Bert pre-trained model of the vocabulary, as in run_finetune.py.")
+    parser.add_argument("--task_name",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The name of the task, which gives the labels.")
+    parser.add_argument("--max_seq_length",
+                        default=128,
+                        type=int,
+                        help="The maximum total input sequence length after WordPiece tokenization.")
+    parser.add_argument("--do_lower_case",
+                        action='store_true',
+                        help="Set this flag if you are using an uncased model.")
+    parser.add_argument("--host",
+                        default='127.0.0.1',
+                        type=str,
+                        help="Address the server listens on.")
+    parser.add_argument("--port",
+                        default=8080,
+                        type=int,
+                        help="Port the server listens on (0: any free port).")
+    parser.add_argument("--max_batch_size",
+                        default=32,
+                        type=int,
+                        help="Maximum number of examples run in one forward.")
+    parser.add_argument("--max_wait_ms",
+                        default=5.,
+                        type=float,
+                        help="Maximum time an example waits for its batch to fill up.")
+    parser.add_argument("--request_timeout",
+                        default=30.,
+                        type=float,
+                        help="Seconds a request waits for its predictions before failing.")
+    parser.add_argument("--p_type",
+                        default='svd',
+                        type=str,
+                        help="Projection backend of every encoder projection (see `set_projections`).")
+    parser.add_argument("--p_rate",
+                        default=1.,
+                        type=float,
+                        help="Fraction of the rank ('svd') or of the weights ('sparse') kept.")
+    parser.add_argument("--bf16",
+                        action='store_true',
+                        help="Run the student under bfloat16 autocast.")
+    parser.add_argument("--threads",
+                        default=0,
+                        type=int,
+                        help="Number of CPU threads of the forward (0: the torch default).")
+    parser.add_argument("--no_cuda",
+                        action='store_true',
+                        help="Whether not to use CUDA when available")
+    args = parser.parse_args()
+
+    server = build_server(args)
+    logger.info("Serving on http://%s:%d (max batch size %d, max wait %.1f ms)",
+                server.server_address[0], server.server_address[1], args.max_batch_size, args.max_wait_ms)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.batcher.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,159 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs a grid of compression configurations of run_finetune.py in parallel worker processes.
+
+The task is featurized and the teacher loaded once; the workers share them through shared
+memory. The sweep file is JSON, either a dict mapping run_finetune.py arguments to lists of
+values (every combination is run) or a list of {argument: value} configurations, e.g.
+    {"p_encoder": [0.2, 0.231, 0.3], "p_embd": [0.2, 0.4]}
+All the other arguments are the ones of run_finetune.py. Every configuration writes to its own
+subdirectory of output_dir, and the results are gathered in output_dir/sweep_results.tsv.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import copy
+import csv
+import itertools
+import json
+import logging
+import os
+import re
+import sys
+import time
+import traceback
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import run_finetune  # noqa: E402
+
+logger = logging.getLogger(__name__)
+
+_worker = {}
+
+# Arguments of the featurized data and the teacher, which the workers share.
+SHARED_ARGS = ['task_name', 'data_dir', 'max_seq_length', 'bert_model', 'do_lower_case', 'distill_dir']
+
+
+def load_sweep(path):
+    """The list of configurations of a sweep file."""
+    with open(path) as f:
+        sweep = json.load(f)
+    if isinstance(sweep, dict):
+        names = sorted(sweep.keys())
+        return [dict(zip(names, values)) for values in itertools.product(*[sweep[name] for name in names])]
+    return sweep
+
+
+def config_name(config):
+    name = '-'.join('{}={}'.format(key, os.path.basename(str(value))) for key, value in sorted(config.items()))
+    return re.sub(r'[^A-Za-z0-9_.=-]', '_', name) or 'default'
+
+
+def _init_worker(args, shared, num_threads):
+    torch.set_num_threads(num_threads)
+    _worker['args'] = args
+    _worker['shared'] = shared
+
+
+def _run_config(job):
+    """Trains one configuration of the sweep with the shared data and teacher."""
+    index, config = job
+    args = copy.deepcopy(_worker['args'])
+    for key, value in config.items():
+        setattr(args, key, value)
+    args.output_dir = os.path.join(args.output_dir, config_name(config))
+    row = dict(config, index=index, name=config_name(config))
+    start = time.time()
+    try:
+        run_finetune.finalize_args(args)
+        prune_type, prune_rate = run_finetune.configure_pruning(args)
+        func = run_finetune.prune_function(args, shared=_worker['shared'])
+        row['best_acc'] = float(func.eval_after_train(prune_type, prune_rate))
+    except Exception:
+        error = traceback.format_exc()
+        logger.error("configuration %s failed:\n%s", row['name'], error)
+        row['error'] = error.strip().splitlines()[-1]
+    row['seconds'] = time.time() - start
+    return row
+
+
+def write_results(rows, keys, output_dir):
+    """Writes the sweep results as sweep_results.tsv and sweep_results.json in `output_dir`."""
+    columns = ['name'] + keys + ['best_acc', 'seconds', 'error']
+    with open(os.path.join(output_dir, 'sweep_results.tsv'), 'w') as f:
+        writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+        writer.writerow(columns)
+        for row in rows:
+            writer.writerow([row.get(column, '') for column in columns])
+    with open(os.path.join(output_dir, 'sweep_results.json'), 'w') as f:
+        json.dump(rows, f, indent=2)
+
+
+def main():
+    parser = run_finetune.build_parser()
+    parser.add_argument("--sweep",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="JSON file of the configurations to run (see the module docstring).")
+    parser.add_argument("--sweep_workers",
+                        default=0,
+                        type=int,
+                        help="Number of configurations trained at the same time "
+                             "(0: the CPU cores divided by --threads_per_proc, 4 threads each by default).")
+    args = parser.parse_args()
+    if args.local_rank != -1 or args.cpu_procs > 1:
+        raise ValueError("A sweep runs every configuration in a single process.")
+    # The workers are daemon processes, which cannot start the evaluation process.
+    args.async_eval = False
+    # Every configuration writes its predictions to its own output_dir only.
+    args.predictions_in_cwd = False
+
+    configs = load_sweep(args.sweep)
+    keys = sorted(set(key for config in configs for key in config))
+    unknown = [key for key in keys if not hasattr(args, key)]
+    if unknown:
+        raise ValueError("Unknown arguments in the sweep: {}".format(', '.join(unknown)))
+    shared_keys = [key for key in keys if key in SHARED_ARGS]
+    if shared_keys:
+        raise ValueError("The data and the teacher are shared by the whole sweep, these arguments cannot be "
+                         "swept: {}".format(', '.join(shared_keys)))
+    num_cores = os.cpu_count() or 1
+    num_workers = args.sweep_workers or max(1, num_cores // (args.threads_per_proc or 4))
+    num_workers = max(1, min(num_workers, len(configs)))
+    num_threads = args.threads_per_proc or max(1, num_cores // num_workers)
+    logger.info("%d configurations on %d workers with %d threads each", len(configs), num_workers, num_threads)
+
+    # Featurizes the task and loads the teacher once, in shared memory.
+    base = run_finetune.prune_function(run_finetune.finalize_args(copy.deepcopy(args)))
+    shared = base.shared_state()
+    del base.model  # only the data and the teacher are kept
+
+    rows = []
+    context = torch.multiprocessing.get_context('spawn')
+    pool = context.Pool(num_workers, initializer=_init_worker, initargs=(args, shared, num_threads))
+    try:
+        for row in pool.imap_unordered(_run_config, list(enumerate(configs))):
+            rows.append(row)
+            logger.info("%d/%d done: %s", len(rows), len(configs),
+                        {key: row.get(key) for key in ['name', 'best_acc', 'seconds']})
+            write_results(sorted(rows, key=lambda r: r['index']), keys, args.output_dir)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == "__main__":
+    main()
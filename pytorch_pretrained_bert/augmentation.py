@@ -0,0 +1,271 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Data augmentation utilities (GloVe neighbours and masked-LM replacements)."""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import os
+import random
+from io import open
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+GLOVE_MATRIX_SUFFIX = '.npy'
+GLOVE_VOCAB_SUFFIX = '.vocab.txt'
+
+
+def _count_lines(path, chunk_size=1 << 20):
+    """Counts newlines in a file without decoding it."""
+    n = 0
+    last = b'\n'
+    with open(path, 'rb') as reader:
+        while True:
+            chunk = reader.read(chunk_size)
+            if not chunk:
+                break
+            n += chunk.count(b'\n')
+            last = chunk[-1:]
+    if last != b'\n':
+        n += 1
+    return n
+
+
+def _atomic_save_npy(path, array):
+    tmp_path = path + '.tmp.npy'
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
+
+
+def load_glove_embeddings(glove_file):
+    """Loads a GloVe text file as a float32 matrix and its word list.
+
+    The text file is parsed once into a preallocated array which is cached next to
+    it as `<glove_file>.npy` (plus `<glove_file>.vocab.txt`); later calls memory-map
+    the cached matrix instead of parsing the text again.
+    """
+    matrix_file = glove_file + GLOVE_MATRIX_SUFFIX
+    vocab_file = glove_file + GLOVE_VOCAB_SUFFIX
+    if os.path.exists(matrix_file) and os.path.exists(vocab_file):
+        logger.info("loading GloVe embeddings from cache at {}".format(matrix_file))
+        embeddings = np.load(matrix_file, mmap_mode='r')
+        with open(vocab_file, 'r', encoding='utf-8') as reader:
+            words = [line.rstrip('\n') for line in reader]
+        return embeddings, words
+
+    n = _count_lines(glove_file)
+    with open(glove_file, 'r', encoding='utf-8') as reader:
+        dim = len(reader.readline().rstrip().split(' ')) - 1
+    logger.info("parsing GloVe file {} ({} words, dim {})".format(glove_file, n, dim))
+
+    embeddings = np.empty((n, dim), dtype=np.float32)
+    words = []
+    with open(glove_file, 'r', encoding='utf-8') as reader:
+        for line in tqdm(reader, total=n, desc="GloVe"):
+            split_line = line.rstrip().split(' ')
+            if len(split_line) != dim + 1:
+                continue
+            embeddings[len(words)] = np.asarray(split_line[1:], dtype=np.float32)
+            words.append(split_line[0])
+    embeddings = embeddings[:len(words)]
+
+    _atomic_save_npy(matrix_file, embeddings)
+    tmp_vocab_file = vocab_file + '.tmp'
+    with open(tmp_vocab_file, 'w', encoding='utf-8') as writer:
+        for word in words:
+            writer.write(word + '\n')
+    os.replace(tmp_vocab_file, vocab_file)
+    return embeddings, words
+
+
+def build_neighbour_table(embeddings, num_candidates, batch_size=1024, device=None):
+    """Computes the `num_candidates` nearest rows (squared L2, self included) of every row.
+
+    Distances are evaluated block by block as ||b||^2 - 2 a.b with a matrix product,
+    and only a `topk` of each block is kept. Returns an int32 array [n, num_candidates]
+    ordered from nearest to farthest.
+    """
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    n = embeddings.shape[0]
+    k = min(num_candidates, n)
+    table = np.empty((n, k), dtype=np.int32)
+    with torch.no_grad():
+        matrix = torch.from_numpy(np.ascontiguousarray(embeddings, dtype=np.float32)).to(device)
+        sq_norms = (matrix * matrix).sum(-1)
+        for start in tqdm(range(0, n, batch_size), desc="GloVe neighbours"):
+            block = matrix[start:start + batch_size]
+            # ||a||^2 is constant per query row, so it does not change the ranking.
+            dist = sq_norms.unsqueeze(0) - 2. * torch.matmul(block, matrix.t())
+            _, indices = torch.topk(dist, k, dim=-1, largest=False, sorted=True)
+            table[start:start + block.size(0)] = indices.cpu().numpy()
+    return table
+
+
+class GloveNeighbours(object):
+    """Nearest-neighbour lookup over GloVe vectors backed by a precomputed top-k table."""
+
+    def __init__(self, glove_file, num_candidates=40, vocab_limit=None, batch_size=1024):
+        """Loads (or builds and caches) the embeddings and their neighbour table.
+
+        Args:
+            glove_file: path to a GloVe text file (e.g. glove.6B.50d.txt).
+            num_candidates: number of nearest words kept per word (the word itself included).
+            vocab_limit: optionally keep only the first `vocab_limit` (most frequent) words.
+            batch_size: number of query rows per matrix product when building the table.
+        """
+        embeddings, words = load_glove_embeddings(glove_file)
+        if vocab_limit is not None:
+            embeddings = embeddings[:vocab_limit]
+            words = words[:vocab_limit]
+        self.words = words
+        self.word_to_id = {word: i for i, word in enumerate(words)}
+        self.num_candidates = num_candidates
+
+        table_file = "{}.top{}{}{}".format(
+            glove_file, num_candidates,
+            '' if vocab_limit is None else '.v{}'.format(vocab_limit), GLOVE_MATRIX_SUFFIX)
+        if os.path.exists(table_file):
+            logger.info("loading GloVe neighbour table from cache at {}".format(table_file))
+            self.table = np.load(table_file, mmap_mode='r')
+        else:
+            self.table = build_neighbour_table(embeddings, num_candidates, batch_size=batch_size)
+            _atomic_save_npy(table_file, self.table)
+
+    def __contains__(self, word):
+        return word in self.word_to_id
+
+    def candidates(self, word):
+        """Returns the nearest words of `word` (itself first), or [] if it is unknown."""
+        if word not in self.word_to_id:
+            return []
+        return [self.words[i] for i in self.table[self.word_to_id[word]]]
+
+    def sample(self, word, rng=random):
+        """Draws one of the `num_candidates` nearest words of `word` uniformly."""
+        if word not in self.word_to_id:
+            return word
+        row = self.table[self.word_to_id[word]]
+        return self.words[row[int(len(row) * rng.random())]]
+
+
+class AugmentationPlan(object):
+    """Words of one sentence with the GloVe replacements applied and the [MASK]ed word pieces."""
+
+    def __init__(self, words, input_ids, masked_positions, masked_words):
+        self.words = words
+        self.input_ids = input_ids
+        # Positions in `input_ids` (after [CLS]) and the index in `words` they replace.
+        self.masked_positions = masked_positions
+        self.masked_words = masked_words
+
+
+def plan_augmentation(tokenizer, text, rng, mask_prob=0.4, glove=None, max_seq_length=128):
+    """Decides which words of `text` are replaced, following `BertTokenizer.tokenize_aug`.
+
+    Each word is picked with probability `mask_prob`; words made of several word pieces
+    are replaced by a GloVe neighbour (when `glove` is given) and single-piece words are
+    [MASK]ed so that a masked LM can propose a replacement.
+    """
+    words = []
+    tokens = ["[CLS]"]
+    masked_positions = []
+    masked_words = []
+    fits = True
+    for token in tokenizer.basic_tokenizer.tokenize(text):
+        sub_tokens = tokenizer.wordpiece_tokenizer.tokenize(token)
+        picked = rng.random() < mask_prob
+        # The masked LM sees the words up to the first one that does not fit, without gaps.
+        fits = fits and len(tokens) + len(sub_tokens) < max_seq_length
+        if picked and len(sub_tokens) > 1:
+            if glove is not None:
+                token = glove.sample(token, rng)
+        elif picked and fits:
+            masked_positions.append(len(tokens))
+            masked_words.append(len(words))
+            sub_tokens = ["[MASK]"]
+        words.append(token)
+        if fits:
+            tokens.extend(sub_tokens)
+    tokens.append("[SEP]")
+    return AugmentationPlan(words, tokenizer.convert_tokens_to_ids(tokens), masked_positions, masked_words)
+
+
+class MaskedLMAugmenter(object):
+    """Fills the [MASK]ed words of many `AugmentationPlan`s with batched masked-LM forwards.
+
+    Sequences are padded only to the longest sequence of their batch, vocabulary logits
+    are computed only at the masked positions and candidates come from `topk`.
+    """
+
+    def __init__(self, model, tokenizer, num_candidates=40, batch_size=64, device=None):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.num_candidates = num_candidates
+        self.batch_size = batch_size
+        self.device = device if device is not None else next(model.parameters()).device
+        # Candidates which cannot stand alone as a word are never proposed.
+        self.banned_ids = torch.tensor(
+            [i for tok, i in tokenizer.vocab.items() if tok.startswith('##') or tok.startswith('[')],
+            dtype=torch.long, device=self.device)
+
+    def _predict(self, plans):
+        """Returns, for every plan, a [num_masked, num_candidates] array of candidate ids."""
+        max_len = max(len(plan.input_ids) for plan in plans)
+        max_masked = max(len(plan.masked_positions) for plan in plans)
+        input_ids = torch.zeros(len(plans), max_len, dtype=torch.long)
+        input_mask = torch.zeros(len(plans), max_len, dtype=torch.long)
+        masked_positions = torch.zeros(len(plans), max_masked, dtype=torch.long)
+        is_masked = torch.zeros(len(plans), max_masked, dtype=torch.bool)
+        for i, plan in enumerate(plans):
+            input_ids[i, :len(plan.input_ids)] = torch.tensor(plan.input_ids, dtype=torch.long)
+            input_mask[i, :len(plan.input_ids)] = 1
+            masked_positions[i, :len(plan.masked_positions)] = torch.tensor(plan.masked_positions, dtype=torch.long)
+            is_masked[i, :len(plan.masked_positions)] = True
+        input_ids = input_ids.to(self.device)
+        input_mask = input_mask.to(self.device)
+        masked_positions = masked_positions.to(self.device)
+
+        with torch.no_grad():
+            logits, _ = self.model(input_ids, torch.zeros_like(input_ids), input_mask,
+                                   masked_positions=masked_positions)
+            logits = logits[is_masked.to(self.device)]
+            logits[:, self.banned_ids] = -float('inf')
+            candidates = torch.topk(logits, self.num_candidates, dim=-1)[1].cpu().numpy()
+
+        results = []
+        start = 0
+        for plan in plans:
+            results.append(candidates[start:start + len(plan.masked_positions)])
+            start += len(plan.masked_positions)
+        return results
+
+    def fill(self, plans, rngs):
+        """Replaces the masked words of `plans` in place, drawing candidates with `rngs`.
+
+        Returns the augmented sentences (space-joined words) in the order of `plans`.
+        """
+        to_predict = [i for i, plan in enumerate(plans) if plan.masked_positions]
+        # Sort by length so each batch pads to a similar length.
+        to_predict.sort(key=lambda i: len(plans[i].input_ids))
+        for start in range(0, len(to_predict), self.batch_size):
+            batch = to_predict[start:start + self.batch_size]
+            for i, candidates in zip(batch, self._predict([plans[i] for i in batch])):
+                plan, rng = plans[i], rngs[i]
+                for word_index, row in zip(plan.masked_words, candidates):
+                    plan.words[word_index] = self.tokenizer.ids_to_tokens[int(row[int(len(row) * rng.random())])]
+        return [" ".join(plan.words) for plan in plans]
@@ -0,0 +1,236 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Background, crash-safe checkpoint writing and resumable training state."""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import math
+import os
+import random
+import shutil
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+import torch
+from torch.utils.data import Sampler
+
+logger = logging.getLogger(__name__)
+
+
+def snapshot_state_dict(state_dict):
+    """Copies every tensor of a state dict to CPU, so training can keep updating the originals."""
+    return state_dict.__class__((key, value.detach().to('cpu', copy=True) if torch.is_tensor(value) else value)
+                                for key, value in state_dict.items())
+
+
+def snapshot(obj):
+    """`snapshot_state_dict` for nested dicts, lists and tuples (e.g. an optimizer state dict)."""
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return obj.__class__((key, snapshot(value)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return obj.__class__(snapshot(value) for value in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    """`torch.save` to a temporary file in the same directory, then rename it over `path`.
+
+    Readers of `path` see either the previous file or the complete new one, never a partial write.
+    """
+    tmp_path = '{}.tmp.{}'.format(path, os.getpid())
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def _atomic_link(src, dst):
+    tmp_path = '{}.tmp.{}'.format(dst, os.getpid())
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+def load_training_state(path):
+    """Loads a training state written by `AsyncCheckpointWriter.save_state` on CPU."""
+    try:
+        return torch.load(path, map_location='cpu', weights_only=False)
+    except TypeError:  # torch < 1.13
+        return torch.load(path, map_location='cpu')
+
+
+def get_rng_state():
+    """The states of the python, numpy, torch and CUDA random generators."""
+    state = {'python': random.getstate(), 'numpy': np.random.get_state(), 'torch': torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+class ResumableRandomSampler(Sampler):
+    """Samples a dataset in the random order given by `seed` and the epoch, and can start in the
+    middle of an epoch.
+
+    `set_epoch(epoch, start)` selects the permutation of `epoch` and skips its first `start`
+    samples. With `num_replicas` > 1, rank `rank` gets every `num_replicas`-th index of the
+    permutation, padded to the same number of samples on every rank as `DistributedSampler`.
+    """
+    def __init__(self, data_source, seed=0, num_replicas=1, rank=0):
+        self.total_size = len(data_source)
+        self.seed = seed
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.num_samples = int(math.ceil(1.0 * self.total_size / num_replicas))
+        self.epoch = 0
+        self.start = 0
+
+    def set_epoch(self, epoch, start=0):
+        self.epoch = epoch
+        self.start = start
+
+    def __iter__(self):
+        generator = torch.Generator()
+        generator.manual_seed(self.seed + self.epoch)
+        indices = torch.randperm(self.total_size, generator=generator).tolist()
+        padded_size = self.num_samples * self.num_replicas
+        while len(indices) < padded_size:
+            indices += indices[:padded_size - len(indices)]
+        indices = indices[self.rank:padded_size:self.num_replicas]
+        return iter(indices[self.start:])
+
+    def __len__(self):
+        return max(self.num_samples - self.start, 0)
+
+
+class AsyncCheckpointWriter(object):
+    """Writes checkpoints on a background thread.
+
+    `save` snapshots the weights to CPU and returns; the worker thread serializes the snapshot
+    with `atomic_save`. The `keep_last` most recent checkpoints are kept as `checkpoint-<step>.bin`
+    and the best one so far (highest `metric`) is always available as `best_name`. `save_state`
+    writes a full training state (weights, optimizer, schedule, ...) the same way.
+
+    Params:
+        output_dir: directory the checkpoints are written to.
+        best_name: file name of the best checkpoint. Default: 'pytorch_model.bin'
+        keep_last: number of recent `checkpoint-<step>.bin` files to keep (0 keeps only `best_name`). Default: 0
+        max_pending: number of snapshots that may wait to be written before `save` blocks. Default: 2
+    """
+    def __init__(self, output_dir, best_name='pytorch_model.bin', keep_last=0, max_pending=2):
+        self.output_dir = output_dir
+        self.best_name = best_name
+        self.keep_last = keep_last
+        self.best_metric = None
+        self.recent = []
+        self.latencies = []
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, name='checkpoint-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def save(self, state_dict, step, metric=None):
+        """Queues a checkpoint of `state_dict` for `step`; it becomes the best one when `metric`
+        improves on every previous metric (or when no metric is ever given).
+
+        Returns the time, in seconds, the caller was blocked taking the snapshot.
+        """
+        self._raise_error()
+        start = time.time()
+        snapshot = snapshot_state_dict(state_dict)
+        is_best = metric is None or self.best_metric is None or metric > self.best_metric
+        if is_best and metric is not None:
+            self.best_metric = metric
+        blocked = time.time() - start
+        self._queue.put((snapshot, step, is_best, None, time.time()))
+        return blocked
+
+    def save_state(self, state, step, name):
+        """Queues `state`, any nested structure of tensors and picklable values, to be written
+        to `name` in the output directory. Returns the time the caller was blocked."""
+        self._raise_error()
+        start = time.time()
+        state = snapshot(state)
+        blocked = time.time() - start
+        self._queue.put((state, step, False, name, time.time()))
+        return blocked
+
+    def wait(self):
+        """Blocks until every queued checkpoint is on disk."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self.wait()
+        self._queue.put(None)
+        self._thread.join()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            state, step, is_best, name, queued = item
+            try:
+                start = time.time()
+                if name is None:
+                    self._write(state, step, is_best)
+                else:
+                    atomic_save(state, os.path.join(self.output_dir, name))
+                latency = time.time() - start
+                self.latencies.append(latency)
+                logger.info("%s for step %d written in %.2fs (%.2fs after it was queued)",
+                            name or "checkpoint", step, latency, time.time() - queued)
+            except Exception as e:  # reported to the training loop on the next call
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _write(self, state_dict, step, is_best):
+        best_path = os.path.join(self.output_dir, self.best_name)
+        if self.keep_last <= 0:
+            if is_best:
+                atomic_save(state_dict, best_path)
+            return
+        path = os.path.join(self.output_dir, 'checkpoint-{}.bin'.format(step))
+        atomic_save(state_dict, path)
+        if is_best:
+            _atomic_link(path, best_path)
+        self.recent.append(path)
+        while len(self.recent) > self.keep_last:
+            old_path = self.recent.pop(0)
+            if os.path.exists(old_path):
+                os.remove(old_path)
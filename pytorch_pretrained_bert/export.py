@@ -0,0 +1,146 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Freezing of a compressed student into static modules, int8 quantization and export as a
+TorchScript module."""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import copy
+import logging
+
+import torch
+from torch import nn
+
+from . import modeling
+from .factorization import ENCODER_FACTORS, _submodule
+
+logger = logging.getLogger(__name__)
+
+
+def _linear(weight, bias=None):
+    linear = nn.Linear(weight.size(1), weight.size(0), bias=bias is not None)
+    linear.weight.data.copy_(weight)
+    if bias is not None:
+        linear.bias.data.copy_(bias)
+    return linear
+
+
+def _effective_projection(module, dense_name, prefix):
+    """The weight and bias of the projection as computed by the selected backend (masks and
+    rounding included), read by projecting the identity."""
+    dense = getattr(module, dense_name)
+    probe = torch.cat([torch.zeros(1, dense.in_features), torch.eye(dense.in_features)])
+    out = module.project(probe.to(dense.weight), dense_name, prefix).float()
+    return (out[1:] - out[:1]).t(), out[0]
+
+
+def freeze_projection(module, dense_name, prefix):
+    """A static module computing the projection `dense_name` of `module` as its selected backend
+    does. 'svd' projections keep the components (up to their rank) that pruning left non-zero,
+    as two bias-free `nn.Linear`s, or their product when it is cheaper; other backends become
+    the `nn.Linear` of their effective weight. Returns the module and its rank (None when dense)."""
+    dense = getattr(module, dense_name)
+    if module.backend == 'svd':
+        rank = module.to_dim
+        mat1 = getattr(module, prefix + '1')[:, :rank].detach().float()
+        mat2 = getattr(module, prefix + '2')[:rank].detach().float()
+        kept = (mat1.abs().sum(dim=0) > 0) & (mat2.abs().sum(dim=1) > 0)
+        mat1, mat2 = mat1[:, kept], mat2[kept]
+        num_kept = mat2.size(0)
+        if num_kept == 0 or num_kept * (dense.in_features + dense.out_features) >= \
+                dense.in_features * dense.out_features:
+            return _linear(torch.matmul(mat1, mat2)), None
+        return nn.Sequential(_linear(mat2), _linear(mat1)), num_kept
+    weight, bias = _effective_projection(module, dense_name, prefix)
+    return _linear(weight, bias if dense.bias is not None else None), None
+
+
+def freeze_student(model, p_type=None, p_rate=None):
+    """A copy of the student, on CPU and in eval mode, where every encoder projection is a static
+    module (see `freeze_projection`) computed with the backends selected by `p_type`/`p_rate`
+    (the current ones by default), the factors are dropped and factorized word embeddings are
+    cut to their rank. Returns the copy and the ranks kept, by projection name."""
+    model = copy.deepcopy(model.module if hasattr(model, 'module') else model).cpu().float().eval()
+    if p_type is not None:
+        model.set_projections(p_type, p_rate)
+    ranks = {}
+    with torch.no_grad():
+        for i, layer in enumerate(model.bert.encoder.layer):
+            for path, dense_name, prefix in ENCODER_FACTORS:
+                module = _submodule(layer, path)
+                frozen, rank = freeze_projection(module, dense_name, prefix)
+                ranks['{}.{}.{}'.format(i, path, dense_name)] = rank
+                setattr(module, dense_name, frozen)
+                for name in (prefix + '1', prefix + '2'):
+                    if name in module._parameters:
+                        delattr(module, name)
+            for module in layer.projection_modules():
+                module.set_projection('dense')  # the frozen modules are called as they are
+        embeddings = model.bert.embeddings.word_embeddings
+        if isinstance(embeddings, modeling.FactorizedEmbedding) and embeddings.rank < embeddings.emat1.size(1):
+            rank = embeddings.rank
+            embedding = modeling.FactorizedEmbedding(embeddings.emat1.size(0), rank, embeddings.emat2.size(1))
+            embedding.emat1.copy_(embeddings.emat1[:, :rank])
+            embedding.emat2.copy_(embeddings.emat2[:rank])
+            model.bert.embeddings.word_embeddings = embedding
+    model.set_gradient_checkpointing(0)
+    return model, ranks
+
+
+def quantize_student(model, p_type=None, p_rate=None):
+    """`freeze_student`, then the `nn.Linear`s of every encoder projection (both factors of the
+    'svd' ones, at their kept rank) dynamically quantized to int8: weights with one symmetric
+    scale per output channel, activations quantized per batch at run time. For CPU inference.
+    Returns the quantized copy and the ranks kept."""
+    frozen, ranks = freeze_student(model, p_type=p_type, p_rate=p_rate)
+    qconfig = torch.ao.quantization.per_channel_dynamic_qconfig
+    qconfig_spec = {'bert.encoder.layer.{}.{}.{}'.format(i, path, dense_name): qconfig
+                    for i in range(len(frozen.bert.encoder.layer)) for path, dense_name, _ in ENCODER_FACTORS}
+    torch.ao.quantization.quantize_dynamic(frozen, qconfig_spec, dtype=torch.qint8, inplace=True)
+    return frozen, ranks
+
+
+class _Logits(nn.Module):
+    """The logits of a `BertForSequenceClassification` (also the distillation students, whose own
+    `forward` returns the attention scores and hidden states as well)."""
+    def __init__(self, model):
+        super(_Logits, self).__init__()
+        self.model = model
+
+    def forward(self, input_ids, token_type_ids, attention_mask):
+        return modeling.BertForSequenceClassification.forward(self.model, input_ids, token_type_ids, attention_mask)
+
+
+def export_torchscript(model, path, batch_size=1, seq_length=128, p_type=None, p_rate=None, optimize=True,
+                       quantize=False):
+    """Freezes the student (see `freeze_student`, or `quantize_student` with `quantize`), traces
+    its logits on a [batch_size, seq_length] example and saves the frozen TorchScript module to
+    `path`, which `torch.jit.load` runs without this code as
+    `module(input_ids, token_type_ids, attention_mask)`. Other batch sizes and sequence lengths
+    run through the same graph. Returns the TorchScript module and the ranks kept."""
+    if quantize:
+        frozen, ranks = quantize_student(model, p_type=p_type, p_rate=p_rate)
+    else:
+        frozen, ranks = freeze_student(model, p_type=p_type, p_rate=p_rate)
+    input_ids = torch.ones(batch_size, seq_length, dtype=torch.long)
+    token_type_ids = torch.zeros(batch_size, seq_length, dtype=torch.long)
+    attention_mask = torch.ones(batch_size, seq_length, dtype=torch.long)
+    with torch.no_grad():
+        traced = torch.jit.trace(_Logits(frozen).eval(), (input_ids, token_type_ids, attention_mask),
+                                 check_trace=False)
+        scripted = torch.jit.freeze(traced)
+        if optimize:
+            scripted = torch.jit.optimize_for_inference(scripted)
+    torch.jit.save(scripted, path)
+    logger.info("TorchScript student written to {}".format(path))
+    return scripted, ranks
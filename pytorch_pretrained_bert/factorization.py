@@ -0,0 +1,158 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Low-rank (SVD) initialization of the factor matrices of a compressed BERT."""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+
+import torch
+from torch import nn
+
+from .modeling import FactorizedEmbedding
+
+logger = logging.getLogger(__name__)
+
+# (submodule of a BertLayer, dense weight, factor prefix)
+ENCODER_FACTORS = [
+    ('attention.self', 'query', 'qmat'),
+    ('attention.self', 'key', 'kmat'),
+    ('attention.self', 'value', 'vmat'),
+    ('attention.output', 'dense', 'dmat'),
+    ('intermediate', 'dense', 'dmat'),
+    ('output', 'dense', 'dmat'),
+]
+
+
+def truncated_svd(weight, rank, method='exact', oversample=10, n_iter=4):
+    """Factorizes a [d_out, d_in] matrix as mat1 [d_out, rank] x mat2 [rank, d_in].
+
+    The singular values are split evenly (mat1 = U sqrt(S), mat2 = sqrt(S) V^T), and
+    components are sorted by decreasing singular value so the factors can be sliced
+    to a smaller rank. `method` is either 'exact' (thin SVD) or 'randomized'
+    (`torch.svd_lowrank` with `oversample` extra components and `n_iter` power iterations).
+    """
+    weight = weight.detach().float().cpu()
+    rank = min(rank, min(weight.shape))
+    if method == 'exact':
+        U, S, Vh = torch.linalg.svd(weight, full_matrices=False)
+        V = Vh.t()
+    elif method == 'randomized':
+        U, S, V = torch.svd_lowrank(weight, q=min(rank + oversample, min(weight.shape)), niter=n_iter)
+    else:
+        raise ValueError("Invalid SVD method: {} - should be 'exact' or 'randomized'".format(method))
+    root = S[:rank].sqrt()
+    mat1 = U[:, :rank] * root.unsqueeze(0)
+    mat2 = root.unsqueeze(1) * V[:, :rank].t()
+    return mat1.contiguous(), mat2.contiguous()
+
+
+def _cache_key(weight, rank, method):
+    digest = sha256(weight.detach().float().cpu().contiguous().numpy().tobytes())
+    digest.update("{}-{}-{}".format(tuple(weight.shape), rank, method).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def _factorize_cached(weight, rank, method, cache_dir):
+    if cache_dir is None:
+        return truncated_svd(weight, rank, method=method)
+    cache_path = os.path.join(cache_dir, _cache_key(weight, rank, method) + '.pt')
+    if os.path.exists(cache_path):
+        return torch.load(cache_path)
+    factors = truncated_svd(weight, rank, method=method)
+    tmp_path = cache_path + '.{}.tmp'.format(os.getpid())
+    torch.save(factors, tmp_path)
+    os.replace(tmp_path, cache_path)
+    return factors
+
+
+def factorize_weights(weights, rank, method='exact', num_workers=None, cache_dir=None):
+    """Factorizes a dict of weight matrices concurrently.
+
+    Params:
+        weights: dict mapping a name to a [d_out, d_in] tensor.
+        rank: number of components kept for every matrix.
+        method: 'exact' or 'randomized', see `truncated_svd`.
+        num_workers: size of the thread pool (default: one per matrix, capped by the CPU count).
+        cache_dir: optional directory where factors are cached, keyed by a hash of the
+            weight values, the rank and the method.
+    Returns:
+        dict mapping each name to a (mat1, mat2) pair of CPU float tensors.
+    """
+    if cache_dir is not None and not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    if num_workers is None:
+        num_workers = min(len(weights), os.cpu_count() or 1)
+    names = list(weights.keys())
+    with ThreadPoolExecutor(max_workers=max(1, num_workers)) as pool:
+        factors = list(pool.map(lambda name: _factorize_cached(weights[name], rank, method, cache_dir), names))
+    return dict(zip(names, factors))
+
+
+def _submodule(module, path):
+    for name in path.split('.'):
+        module = getattr(module, name)
+    return module
+
+
+def _assign(module, name, value):
+    param = getattr(module, name, None)
+    if isinstance(param, nn.Parameter) and param.shape == value.shape:
+        param.data.copy_(value)
+    else:
+        device = param.device if param is not None else value.device
+        setattr(module, name, nn.Parameter(value.to(device)))
+
+
+def init_svd_factors(model, rank, method='exact', num_workers=None, cache_dir=None):
+    """Initializes the `qmat*/kmat*/vmat*/dmat*` factors of every encoder layer in place
+    from the SVD of the corresponding dense weights.
+    """
+    bert = model.module.bert if hasattr(model, 'module') else model.bert
+    weights = {}
+    for i, layer in enumerate(bert.encoder.layer):
+        for path, dense, prefix in ENCODER_FACTORS:
+            weights['{}.{}.{}'.format(i, path, dense)] = getattr(_submodule(layer, path), dense).weight
+    factors = factorize_weights(weights, rank, method=method, num_workers=num_workers, cache_dir=cache_dir)
+    with torch.no_grad():
+        for i, layer in enumerate(bert.encoder.layer):
+            for path, dense, prefix in ENCODER_FACTORS:
+                mat1, mat2 = factors['{}.{}.{}'.format(i, path, dense)]
+                module = _submodule(layer, path)
+                _assign(module, prefix + '1', mat1)
+                _assign(module, prefix + '2', mat2)
+    logger.info("initialized SVD factors of {} matrices (rank {}, {})".format(len(weights), rank, method))
+    return model
+
+
+def factorize_word_embeddings(model, rank, method='exact', cache_dir=None):
+    """Replaces the dense word embeddings of `model` by a `FactorizedEmbedding` initialized from
+    their truncated SVD, and records `rank` in `model.config.embedding_rank` so that a saved
+    config rebuilds the factorized table.
+    """
+    bert = model.module.bert if hasattr(model, 'module') else model.bert
+    table = bert.embeddings.word_embeddings.weight
+    mat1, mat2 = factorize_weights({'word_embeddings': table}, rank, method=method, num_workers=1,
+                                   cache_dir=cache_dir)['word_embeddings']
+    embedding = FactorizedEmbedding(mat1.size(0), mat1.size(1), mat2.size(1))
+    with torch.no_grad():
+        embedding.emat1.copy_(mat1)
+        embedding.emat2.copy_(mat2)
+    bert.embeddings.word_embeddings = embedding.to(table.device)
+    bert.config.embedding_rank = mat1.size(1)
+    model.config.embedding_rank = mat1.size(1)
+    logger.info("factorized word embeddings {} with rank {} ({})".format(tuple(table.shape), mat1.size(1), method))
+    return model
@@ -9,6 +9,7 @@ import json
 import logging
 import os
 import shutil
+import tarfile
 import tempfile
 from functools import wraps
 from hashlib import sha256
@@ -231,6 +232,40 @@ def get_from_cache(url, cache_dir=None):
     return cache_path
 
 
+def extract_archive(archive_path, cache_dir=None):
+    """
+    Extract a ``.tar.gz`` archive into the cache directory, once, and return
+    the extracted directory. The directory name is derived from the archive's
+    path, size and modification time, so a modified archive is extracted again.
+    """
+    if cache_dir is None:
+        cache_dir = PYTORCH_PRETRAINED_BERT_CACHE
+    if sys.version_info[0] == 3 and isinstance(cache_dir, Path):
+        cache_dir = str(cache_dir)
+
+    archive_path = os.path.abspath(archive_path)
+    stat = os.stat(archive_path)
+    filename = url_to_filename(archive_path, '{}-{}'.format(stat.st_size, int(stat.st_mtime)))
+    extracted_dir = os.path.join(cache_dir, filename + '.extracted')
+    if os.path.isdir(extracted_dir):
+        return extracted_dir
+
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    # Extract next to the final location, then rename, so an interrupted
+    # extraction never leaves a partial directory behind.
+    tempdir = tempfile.mkdtemp(dir=cache_dir)
+    logger.info("extracting archive file %s to %s", archive_path, extracted_dir)
+    with tarfile.open(archive_path, 'r:gz') as archive:
+        archive.extractall(tempdir)
+    try:
+        os.rename(tempdir, extracted_dir)
+    except OSError:
+        # Another process extracted the same archive first.
+        shutil.rmtree(tempdir)
+    return extracted_dir
+
+
 def read_set_from_file(filename):
     '''
     Extract a de-duped collection (set) of text from a file.
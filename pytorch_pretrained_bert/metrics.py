@@ -0,0 +1,108 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Evaluation metrics accumulated on the device across batches."""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import math
+
+import torch
+
+
+def _rank(x):
+    """Ranks (1-based, ties get their average rank) of the entries of a 1-D tensor."""
+    values, order = x.sort()
+    _, inverse, counts = torch.unique_consecutive(values, return_inverse=True, return_counts=True)
+    ends = counts.cumsum(0)
+    average = (ends - counts + ends - 1).double() / 2 + 1
+    ranks = torch.empty(x.numel(), dtype=torch.float64, device=x.device)
+    ranks[order] = average[inverse]
+    return ranks
+
+
+def _pearson(n, sx, sy, sxx, syy, sxy):
+    cov = n * sxy - sx * sy
+    var = (n * sxx - sx * sx) * (n * syy - sy * sy)
+    return cov / math.sqrt(var) if var > 0 else 0.
+
+
+class StreamingMetrics(object):
+    """Accumulates the predictions of a classifier (`num_labels` > 1) or a regressor
+    (`num_labels` == 1) batch after batch, on the device of the logits.
+
+    Classification keeps a confusion matrix and `compute` returns the exact 'acc', 'f1' (of
+    label 1 for two labels, macro-averaged over the labels seen otherwise) and 'mcc' (multi-class
+    Matthews correlation) over all the batches. Regression keeps the sums of the Pearson
+    correlation and the predictions (for the ranks of the Spearman correlation) and `compute`
+    returns 'pearson', 'spearmanr' and their mean 'corr'. Only `compute` copies anything to the host.
+    """
+    def __init__(self, num_labels, device=None):
+        self.num_labels = num_labels
+        self.device = device
+        self.reset()
+
+    def reset(self):
+        if self.num_labels > 1:
+            self.confusion = torch.zeros(self.num_labels, self.num_labels, dtype=torch.long, device=self.device)
+        else:
+            self.sums = torch.zeros(5, dtype=torch.float64, device=self.device)
+            self.count = 0
+            self.preds, self.labels = [], []
+
+    def update(self, logits, labels):
+        """Adds a batch of logits [batch, num_labels] and labels [batch]."""
+        logits = logits.detach()
+        labels = labels.to(logits.device)
+        if self.num_labels > 1:
+            if self.confusion.device != logits.device:
+                self.confusion = self.confusion.to(logits.device)
+            index = labels.long().view(-1) * self.num_labels + logits.argmax(dim=-1).view(-1)
+            self.confusion += torch.bincount(index, minlength=self.num_labels ** 2).view_as(self.confusion)
+        else:
+            x = logits.view(-1).double()
+            y = labels.view(-1).double()
+            if self.sums.device != x.device:
+                self.sums = self.sums.to(x.device)
+            self.sums += torch.stack([x.sum(), y.sum(), (x * x).sum(), (y * y).sum(), (x * y).sum()])
+            self.count += x.numel()
+            self.preds.append(x)
+            self.labels.append(y)
+
+    def compute(self):
+        if self.num_labels > 1:
+            return self._classification()
+        return self._regression()
+
+    def _classification(self):
+        confusion = self.confusion.cpu().double()
+        total = confusion.sum().item()
+        correct = confusion.diag().sum().item()
+        true, pred = confusion.sum(dim=1), confusion.sum(dim=0)
+        tp = confusion.diag()
+        f1 = 2 * tp / (true + pred).clamp(min=1)
+        present = (true + pred) > 0  # the macro average is over the labels that occur, as sklearn's
+        cov = correct * total - (true * pred).sum().item()
+        var = (total ** 2 - (pred * pred).sum().item()) * (total ** 2 - (true * true).sum().item())
+        return {'acc': correct / total if total else 0.,
+                'f1': f1[1].item() if self.num_labels == 2 else f1[present].mean().item() if present.any() else 0.,
+                'mcc': cov / math.sqrt(var) if var > 0 else 0.}
+
+    def _regression(self):
+        if not self.count:
+            return {'pearson': 0., 'spearmanr': 0., 'corr': 0.}
+        sx, sy, sxx, syy, sxy = self.sums.tolist()
+        pearson = _pearson(self.count, sx, sy, sxx, syy, sxy)
+        x, y = _rank(torch.cat(self.preds)), _rank(torch.cat(self.labels))
+        rank_sums = torch.stack([x.sum(), y.sum(), (x * x).sum(), (y * y).sum(), (x * y).sum()]).tolist()
+        spearman = _pearson(self.count, *rank_sums)
+        return {'pearson': pearson, 'spearmanr': spearman, 'corr': (pearson + spearman) / 2}
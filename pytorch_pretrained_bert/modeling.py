@@ -18,28 +18,29 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import copy
+import inspect
 import json
 import logging
 import math
 import os
-import shutil
-import tarfile
-import tempfile
 import sys
+import tempfile
+import threading
+import zipfile
+from contextlib import contextmanager
 from io import open
 import numpy as np
 
 import torch
+import torch.nn.functional as F
+import torch.utils.checkpoint
 from torch import nn
 from torch.nn import CrossEntropyLoss
 
-from .file_utils import cached_path
+from .file_utils import cached_path, extract_archive
 
 logger = logging.getLogger(__name__)
 
-prune_type=None
-prune_rate=None
-
 PRETRAINED_MODEL_ARCHIVE_MAP = {
     'bert-base-uncased': "https://s3.amazonaws.com/models.huggingface.co/bert/bert-base-uncased.tar.gz",
     'bert-large-uncased': "https://s3.amazonaws.com/models.huggingface.co/bert/bert-large-uncased.tar.gz",
@@ -53,6 +54,78 @@ CONFIG_NAME = 'bert_config.json'
 WEIGHTS_NAME = 'pytorch_model.bin'
 TF_WEIGHTS_NAME = 'model.ckpt'
 
+# Per thread, so that models built by other threads meanwhile are initialized.
+_init_state = threading.local()
+
+
+def _init_weights():
+    return getattr(_init_state, 'init_weights', True)
+
+
+@contextmanager
+def no_init_weights():
+    """ Build models without random weight initialization (`init_bert_weights` and the
+        torch.nn defaults), for weights that are about to be overwritten by a checkpoint.
+        With torch >= 2.0 the parameters are created on the meta device, neither allocated nor
+        initialized, and have to be allocated with `materialize` before loading the checkpoint.
+        Parameters the checkpoint does not provide should then be passed to
+        `BertPreTrainedModel.init_missing_weights`. Only affects the current thread.
+    """
+    old_init_weights = _init_weights()
+    _init_state.init_weights = False
+    try:
+        if hasattr(torch.device, '__enter__'):
+            with torch.device('meta'):
+                yield
+        else:
+            yield
+    finally:
+        _init_state.init_weights = old_init_weights
+
+
+def materialize(model, device='cpu'):
+    """ Allocates on `device`, uninitialized, the parameters of a model built on the meta device
+        by `no_init_weights()`. Parameters shared by several modules (the LM head decoder and the
+        word embeddings) stay shared. """
+    if any(param.is_meta for param in model.parameters()):
+        uses = {}
+        for module in model.modules():
+            for name, param in module._parameters.items():
+                if param is not None:
+                    uses.setdefault(id(param), []).append((module, name))
+        # `to_empty` gives every module a parameter of its own.
+        model.to_empty(device=device)
+        for tied in uses.values():
+            module, name = tied[0]
+            for tied_module, tied_name in tied[1:]:
+                setattr(tied_module, tied_name, getattr(module, name))
+    return model
+
+
+def load_state_dict_file(weights_path, convert_legacy=False):
+    """ Load a state dict on CPU, memory-mapping its tensors when the file uses the zip
+        serialization format and this version of torch supports `mmap`.
+        With `convert_legacy`, a legacy-format file is rewritten in place in the zip format
+        so that the next load can be memory-mapped.
+    """
+    can_mmap = 'mmap' in inspect.signature(torch.load).parameters
+    if can_mmap and zipfile.is_zipfile(weights_path):
+        return torch.load(weights_path, map_location='cpu', mmap=True)
+    state_dict = torch.load(weights_path, map_location='cpu')
+    if convert_legacy and can_mmap:
+        logger.info("converting {} to a memory-mappable checkpoint".format(weights_path))
+        # A temporary file of its own, as every rank may convert the same cached file at once.
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(weights_path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                torch.save(state_dict, f)
+            os.replace(tmp_path, weights_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+    return state_dict
+
 def load_tf_weights_in_bert(model, tf_checkpoint_path):
     """ Load tf checkpoints in a pytorch model
     """
@@ -130,6 +203,14 @@ def swish(x):
 ACT2FN = {"gelu": gelu, "relu": torch.nn.functional.relu, "swish": swish}
 
 
+def gather_positions(sequence_tensor, positions):
+    """Gathers the vectors at `positions` ([batch_size, num_positions]) of a
+    [batch_size, sequence_length, hidden_size] tensor.
+    """
+    index = positions.unsqueeze(-1).expand(-1, -1, sequence_tensor.size(-1))
+    return torch.gather(sequence_tensor, 1, index)
+
+
 class BertConfig(object):
     """Configuration class to store the configuration of a `BertModel`.
     """
@@ -144,7 +225,9 @@ class BertConfig(object):
                  attention_probs_dropout_prob=0.1,
                  max_position_embeddings=512,
                  type_vocab_size=2,
-                 initializer_range=0.02):
+                 initializer_range=0.02,
+                 factor_rank=None,
+                 embedding_rank=None):
         """Constructs BertConfig.
 
         Args:
@@ -168,6 +251,10 @@ class BertConfig(object):
                 `BertModel`.
             initializer_range: The sttdev of the truncated_normal_initializer for
                 initializing all weight matrices.
+            factor_rank: If set, every encoder projection also gets low-rank factors
+                (`qmat1`/`qmat2`, ..., `dmat1`/`dmat2`) of this rank for the 'svd' backend.
+            embedding_rank: If set, the word embeddings are a `FactorizedEmbedding` of this
+                rank instead of a dense table (models without a tied LM head only).
         """
         if isinstance(vocab_size_or_config_json_file, str) or (sys.version_info[0] == 2
                         and isinstance(vocab_size_or_config_json_file, unicode)):
@@ -187,6 +274,8 @@ class BertConfig(object):
             self.max_position_embeddings = max_position_embeddings
             self.type_vocab_size = type_vocab_size
             self.initializer_range = initializer_range
+            self.factor_rank = factor_rank
+            self.embedding_rank = embedding_rank
         else:
             raise ValueError("First argument must be either a vocabulary size (int)"
                              "or the path to a pretrained model config file (str)")
@@ -232,17 +321,41 @@ except ImportError:
             self.variance_epsilon = eps
 
         def forward(self, x):
-            u = x.mean(-1, keepdim=True)
-            s = (x - u).pow(2).mean(-1, keepdim=True)
-            x = (x - u) / torch.sqrt(s + self.variance_epsilon)
-            return self.weight * x + self.bias
+            # Native kernel; under autocast it runs in fp32 whatever the input dtype.
+            return F.layer_norm(x, self.weight.shape, self.weight, self.bias, self.variance_epsilon)
+
+class FactorizedEmbedding(nn.Module):
+    """Word embeddings stored as `emat1` [num_embeddings, rank] x `emat2` [rank, embedding_dim].
+
+    A lookup gathers rows of `emat1` and projects them with `emat2`, using only the first
+    `self.rank` components (see `BertPreTrainedModel.set_embedding_rank`). Like `nn.Embedding`,
+    setting `sparse` gives `emat1` row-sparse gradients (whole rows, whatever the rank).
+    """
+    def __init__(self, num_embeddings, rank, embedding_dim):
+        super(FactorizedEmbedding, self).__init__()
+        self.emat1 = nn.Parameter(torch.zeros(num_embeddings, rank))
+        self.emat2 = nn.Parameter(torch.zeros(rank, embedding_dim))
+        self.rank = rank
+        self.sparse = False
+
+    def forward(self, input_ids):
+        if self.rank == self.emat1.size(1):
+            return torch.matmul(F.embedding(input_ids, self.emat1, sparse=self.sparse), self.emat2)
+        if self.sparse:
+            return torch.matmul(F.embedding(input_ids, self.emat1, sparse=True)[..., :self.rank],
+                                self.emat2[:self.rank])
+        return torch.matmul(F.embedding(input_ids, self.emat1[:, :self.rank]), self.emat2[:self.rank])
+
 
 class BertEmbeddings(nn.Module):
     """Construct the embeddings from word, position and token_type embeddings.
     """
     def __init__(self, config):
         super(BertEmbeddings, self).__init__()
-        self.word_embeddings = nn.Embedding(config.vocab_size, config.hidden_size)
+        if getattr(config, 'embedding_rank', None):
+            self.word_embeddings = FactorizedEmbedding(config.vocab_size, config.embedding_rank, config.hidden_size)
+        else:
+            self.word_embeddings = nn.Embedding(config.vocab_size, config.hidden_size)
         self.position_embeddings = nn.Embedding(config.max_position_embeddings, config.hidden_size)
         self.token_type_embeddings = nn.Embedding(config.type_vocab_size, config.hidden_size)
 
@@ -268,9 +381,134 @@ class BertEmbeddings(nn.Module):
         return embeddings
 
 
-class BertSelfAttention(nn.Module):
-    def __init__(self, config, flag):
-        super(BertSelfAttention, self).__init__()
+class ProjectionBackend(object):
+    """Computes a projection `x W^T + b` of an encoder layer.
+
+    A backend gets the dense `nn.Linear` of the projection and, when the model has them,
+    its low-rank factors `(mat1 [d_out, rank], mat2 [rank, d_in])`. `prepare` is called
+    (without gradients) the first time a projection runs after the backend was selected and
+    may return state derived from the weights; `forward` applies the projection.
+    """
+    def prepare(self, dense, factors, rank, rate):
+        return None
+
+    def forward(self, hidden_states, dense, factors, rank, state):
+        raise NotImplementedError
+
+
+class DenseProjection(ProjectionBackend):
+    """The original dense `nn.Linear`."""
+    def forward(self, hidden_states, dense, factors, rank, state):
+        return dense(hidden_states)
+
+
+class LowRankProjection(ProjectionBackend):
+    """`x mat2[:rank]^T mat1[:, :rank]^T`, the first `rank` SVD components (no bias)."""
+    def prepare(self, dense, factors, rank, rate):
+        if factors is None:
+            raise ValueError("The 'svd' projection needs a model built with `config.factor_rank` set")
+        return None
+
+    def forward(self, hidden_states, dense, factors, rank, state):
+        mat1, mat2 = factors
+        return torch.matmul(torch.matmul(hidden_states, mat2[:rank, :].t()), mat1[:, :rank].t())
+
+
+class MaskedSparseProjection(ProjectionBackend):
+    """The dense weight with all but its `rate` fraction of largest magnitude entries masked.
+
+    The mask is computed when the backend is selected; gradients still reach the kept entries.
+    """
+    def prepare(self, dense, factors, rank, rate):
+        weight = dense.weight.detach()
+        num_kept = max(1, int(rate * weight.numel()))
+        threshold = weight.abs().view(-1).kthvalue(weight.numel() - num_kept + 1)[0]
+        return (weight.abs() >= threshold).to(weight.dtype)
+
+    def forward(self, hidden_states, dense, factors, rank, state):
+        return F.linear(hidden_states, dense.weight * state, dense.bias)
+
+
+class QuantizedProjection(ProjectionBackend):
+    """The dense weight rounded to int8 with one symmetric scale per output row (inference only:
+    the weight gets no gradient)."""
+    def prepare(self, dense, factors, rank, rate):
+        weight = dense.weight.detach().float()
+        scale = weight.abs().max(dim=1, keepdim=True)[0].clamp(min=1e-8) / 127.
+        return torch.round(weight / scale).to(torch.int8), scale
+
+    def forward(self, hidden_states, dense, factors, rank, state):
+        qweight, scale = state
+        weight = (qweight.to(scale.dtype) * scale).to(hidden_states.dtype)
+        return F.linear(hidden_states, weight, dense.bias)
+
+
+PROJECTION_BACKENDS = {
+    'dense': DenseProjection(),
+    'vanilla': DenseProjection(),
+    'svd': LowRankProjection(),
+    'sparse': MaskedSparseProjection(),
+    'quantized': QuantizedProjection(),
+}
+
+
+def register_projection_backend(name, backend):
+    """Makes `backend` (a `ProjectionBackend`) selectable as `name` in `set_projections`."""
+    PROJECTION_BACKENDS[name] = backend
+
+
+class BertProjectionModule(nn.Module):
+    """Base of the encoder sub-modules whose projections go through a `ProjectionBackend`.
+
+    `to_dim_part` is the rank kept by the 'svd' backend at rate 1. The state a backend prepares
+    from the dense weight (the 'sparse' mask, the 'quantized' int8 weight) is prepared again after
+    `load_state_dict` or an in-place change of the weight (not through `.data`).
+    """
+    def __init__(self, to_dim_part, min_rank=0):
+        super(BertProjectionModule, self).__init__()
+        self.to_dim_part = to_dim_part
+        self.min_rank = min_rank
+        self.backend = None
+        self.rate = None
+        self.set_projection('dense')
+
+    def add_factors(self, prefix, out_features, in_features, rank):
+        if rank:
+            setattr(self, prefix + '1', nn.Parameter(torch.zeros(out_features, rank)))
+            setattr(self, prefix + '2', nn.Parameter(torch.zeros(rank, in_features)))
+
+    def set_projection(self, backend, rate=1.):
+        if backend not in PROJECTION_BACKENDS:
+            raise ValueError("Unknown projection backend {}, should be one of {}".format(
+                backend, sorted(PROJECTION_BACKENDS.keys())))
+        if backend != self.backend or rate != self.rate:
+            self._projection_state = {}
+        self.backend = backend
+        self.rate = rate
+        self.to_dim = max(self.min_rank, int(rate * self.to_dim_part))
+
+    def project(self, hidden_states, dense_name, prefix):
+        backend = PROJECTION_BACKENDS[self.backend]
+        dense = getattr(self, dense_name)
+        factors = None
+        if prefix + '1' in self._parameters:
+            factors = (self._parameters[prefix + '1'], self._parameters[prefix + '2'])
+        key = (dense_name, hidden_states.device)
+        weight = getattr(dense, 'weight', None)  # the frozen modules of `export.freeze_student` have none
+        version = weight._version if weight is not None else None
+        if key not in self._projection_state or self._projection_state[key][0] != version:
+            with torch.no_grad():
+                self._projection_state[key] = version, backend.prepare(dense, factors, self.to_dim, self.rate)
+        return backend.forward(hidden_states, dense, factors, self.to_dim, self._projection_state[key][1])
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        self._projection_state = {}
+        super(BertProjectionModule, self)._load_from_state_dict(*args, **kwargs)
+
+
+class BertSelfAttention(BertProjectionModule):
+    def __init__(self, config):
+        super(BertSelfAttention, self).__init__(1.0 * config.hidden_size / 2)
         if config.hidden_size % config.num_attention_heads != 0:
             raise ValueError(
                 "The hidden size (%d) is not a multiple of the number of attention "
@@ -279,8 +517,10 @@ class BertSelfAttention(nn.Module):
         self.attention_head_size = int(config.hidden_size / config.num_attention_heads)
         self.all_head_size = self.num_attention_heads * self.attention_head_size
 
-        self.flag = flag
-        self.to_dim_part = 1.0 * config.hidden_size / 2
+        rank = getattr(config, 'factor_rank', None)
+        self.add_factors('qmat', self.all_head_size, config.hidden_size, rank)
+        self.add_factors('kmat', self.all_head_size, config.hidden_size, rank)
+        self.add_factors('vmat', self.all_head_size, config.hidden_size, rank)
         self.query = nn.Linear(config.hidden_size, self.all_head_size)
         self.key = nn.Linear(config.hidden_size, self.all_head_size)
         self.value = nn.Linear(config.hidden_size, self.all_head_size)
@@ -292,20 +532,9 @@ class BertSelfAttention(nn.Module):
         return x.permute(0, 2, 1, 3)
 
     def forward(self, hidden_states, attention_mask):
-        global prune_type, prune_rate
-        self.to_dim = int(prune_rate[self.flag * 4 + 0] * self.to_dim_part)
-        if prune_type[self.flag * 4 + 0] != 'svd':
-            mixed_query_layer = self.query(hidden_states)
-            mixed_key_layer = self.key(hidden_states)
-            mixed_value_layer = self.value(hidden_states)
-
-        elif prune_type[self.flag * 4 + 0] == 'svd':
-            mixed_query_layer = torch.matmul(torch.matmul(hidden_states, self.qmat2[:self.to_dim, :].t()),
-                                             self.qmat1[:, :self.to_dim].t())
-            mixed_key_layer = torch.matmul(torch.matmul(hidden_states, self.kmat2[:self.to_dim, :].t()),
-                                           self.kmat1[:, :self.to_dim].t())
-            mixed_value_layer = torch.matmul(torch.matmul(hidden_states, self.vmat2[:self.to_dim, :].t()),
-                                             self.vmat1[:, :self.to_dim].t())
+        mixed_query_layer = self.project(hidden_states, 'query', 'qmat')
+        mixed_key_layer = self.project(hidden_states, 'key', 'kmat')
+        mixed_value_layer = self.project(hidden_states, 'value', 'vmat')
 
         query_layer = self.transpose_for_scores(mixed_query_layer)
         key_layer = self.transpose_for_scores(mixed_key_layer)
@@ -324,128 +553,118 @@ class BertSelfAttention(nn.Module):
         # seem a bit unusual, but is taken from the original Transformer paper.
         attention_probs = self.dropout(attention_probs)
 
-        previous_type = attention_probs.type()
         context_layer = torch.matmul(attention_probs, value_layer)
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[:-2] + (self.all_head_size,)
         context_layer = context_layer.view(*new_context_layer_shape)
-        return context_layer
+        return context_layer, attention_scores
 
 
-class BertSelfOutput(nn.Module):
-    def __init__(self, config, flag):
-        super(BertSelfOutput, self).__init__()
-        self.flag = flag
-        self.to_dim_part = 1.0 * config.hidden_size / 2
+class BertSelfOutput(BertProjectionModule):
+    def __init__(self, config):
+        super(BertSelfOutput, self).__init__(1.0 * config.hidden_size / 2)
+        self.add_factors('dmat', config.hidden_size, config.hidden_size, getattr(config, 'factor_rank', None))
         self.dense = nn.Linear(config.hidden_size, config.hidden_size)
         self.LayerNorm = BertLayerNorm(config.hidden_size, eps=1e-12)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
     def forward(self, hidden_states, input_tensor):
-        global prune_type, prune_rate
-        self.to_dim = int(prune_rate[self.flag * 4 + 1] * self.to_dim_part)
-        if prune_type[self.flag * 4 + 1] != 'svd':
-            hidden_states = self.dense(hidden_states)
-        elif prune_type[self.flag * 4 + 1] == 'svd':
-            hidden_states = torch.matmul(torch.matmul(hidden_states, self.dmat2[:self.to_dim, :].t()),
-                                         self.dmat1[:, :self.to_dim].t())
+        hidden_states = self.project(hidden_states, 'dense', 'dmat')
         hidden_states = self.dropout(hidden_states)
         hidden_states = self.LayerNorm(hidden_states + input_tensor)
         return hidden_states
 
 
 class BertAttention(nn.Module):
-    def __init__(self, config, flag):
+    def __init__(self, config):
         super(BertAttention, self).__init__()
-        self.flag = flag
-        self.self = BertSelfAttention(config, flag)
-        self.output = BertSelfOutput(config, flag)
+        self.self = BertSelfAttention(config)
+        self.output = BertSelfOutput(config)
 
     def forward(self, input_tensor, attention_mask):
-        self_output = self.self(input_tensor, attention_mask)
+        self_output, layer_att = self.self(input_tensor, attention_mask)
         attention_output = self.output(self_output, input_tensor)
-        return attention_output
+        return attention_output, layer_att
 
 
-class BertIntermediate(nn.Module):
-    def __init__(self, config, flag):
-        super(BertIntermediate, self).__init__()
-        self.flag = flag
-        self.to_dim_part = 1.0 * config.hidden_size * config.intermediate_size / (
-                config.hidden_size + config.intermediate_size)
+class BertIntermediate(BertProjectionModule):
+    def __init__(self, config):
+        super(BertIntermediate, self).__init__(1.0 * config.hidden_size * config.intermediate_size / (
+                config.hidden_size + config.intermediate_size))
+        self.add_factors('dmat', config.intermediate_size, config.hidden_size, getattr(config, 'factor_rank', None))
         self.dense = nn.Linear(config.hidden_size, config.intermediate_size)
         self.intermediate_act_fn = ACT2FN[config.hidden_act] \
             if isinstance(config.hidden_act, str) else config.hidden_act
 
     def forward(self, hidden_states):
-        global prune_type, prune_rate
-        self.to_dim = int(prune_rate[self.flag * 4 + 2] * self.to_dim_part)
-        if prune_type[self.flag * 4 + 2] != 'svd':
-            hidden_states = self.dense(hidden_states)
-        elif prune_type[self.flag * 4 + 2] == 'svd':
-            hidden_states = torch.matmul(torch.matmul(hidden_states, self.dmat2[:self.to_dim, :].t()),
-                                         self.dmat1[:, :self.to_dim].t())
+        hidden_states = self.project(hidden_states, 'dense', 'dmat')
         hidden_states = self.intermediate_act_fn(hidden_states)
         return hidden_states
 
 
-class BertOutput(nn.Module):
-    def __init__(self, config, flag):
-        super(BertOutput, self).__init__()
-        self.flag = flag
-        self.to_dim_part = 1.0 * config.hidden_size * config.intermediate_size / (
-                config.hidden_size + config.intermediate_size)
+class BertOutput(BertProjectionModule):
+    def __init__(self, config):
+        super(BertOutput, self).__init__(1.0 * config.hidden_size * config.intermediate_size / (
+                config.hidden_size + config.intermediate_size), min_rank=1)
+        self.add_factors('dmat', config.hidden_size, config.intermediate_size, getattr(config, 'factor_rank', None))
         self.dense = nn.Linear(config.intermediate_size, config.hidden_size)
         self.LayerNorm = BertLayerNorm(config.hidden_size, eps=1e-12)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
     def forward(self, hidden_states, input_tensor):
-        global prune_type, prune_rate
-        self.to_dim = max(1,int(prune_rate[self.flag * 4 + 3] * self.to_dim_part))
-        if prune_type[self.flag * 4 + 3] != 'svd':
-            hidden_states = self.dense(hidden_states)
-        elif prune_type[self.flag * 4 + 3] == 'svd':
-            hidden_states = torch.matmul(torch.matmul(hidden_states, self.dmat2[:self.to_dim, :].t()),
-                                         self.dmat1[:, :self.to_dim].t())
+        hidden_states = self.project(hidden_states, 'dense', 'dmat')
         hidden_states = self.dropout(hidden_states)
         hidden_states = self.LayerNorm(hidden_states + input_tensor)
         return hidden_states
 
 
 class BertLayer(nn.Module):
-    def __init__(self, config,flag):
+    def __init__(self, config):
         super(BertLayer, self).__init__()
-        self.attention = BertAttention(config,flag)
-        self.intermediate = BertIntermediate(config,flag)
-        self.output = BertOutput(config,flag)
+        self.attention = BertAttention(config)
+        self.intermediate = BertIntermediate(config)
+        self.output = BertOutput(config)
+
+    def projection_modules(self):
+        """The four projection slots of the layer: q/k/v, attention output, intermediate, output."""
+        return [self.attention.self, self.attention.output, self.intermediate, self.output]
 
     def forward(self, hidden_states, attention_mask):
-        attention_output = self.attention(hidden_states, attention_mask)
+        attention_output, layer_att = self.attention(hidden_states, attention_mask)
         intermediate_output = self.intermediate(attention_output)
         layer_output = self.output(intermediate_output, attention_output)
-        self.out=layer_output
-        return layer_output
+        return layer_output, layer_att
 
 
 class BertEncoder(nn.Module):
+    """The stack of `BertLayer`s.
+
+    With `checkpoint_every` = k > 0, every k-th layer (the 1st, (k+1)-th, ...) is run under
+    activation checkpointing when gradients are recorded: only its inputs and outputs (the
+    hidden states and attention scores returned for distillation) are kept, and its inner
+    activations are recomputed in the backward pass. Dropout masks are replayed identically.
+    """
     def __init__(self, config):
         super(BertEncoder, self).__init__()
-        lst=[]
-        for i in range(config.num_hidden_layers):
-            lst.append(BertLayer(config,i))
-        self.layer=nn.ModuleList(lst)
-        #layer = BertLayer(config)
-        #self.layer = nn.ModuleList([copy.deepcopy(layer) for _ in range(config.num_hidden_layers)])
+        self.layer = nn.ModuleList([BertLayer(config) for _ in range(config.num_hidden_layers)])
+        self.checkpoint_every = 0
 
     def forward(self, hidden_states, attention_mask, output_all_encoded_layers=True):
         all_encoder_layers = []
-        for layer_module in self.layer:
-            hidden_states = layer_module(hidden_states, attention_mask)
+        all_encoder_atts = []
+        checkpoint = self.checkpoint_every > 0 and self.training and torch.is_grad_enabled()
+        for i, layer_module in enumerate(self.layer):
+            if checkpoint and i % self.checkpoint_every == 0:
+                hidden_states, layer_att = torch.utils.checkpoint.checkpoint(
+                    layer_module, hidden_states, attention_mask, use_reentrant=False)
+            else:
+                hidden_states, layer_att = layer_module(hidden_states, attention_mask)
             if output_all_encoded_layers:
                 all_encoder_layers.append(hidden_states)
+            all_encoder_atts.append(layer_att)
         if not output_all_encoded_layers:
             all_encoder_layers.append(hidden_states)
-        return all_encoder_layers
+        return all_encoder_layers, all_encoder_atts
 
 
 class BertPooler(nn.Module):
@@ -493,7 +712,10 @@ class BertLMPredictionHead(nn.Module):
         self.decoder.weight = bert_model_embedding_weights
         self.bias = nn.Parameter(torch.zeros(bert_model_embedding_weights.size(0)))
 
-    def forward(self, hidden_states):
+    def forward(self, hidden_states, masked_positions=None):
+        if masked_positions is not None:
+            # Only the masked positions are projected to the vocabulary.
+            hidden_states = gather_positions(hidden_states, masked_positions)
         hidden_states = self.transform(hidden_states)
         hidden_states = self.decoder(hidden_states) + self.bias
         return hidden_states
@@ -504,8 +726,8 @@ class BertOnlyMLMHead(nn.Module):
         super(BertOnlyMLMHead, self).__init__()
         self.predictions = BertLMPredictionHead(config, bert_model_embedding_weights)
 
-    def forward(self, sequence_output):
-        prediction_scores = self.predictions(sequence_output)
+    def forward(self, sequence_output, masked_positions=None):
+        prediction_scores = self.predictions(sequence_output, masked_positions)
         return prediction_scores
 
 
@@ -525,8 +747,8 @@ class BertPreTrainingHeads(nn.Module):
         self.predictions = BertLMPredictionHead(config, bert_model_embedding_weights)
         self.seq_relationship = nn.Linear(config.hidden_size, 2)
 
-    def forward(self, sequence_output, pooled_output):
-        prediction_scores = self.predictions(sequence_output)
+    def forward(self, sequence_output, pooled_output, masked_positions=None):
+        prediction_scores = self.predictions(sequence_output, masked_positions)
         seq_relationship_score = self.seq_relationship(pooled_output)
         return prediction_scores, seq_relationship_score
 
@@ -549,6 +771,8 @@ class BertPreTrainedModel(nn.Module):
     def init_bert_weights(self, module):
         """ Initialize the weights.
         """
+        if not _init_weights():
+            return
         if isinstance(module, (nn.Linear, nn.Embedding)):
             # Slightly different from the TF version which uses truncated_normal for initialization
             # cf https://github.com/pytorch/pytorch/pull/5617
@@ -556,9 +780,83 @@ class BertPreTrainedModel(nn.Module):
         elif isinstance(module, BertLayerNorm):
             module.bias.data.zero_()
             module.weight.data.fill_(1.0)
+        elif isinstance(module, FactorizedEmbedding):
+            module.emat1.data.normal_(mean=0.0, std=self.config.initializer_range)
+            module.emat2.data.normal_(mean=0.0, std=self.config.initializer_range)
         if isinstance(module, nn.Linear) and module.bias is not None:
             module.bias.data.zero_()
 
+    def init_missing_weights(self, missing_keys):
+        """ Initialize, as `init_bert_weights` would, only the parameters named in `missing_keys`
+            (e.g. the ones a checkpoint did not provide to a model built under `no_init_weights()`).
+        """
+        modules = dict(self.named_modules())
+        # A parameter tied to one the checkpoint provided (the LM head decoder) is loaded.
+        missing = set(missing_keys)
+        loaded = set(id(param) for module_name, module in modules.items()
+                     for param_name, param in module._parameters.items()
+                     if (module_name + '.' + param_name if module_name else param_name) not in missing)
+        for key in missing_keys:
+            module_name, _, param_name = key.rpartition('.')
+            module = modules.get(module_name)
+            param = getattr(module, param_name, None) if module is not None else None
+            if param is None or id(param) in loaded:
+                continue
+            if isinstance(module, BertLayerNorm):
+                param.data.fill_(1.0 if param_name == 'weight' else 0.0)
+            elif param_name == 'weight' and isinstance(module, (nn.Linear, nn.Embedding)):
+                param.data.normal_(mean=0.0, std=self.config.initializer_range)
+            elif param_name == 'bias' and isinstance(module, nn.Linear):
+                param.data.zero_()
+            elif isinstance(module, FactorizedEmbedding):
+                param.data.normal_(mean=0.0, std=self.config.initializer_range)
+            else:
+                param.data.zero_()  # as the constructors of the other parameters (factors, biases)
+
+    def set_projections(self, p_type, p_rate=None):
+        """ Selects, in place, how every projection of the encoder is computed.
+
+            `p_type` is a backend name of `PROJECTION_BACKENDS` ('dense', 'svd', 'sparse',
+            'quantized', ...) or a list of 4 names per layer, one for each of the q/k/v,
+            attention output, intermediate and output projections. `p_rate` (a float or a list
+            of the same length) is the fraction of the rank ('svd') or of the weights ('sparse') kept.
+        """
+        encoder = self.encoder if hasattr(self, 'encoder') else self.bert.encoder
+        modules = [module for layer in encoder.layer for module in layer.projection_modules()]
+        if isinstance(p_type, str):
+            p_type = [p_type] * len(modules)
+        if p_rate is None or isinstance(p_rate, (int, float)):
+            p_rate = [1. if p_rate is None else p_rate] * len(modules)
+        if len(p_type) != len(modules) or len(p_rate) != len(modules):
+            raise ValueError("Expected {} projection types and rates, got {} and {}".format(
+                len(modules), len(p_type), len(p_rate)))
+        for module, backend, rate in zip(modules, p_type, p_rate):
+            module.set_projection(backend, rate)
+
+    def set_embedding_rank(self, rank):
+        """ Uses only the first `rank` components of `FactorizedEmbedding` word embeddings. """
+        embeddings = self.embeddings if hasattr(self, 'embeddings') else self.bert.embeddings
+        if not isinstance(embeddings.word_embeddings, FactorizedEmbedding):
+            raise ValueError("The word embeddings are not factorized, see `config.embedding_rank`")
+        if not 0 < rank <= embeddings.word_embeddings.emat1.size(1):
+            raise ValueError("Invalid embedding rank: {}".format(rank))
+        embeddings.word_embeddings.rank = rank
+
+    def set_gradient_checkpointing(self, every=1):
+        """ Recomputes every `every`-th encoder layer in the backward pass instead of storing its
+            activations (0 disables it), see `BertEncoder`.
+        """
+        if every < 0:
+            raise ValueError("Invalid checkpointing interval: {}".format(every))
+        encoder = self.encoder if hasattr(self, 'encoder') else self.bert.encoder
+        encoder.checkpoint_every = every
+
+    def get_projections(self):
+        """ Returns the `(p_type, p_rate)` lists currently selected by `set_projections`. """
+        encoder = self.encoder if hasattr(self, 'encoder') else self.bert.encoder
+        modules = [module for layer in encoder.layer for module in layer.projection_modules()]
+        return [module.backend for module in modules], [module.rate for module in modules]
+
     @classmethod
     def from_pretrained(cls, pretrained_model_name_or_path, state_dict=None, cache_dir=None,
                         from_tf=False, *inputs, **kwargs):
@@ -609,29 +907,26 @@ class BertPreTrainedModel(nn.Module):
         else:
             logger.info("loading archive file {} from cache at {}".format(
                 archive_file, resolved_archive_file))
-        tempdir = None
+        extracted = False
         if os.path.isdir(resolved_archive_file) or from_tf:
             serialization_dir = resolved_archive_file
         else:
-            # Extract archive to temp dir
-            tempdir = tempfile.mkdtemp()
-            logger.info("extracting archive file {} to temp dir {}".format(
-                resolved_archive_file, tempdir))
-            with tarfile.open(resolved_archive_file, 'r:gz') as archive:
-                archive.extractall(tempdir)
-            serialization_dir = tempdir
+            # Extract archive once into the cache, next to the downloaded archive
+            serialization_dir = extract_archive(resolved_archive_file, cache_dir=cache_dir)
+            extracted = True
         # Load config
         config_file = os.path.join(serialization_dir, CONFIG_NAME)
         config = BertConfig.from_json_file(config_file)
         logger.info("Model config {}".format(config))
-        # Instantiate model.
-        model = cls(config, *inputs, **kwargs)
+        # Instantiate model, skipping the random initialization of weights loaded below.
+        if from_tf:
+            model = cls(config, *inputs, **kwargs)
+        else:
+            with no_init_weights():
+                model = materialize(cls(config, *inputs, **kwargs))
         if state_dict is None and not from_tf:
             weights_path = os.path.join(serialization_dir, WEIGHTS_NAME)
-            state_dict = torch.load(weights_path, map_location='cpu' if not torch.cuda.is_available() else None)
-        if tempdir:
-            # Clean up temp dir
-            shutil.rmtree(tempdir)
+            state_dict = load_state_dict_file(weights_path, convert_legacy=extracted)
         if from_tf:
             # Directly load from a TensorFlow checkpoint
             weights_path = os.path.join(serialization_dir, TF_WEIGHTS_NAME)
@@ -671,6 +966,7 @@ class BertPreTrainedModel(nn.Module):
         if not hasattr(model, 'bert') and any(s.startswith('bert.') for s in state_dict.keys()):
             start_prefix = 'bert.'
         load(model, prefix=start_prefix)
+        model.init_missing_weights([key[len(start_prefix):] for key in missing_keys])
         if len(missing_keys) > 0:
             logger.info("Weights of {} not initialized from pretrained model: {}".format(
                 model.__class__.__name__, missing_keys))
@@ -701,8 +997,10 @@ class BertModel(BertPreTrainedModel):
             input sequence length in the current batch. It's the mask that we typically use for attention when
             a batch has varying length sentences.
         `output_all_encoded_layers`: boolean which controls the content of the `encoded_layers` output as described below. Default: `True`.
+        `output_attentions`: if `True`, the raw attention scores of every layer are also returned. Default: `False`.
 
-    Outputs: Tuple of (encoded_layers, pooled_output)
+    Outputs: Tuple of (encoded_layers, pooled_output), or (encoded_layers, attention_scores, pooled_output)
+        if `output_attentions` is `True`
         `encoded_layers`: controled by `output_all_encoded_layers` argument:
             - `output_all_encoded_layers=True`: outputs a list of the full sequences of encoded-hidden-states at the end
                 of each attention block (i.e. 12 full sequences for BERT-base, 24 for BERT-large), each
@@ -712,6 +1010,10 @@ class BertModel(BertPreTrainedModel):
         `pooled_output`: a torch.FloatTensor of size [batch_size, hidden_size] which is the output of a
             classifier pretrained on top of the hidden state associated to the first character of the
             input (`CLS`) to train on the Next-Sentence task (see BERT's paper).
+        `attention_scores`: a list with the [batch_size, num_heads, sequence_length, sequence_length]
+            attention scores (before the softmax) of every layer.
+
+    The projections of the encoder are dense by default, see `set_projections` to select other backends.
 
     Example usage:
     ```python
@@ -734,7 +1036,8 @@ class BertModel(BertPreTrainedModel):
         self.pooler = BertPooler(config)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True,
+                output_attentions=False):
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
         if token_type_ids is None:
@@ -756,13 +1059,15 @@ class BertModel(BertPreTrainedModel):
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
 
         embedding_output = self.embeddings(input_ids, token_type_ids)
-        encoded_layers = self.encoder(embedding_output,
-                                      extended_attention_mask,
-                                      output_all_encoded_layers=output_all_encoded_layers)
+        encoded_layers, layer_atts = self.encoder(embedding_output,
+                                                  extended_attention_mask,
+                                                  output_all_encoded_layers=output_all_encoded_layers)
         sequence_output = encoded_layers[-1]
         pooled_output = self.pooler(sequence_output)
         if not output_all_encoded_layers:
             encoded_layers = encoded_layers[-1]
+        if output_attentions:
+            return encoded_layers, layer_atts, pooled_output
         return encoded_layers, pooled_output
 
 
@@ -792,6 +1097,9 @@ class BertForPreTraining(BertPreTrainedModel):
         `next_sentence_label`: optional next sentence classification loss: torch.LongTensor of shape [batch_size]
             with indices selected in [0, 1].
             0 => next sentence is the continuation, 1 => next sentence is a random sentence.
+        `masked_positions`: optional torch.LongTensor of shape [batch_size, num_predictions] with the positions
+            for which masked language modeling logits are computed. When given, the logits (and
+            `masked_lm_labels`) have shape [batch_size, num_predictions, ...] instead of [batch_size, sequence_length, ...].
 
     Outputs:
         if `masked_lm_labels` and `next_sentence_label` are not `None`:
@@ -822,10 +1130,11 @@ class BertForPreTraining(BertPreTrainedModel):
         self.cls = BertPreTrainingHeads(config, self.bert.embeddings.word_embeddings.weight)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, masked_lm_labels=None, next_sentence_label=None):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, masked_lm_labels=None, next_sentence_label=None,
+                masked_positions=None):
         sequence_output, pooled_output = self.bert(input_ids, token_type_ids, attention_mask,
                                                    output_all_encoded_layers=False)
-        prediction_scores, seq_relationship_score = self.cls(sequence_output, pooled_output)
+        prediction_scores, seq_relationship_score = self.cls(sequence_output, pooled_output, masked_positions)
 
         if masked_lm_labels is not None and next_sentence_label is not None:
             loss_fct = CrossEntropyLoss(ignore_index=-1)
@@ -858,6 +1167,9 @@ class BertForMaskedLM(BertPreTrainedModel):
         `masked_lm_labels`: masked language modeling labels: torch.LongTensor of shape [batch_size, sequence_length]
             with indices selected in [-1, 0, ..., vocab_size]. All labels set to -1 are ignored (masked), the loss
             is only computed for the labels set in [0, ..., vocab_size]
+        `masked_positions`: optional torch.LongTensor of shape [batch_size, num_predictions] with the positions
+            for which logits are computed. When given, the logits (and `masked_lm_labels`) have shape
+            [batch_size, num_predictions, ...] instead of [batch_size, sequence_length, ...].
 
     Outputs:
         if `masked_lm_labels` is  not `None`:
@@ -885,10 +1197,11 @@ class BertForMaskedLM(BertPreTrainedModel):
         self.cls = BertOnlyMLMHead(config, self.bert.embeddings.word_embeddings.weight)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, masked_lm_labels=None):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, masked_lm_labels=None,
+                masked_positions=None):
         sequence_output, _ = self.bert(input_ids, token_type_ids, attention_mask,
                                        output_all_encoded_layers=False)
-        prediction_scores = self.cls(sequence_output)
+        prediction_scores = self.cls(sequence_output, masked_positions)
 
         if masked_lm_labels is not None:
             loss_fct = CrossEntropyLoss(ignore_index=-1)
@@ -982,8 +1295,13 @@ class BertForSequenceClassification(BertPreTrainedModel):
             a batch has varying length sentences.
         `labels`: labels for the classification output: torch.LongTensor of shape [batch_size]
             with indices selected in [0, ..., num_labels].
+        `p_type`, `p_rate`: optional projection backends and rates, see `set_projections`.
+        `output_attentions`: if `True`, also outputs what distillation needs (see below). Default: `False`.
 
     Outputs:
+        if `output_attentions` is `True`:
+            Outputs a tuple of the logits, the attention scores of every layer and the encoded
+            hidden states of every layer.
         if `labels` is not `None`:
             Outputs the CrossEntropy classification loss of the output with the labels.
         if `labels` is `None`:
@@ -1013,14 +1331,21 @@ class BertForSequenceClassification(BertPreTrainedModel):
         self.classifier = nn.Linear(config.hidden_size, num_labels)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None,p_type=['vanilla']*48,p_rate=[1.]*48):
-        global prune_type, prune_rate
-        prune_type = p_type
-        prune_rate = p_rate
-        _, pooled_output = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False)
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, labels=None,
+                p_type=None, p_rate=None, output_attentions=False):
+        if p_type is not None:
+            self.set_projections(p_type, p_rate)
+        if output_attentions:
+            encoded_layers, layer_atts, pooled_output = self.bert(input_ids, token_type_ids, attention_mask,
+                                                                  output_all_encoded_layers=True,
+                                                                  output_attentions=True)
+        else:
+            _, pooled_output = self.bert(input_ids, token_type_ids, attention_mask, output_all_encoded_layers=False)
         pooled_output = self.dropout(pooled_output)
         logits = self.classifier(pooled_output)
 
+        if output_attentions:
+            return logits, layer_atts, encoded_layers
         if labels is not None:
             loss_fct = CrossEntropyLoss()
             loss = loss_fct(logits.view(-1, self.num_labels), labels.view(-1))
@@ -15,8 +15,10 @@
 """PyTorch optimization for BERT model."""
 
 import math
+from collections import defaultdict
+
 import torch
-from torch.optim import Optimizer
+from torch.optim import Optimizer, SparseAdam
 from torch.optim.optimizer import required
 from torch.nn.utils import clip_grad_norm_
 
@@ -41,6 +43,56 @@ SCHEDULES = {
     'warmup_linear':warmup_linear,
 }
 
+QUANTIZED_STATE_KEYS = ['next_m_q', 'next_m_scale', 'next_v_q', 'next_v_scale']
+
+
+def quantize_blockwise(x, block_size, signed):
+    """Quantizes a 1-D float tensor to 8 bits with one absmax scale per block of `block_size` entries.
+
+    Values are companded before rounding to keep relative precision for small entries: signed
+    values (first moments) store sign * sqrt(|x| / absmax) as int8, non-negative ones (second
+    moments) store (x / absmax) ** (1/4) as uint8. Returns (codes, absmax).
+    """
+    n = x.numel()
+    pad = (-n) % block_size
+    if pad:
+        x = torch.cat([x, x.new_zeros(pad)])
+    blocks = x.view(-1, block_size)
+    absmax = blocks.abs().max(dim=1, keepdim=True)[0]
+    normed = blocks / absmax.clamp(min=torch.finfo(absmax.dtype).tiny)
+    if signed:
+        codes = torch.round(normed.sign() * normed.abs().sqrt() * 127).to(torch.int8)
+    else:
+        codes = torch.round(normed.clamp(min=0).sqrt().sqrt() * 255).to(torch.uint8)
+    return codes.view(-1)[:n], absmax.view(-1)
+
+
+def dequantize_blockwise(codes, absmax, block_size, signed):
+    """Inverse of `quantize_blockwise`, returns a float32 tensor."""
+    n = codes.numel()
+    x = codes.float()
+    pad = (-n) % block_size
+    if pad:
+        x = torch.cat([x, x.new_zeros(pad)])
+    x = x.view(-1, block_size)
+    if signed:
+        x = x / 127
+        x = x * x.abs()
+    else:
+        x = (x / 255) ** 4
+    return (x * absmax.unsqueeze(1)).view(-1)[:n]
+
+
+def _foreach_supported():
+    """Whether this torch has the multi-tensor kernels `BertAdam._foreach_step` uses: besides
+    `_foreach_addcmul_`, `_foreach_norm` and the overload of `_foreach_mul_` taking a Tensor
+    scalar, which came with torch 2.1."""
+    try:
+        version = tuple(int(v) for v in torch.__version__.split('+')[0].split('.')[:2])
+    except ValueError:
+        return False
+    return version >= (2, 1) and hasattr(torch, '_foreach_addcmul_') and hasattr(torch, '_foreach_norm')
+
 
 class BertAdam(Optimizer):
     """Implements BERT version of Adam algorithm with weight decay fix.
@@ -55,10 +107,22 @@ class BertAdam(Optimizer):
         e: Adams epsilon. Default: 1e-6
         weight_decay: Weight decay. Default: 0.01
         max_grad_norm: Maximum norm for the gradients (-1 means no clipping). Default: 1.0
+        global_grad_norm: Clip by the norm of all the gradients together instead of
+            clipping every parameter by its own norm. Default: False
+        foreach: Update all the parameters of a group with multi-tensor (`torch._foreach_*`)
+            kernels instead of one parameter at a time. Falls back to the loop when this
+            torch lacks them (see `_foreach_supported`). Default: True
+        compact_state: Keep the moments of parameters given a mask by `set_mask` only for
+            their unmasked entries. Default: False
+        state_bits: 32, or 8 to store the moments of parameters with at least `min_8bit_size`
+            entries block-wise quantized (see `quantize_blockwise`). Default: 32
+        block_size: Entries per quantization block (one fp32 scale each). Default: 2048
+        min_8bit_size: Smaller parameters (biases, LayerNorm) keep fp32 moments. Default: 4096
     """
     def __init__(self, params, lr=required, warmup=-1, t_total=-1, schedule='warmup_linear',
                  b1=0.9, b2=0.999, e=1e-6, weight_decay=0.01,
-                 max_grad_norm=1.0):
+                 max_grad_norm=1.0, global_grad_norm=False, foreach=None, compact_state=False,
+                 state_bits=32, block_size=2048, min_8bit_size=4096):
         if lr is not required and lr < 0.0:
             raise ValueError("Invalid learning rate: {} - should be >= 0.0".format(lr))
         if schedule not in SCHEDULES:
@@ -71,10 +135,98 @@ class BertAdam(Optimizer):
             raise ValueError("Invalid b2 parameter: {} - should be in [0.0, 1.0[".format(b2))
         if not e >= 0.0:
             raise ValueError("Invalid epsilon value: {} - should be >= 0.0".format(e))
+        if state_bits not in (8, 32):
+            raise ValueError("Invalid state_bits: {} - should be 8 or 32".format(state_bits))
         defaults = dict(lr=lr, schedule=schedule, warmup=warmup, t_total=t_total,
                         b1=b1, b2=b2, e=e, weight_decay=weight_decay,
                         max_grad_norm=max_grad_norm)
         super(BertAdam, self).__init__(params, defaults)
+        self.global_grad_norm = global_grad_norm
+        self.foreach = (foreach is None or foreach) and _foreach_supported()
+        self.compact_state = compact_state
+        self.state_bits = state_bits
+        self.block_size = block_size
+        self.min_8bit_size = min_8bit_size
+
+    def set_mask(self, p, mask, compact=None):
+        """Restricts the updates of parameter `p` to the entries where `mask` is nonzero.
+
+        Masked entries of `p` are zeroed and then stay exactly zero: their gradients and moments
+        are zeroed at every step. With `compact` (default: `compact_state`) the moments are only
+        stored for the unmasked entries, which saves memory below ~2/3 density. `mask=None` removes
+        the mask. Calling it again with a new mask carries the moments of the surviving entries over.
+        """
+        if compact is None:
+            compact = self.compact_state
+        state = self.state[p]
+        next_m, next_v = self._dense_moments(p, state)
+        for key in ['mask', 'index'] + QUANTIZED_STATE_KEYS:
+            state.pop(key, None)
+        if mask is None:
+            if next_m is not None:
+                state['next_m'], state['next_v'] = next_m, next_v
+            return
+        mask = mask.to(device=p.device, dtype=torch.bool)
+        p.data.mul_(mask)
+        state['mask'] = mask
+        state.setdefault('step', 0)
+        if next_m is None:
+            next_m, next_v = torch.zeros_like(p.data), torch.zeros_like(p.data)
+        if compact:
+            index = mask.view(-1).nonzero().view(-1).int()
+            state['index'] = index
+            state['next_m'] = next_m.view(-1)[index.long()]
+            state['next_v'] = next_v.view(-1)[index.long()]
+        else:
+            state['next_m'] = next_m.mul_(mask)
+            state['next_v'] = next_v.mul_(mask)
+
+    def load_state_dict(self, state_dict):
+        # `Optimizer.load_state_dict` casts every state tensor to the dtype of its parameter, which
+        # would round the compact indices (exact in fp32 up to 2^24 only) and the 8-bit moments:
+        # the masks, indices and quantized moments with their scales are put back as they are.
+        state_dict = dict(state_dict)
+        kept_keys = ['mask', 'index'] + QUANTIZED_STATE_KEYS
+        kept = {}
+        state = {}
+        for key, param_state in state_dict['state'].items():
+            kept[key] = {name: value for name, value in param_state.items() if name in kept_keys}
+            state[key] = {name: value for name, value in param_state.items() if name not in kept_keys}
+        state_dict['state'] = state
+        super(BertAdam, self).load_state_dict(state_dict)
+        saved_ids = [i for group in state_dict['param_groups'] for i in group['params']]
+        params = dict(zip(saved_ids, [p for group in self.param_groups for p in group['params']]))
+        for key, param_state in kept.items():
+            p = params[key]
+            for name, value in param_state.items():
+                self.state[p][name] = value.to(p.device)
+
+    def _dense_moments(self, p, state):
+        if 'next_m_q' in state:
+            return (dequantize_blockwise(state['next_m_q'], state['next_m_scale'], self.block_size, True).view_as(p),
+                    dequantize_blockwise(state['next_v_q'], state['next_v_scale'], self.block_size, False).view_as(p))
+        if 'next_m' not in state:
+            return None, None
+        if 'index' not in state:
+            return state['next_m'], state['next_v']
+        index = state['index'].long()
+        next_m, next_v = torch.zeros_like(p.data), torch.zeros_like(p.data)
+        next_m.view(-1)[index] = state['next_m']
+        next_v.view(-1)[index] = state['next_v']
+        return next_m, next_v
+
+    def _separate_step(self, p):
+        """Whether `p` is updated on its own (compact or 8-bit moments) rather than by the foreach
+        or single tensor path."""
+        state = self.state.get(p, ())
+        return 'index' in state or 'next_m_q' in state or (
+            self.state_bits == 8 and p.numel() >= self.min_8bit_size)
+
+    def _mask_grads(self):
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is not None and 'mask' in self.state.get(p, ()):
+                    p.grad.data.mul_(self.state[p]['mask'])
 
     def get_lr(self):
         lr = []
@@ -91,6 +243,32 @@ class BertAdam(Optimizer):
                 lr.append(lr_scheduled)
         return lr
 
+    def _scheduled_lr(self, group, step):
+        if group['t_total'] != -1:
+            schedule_fct = SCHEDULES[group['schedule']]
+            return group['lr'] * schedule_fct(step/group['t_total'], group['warmup'])
+        return group['lr']
+
+    def _global_clip_coef(self):
+        """Returns, per group, the factor scaling the gradients to `max_grad_norm` by the norm of
+        all the clipped gradients together (None when global clipping is off)."""
+        if not self.global_grad_norm:
+            return None
+        grads = [p.grad.detach() for group in self.param_groups if group['max_grad_norm'] > 0
+                 for p in group['params'] if p.grad is not None]
+        if not grads:
+            return None
+        if self.foreach:
+            by_device = defaultdict(list)
+            for grad in grads:
+                by_device[grad.device].append(grad)
+            norms = [norm for device_grads in by_device.values() for norm in torch._foreach_norm(device_grads)]
+        else:
+            norms = [torch.norm(grad, 2.0) for grad in grads]
+        total_norm = torch.norm(torch.stack([norm.to(grads[0].device) for norm in norms]), 2.0)
+        return [(group['max_grad_norm'] / (total_norm + 1e-6)).clamp(max=1.0)
+                if group['max_grad_norm'] > 0 else None for group in self.param_groups]
+
     def step(self, closure=None):
         """Performs a single optimization step.
 
@@ -102,61 +280,251 @@ class BertAdam(Optimizer):
         if closure is not None:
             loss = closure()
 
-        for group in self.param_groups:
+        self._mask_grads()
+        clip_coefs = self._global_clip_coef()
+        for i, group in enumerate(self.param_groups):
+            clip_coef = clip_coefs[i] if clip_coefs is not None else None
             for p in group['params']:
-                if p.grad is None:
-                    continue
-                grad = p.grad.data
-                if grad.is_sparse:
-                    raise RuntimeError('Adam does not support sparse gradients, please consider SparseAdam instead')
+                if p.grad is not None and self._separate_step(p):
+                    if 'index' in self.state.get(p, ()):
+                        self._compact_step(p, group, clip_coef)
+                    else:
+                        self._quantized_step(p, group, clip_coef)
+            if self.foreach:
+                self._foreach_step(group, clip_coef)
+            else:
+                self._single_tensor_step(group, clip_coef)
 
-                state = self.state[p]
+        return loss
 
-                # State initialization
-                if len(state) == 0:
-                    state['step'] = 0
-                    # Exponential moving average of gradient values
-                    state['next_m'] = torch.zeros_like(p.data)
-                    # Exponential moving average of squared gradient values
-                    state['next_v'] = torch.zeros_like(p.data)
-
-                next_m, next_v = state['next_m'], state['next_v']
-                beta1, beta2 = group['b1'], group['b2']
-
-                # Add grad clipping
-                if group['max_grad_norm'] > 0:
-                    clip_grad_norm_(p, group['max_grad_norm'])
-
-                # Decay the first and second moment running average coefficient
-                # In-place operations to update the averages at the same time
-                next_m.mul_(beta1).add_(1 - beta1, grad)
-                next_v.mul_(beta2).addcmul_(1 - beta2, grad, grad)
-                update = next_m / (next_v.sqrt() + group['e'])
-
-                # Just adding the square of the weights to the loss function is *not*
-                # the correct way of using L2 regularization/weight decay with Adam,
-                # since that will interact with the m and v parameters in strange ways.
-                #
-                # Instead we want to decay the weights in a manner that doesn't interact
-                # with the m/v parameters. This is equivalent to adding the square
-                # of the weights to the loss with plain (non-momentum) SGD.
-                if group['weight_decay'] > 0.0:
-                    update += group['weight_decay'] * p.data
+    def _init_state(self, p):
+        state = self.state[p]
+        # State initialization
+        if len(state) == 0:
+            state['step'] = 0
+            # Exponential moving average of gradient values
+            state['next_m'] = torch.zeros_like(p.data)
+            # Exponential moving average of squared gradient values
+            state['next_v'] = torch.zeros_like(p.data)
+        return state
 
-                if group['t_total'] != -1:
-                    schedule_fct = SCHEDULES[group['schedule']]
-                    lr_scheduled = group['lr'] * schedule_fct(state['step']/group['t_total'], group['warmup'])
-                else:
-                    lr_scheduled = group['lr']
+    def _foreach_step(self, group, clip_coef):
+        """Updates the parameters of `group` bucketed by device, dtype and step, with one
+        multi-tensor kernel per operation and one schedule evaluation per bucket."""
+        buckets = defaultdict(list)
+        for p in group['params']:
+            if p.grad is None or self._separate_step(p):
+                continue
+            if p.grad.is_sparse:
+                raise RuntimeError('Adam does not support sparse gradients, please consider SparseAdam instead')
+            state = self._init_state(p)
+            buckets[(p.device, p.dtype, state['step'])].append(p)
+
+        beta1, beta2 = group['b1'], group['b2']
+        for (_, _, step), params in buckets.items():
+            grads = [p.grad.data for p in params]
+            next_m = [self.state[p]['next_m'] for p in params]
+            next_v = [self.state[p]['next_v'] for p in params]
+
+            # Add grad clipping
+            if clip_coef is not None:
+                torch._foreach_mul_(grads, clip_coef.to(grads[0].device))
+            elif group['max_grad_norm'] > 0:
+                norms = torch.stack(torch._foreach_norm(grads))
+                coefs = (group['max_grad_norm'] / (norms + 1e-6)).clamp(max=1.0)
+                torch._foreach_mul_(grads, list(coefs.unbind()))
+
+            # Same update as `_single_tensor_step`, see there.
+            torch._foreach_mul_(next_m, beta1)
+            torch._foreach_add_(next_m, grads, alpha=1 - beta1)
+            torch._foreach_mul_(next_v, beta2)
+            torch._foreach_addcmul_(next_v, grads, grads, value=1 - beta2)
+            update = torch._foreach_sqrt(next_v)
+            torch._foreach_add_(update, group['e'])
+            update = torch._foreach_div(next_m, update)
+            if group['weight_decay'] > 0.0:
+                torch._foreach_add_(update, [p.data for p in params], alpha=group['weight_decay'])
+
+            lr_scheduled = self._scheduled_lr(group, step)
+            torch._foreach_add_([p.data for p in params], update, alpha=-lr_scheduled)
+
+            for p in params:
+                self.state[p]['step'] += 1
+
+    def _compact_step(self, p, group, clip_coef):
+        """`_single_tensor_step` on the unmasked entries of `p` only, with compact moments."""
+        state = self.state[p]
+        index = state['index'].long()
+        if clip_coef is not None:
+            p.grad.data.mul_(clip_coef.to(p.device))
+        elif group['max_grad_norm'] > 0:
+            clip_grad_norm_(p, group['max_grad_norm'])
+        grad = p.grad.data.view(-1)[index]
+        next_m, next_v = state['next_m'], state['next_v']
+        beta1, beta2 = group['b1'], group['b2']
 
-                update_with_lr = lr_scheduled * update
-                p.data.add_(-update_with_lr)
+        next_m.mul_(beta1).add_(grad, alpha=1 - beta1)
+        next_v.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+        update = next_m / (next_v.sqrt() + group['e'])
+        if group['weight_decay'] > 0.0:
+            update += group['weight_decay'] * p.data.view(-1)[index]
 
-                state['step'] += 1
+        lr_scheduled = self._scheduled_lr(group, state['step'])
+        p.data.view(-1).index_add_(0, index, update, alpha=-lr_scheduled)
+        state['step'] += 1
 
-                # step_size = lr_scheduled * math.sqrt(bias_correction2) / bias_correction1
-                # No bias correction
-                # bias_correction1 = 1 - beta1 ** state['step']
-                # bias_correction2 = 1 - beta2 ** state['step']
+    def _quantized_step(self, p, group, clip_coef, chunk_blocks=256):
+        """`_single_tensor_step` with 8-bit block-wise moments, dequantized, updated and
+        requantized `chunk_blocks` blocks at a time to bound the fp32 temporaries."""
+        state = self.state[p]
+        if 'next_m_q' not in state:
+            next_m, next_v = self._dense_moments(p, state)
+            if next_m is None:
+                next_m, next_v = torch.zeros_like(p.data), torch.zeros_like(p.data)
+            state.setdefault('step', 0)
+            state['next_m_q'], state['next_m_scale'] = quantize_blockwise(next_m.view(-1).float(), self.block_size, True)
+            state['next_v_q'], state['next_v_scale'] = quantize_blockwise(next_v.view(-1).float(), self.block_size, False)
+            state.pop('next_m', None)
+            state.pop('next_v', None)
 
+        if clip_coef is not None:
+            p.grad.data.mul_(clip_coef.to(p.device))
+        elif group['max_grad_norm'] > 0:
+            clip_grad_norm_(p, group['max_grad_norm'])
+
+        beta1, beta2 = group['b1'], group['b2']
+        lr_scheduled = self._scheduled_lr(group, state['step'])
+        flat_p, flat_grad = p.data.view(-1), p.grad.data.view(-1)
+        chunk = self.block_size * chunk_blocks
+        for start in range(0, flat_p.numel(), chunk):
+            end = min(start + chunk, flat_p.numel())
+            blocks = slice(start // self.block_size, (end + self.block_size - 1) // self.block_size)
+            grad = flat_grad[start:end].float()
+            next_m = dequantize_blockwise(state['next_m_q'][start:end], state['next_m_scale'][blocks],
+                                          self.block_size, True)
+            next_v = dequantize_blockwise(state['next_v_q'][start:end], state['next_v_scale'][blocks],
+                                          self.block_size, False)
+
+            next_m.mul_(beta1).add_(grad, alpha=1 - beta1)
+            next_v.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            update = next_m / (next_v.sqrt() + group['e'])
+            if group['weight_decay'] > 0.0:
+                update += group['weight_decay'] * flat_p[start:end].float()
+            flat_p[start:end].add_(update.to(flat_p.dtype), alpha=-lr_scheduled)
+
+            state['next_m_q'][start:end], state['next_m_scale'][blocks] = quantize_blockwise(
+                next_m, self.block_size, True)
+            state['next_v_q'][start:end], state['next_v_scale'][blocks] = quantize_blockwise(
+                next_v, self.block_size, False)
+        state['step'] += 1
+
+    def _single_tensor_step(self, group, clip_coef):
+        for p in group['params']:
+            if p.grad is None or self._separate_step(p):
+                continue
+            grad = p.grad.data
+            if grad.is_sparse:
+                raise RuntimeError('Adam does not support sparse gradients, please consider SparseAdam instead')
+
+            state = self._init_state(p)
+            next_m, next_v = state['next_m'], state['next_v']
+            beta1, beta2 = group['b1'], group['b2']
+
+            # Add grad clipping
+            if clip_coef is not None:
+                grad.mul_(clip_coef.to(grad.device))
+            elif group['max_grad_norm'] > 0:
+                clip_grad_norm_(p, group['max_grad_norm'])
+
+            # Decay the first and second moment running average coefficient
+            # In-place operations to update the averages at the same time
+            next_m.mul_(beta1).add_(grad, alpha=1 - beta1)
+            next_v.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            update = next_m / (next_v.sqrt() + group['e'])
+
+            # Just adding the square of the weights to the loss function is *not*
+            # the correct way of using L2 regularization/weight decay with Adam,
+            # since that will interact with the m and v parameters in strange ways.
+            #
+            # Instead we want to decay the weights in a manner that doesn't interact
+            # with the m/v parameters. This is equivalent to adding the square
+            # of the weights to the loss with plain (non-momentum) SGD.
+            if group['weight_decay'] > 0.0:
+                update += group['weight_decay'] * p.data
+
+            lr_scheduled = self._scheduled_lr(group, state['step'])
+
+            update_with_lr = lr_scheduled * update
+            p.data.add_(-update_with_lr)
+
+            state['step'] += 1
+
+            # step_size = lr_scheduled * math.sqrt(bias_correction2) / bias_correction1
+            # No bias correction
+            # bias_correction1 = 1 - beta1 ** state['step']
+            # bias_correction2 = 1 - beta2 ** state['step']
+
+
+class SparseBertAdam(SparseAdam):
+    """`torch.optim.SparseAdam` for the row-sparse gradients of an `nn.Embedding(..., sparse=True)`:
+    only the rows a batch looks up (and their moments) are updated. The learning rate follows
+    BertAdam's schedule; unlike BertAdam there is bias correction, no weight decay and no clipping.
+    Params:
+        lr: learning rate
+        warmup: portion of t_total for the warmup, -1  means no warmup. Default: -1
+        t_total: total number of training steps for the learning
+            rate schedule, -1  means constant learning rate. Default: -1
+        schedule: schedule to use for the warmup (see above). Default: 'warmup_linear'
+        b1: Adams b1. Default: 0.9
+        b2: Adams b2. Default: 0.999
+        e: Adams epsilon. Default: 1e-6
+    """
+    def __init__(self, params, lr=required, warmup=-1, t_total=-1, schedule='warmup_linear',
+                 b1=0.9, b2=0.999, e=1e-6):
+        if schedule not in SCHEDULES:
+            raise ValueError("Invalid schedule parameter: {}".format(schedule))
+        super(SparseBertAdam, self).__init__(params, lr=lr, betas=(b1, b2), eps=e)
+        for group in self.param_groups:
+            group.update(base_lr=group['lr'], warmup=warmup, t_total=t_total, schedule=schedule)
+        self.global_step = 0
+        self.masks = {}
+
+    def set_mask(self, p, mask):
+        """Zeroes the entries of `p` where `mask` is zero and keeps them at zero after every step
+        (only the rows updated by the step are masked again). `mask=None` removes the mask."""
+        if mask is None:
+            self.masks.pop(p, None)
+            return
+        mask = mask.to(device=p.device, dtype=p.dtype)
+        p.data.mul_(mask)
+        self.masks[p] = mask
+
+    def get_lr(self):
+        return [group['lr'] for group in self.param_groups]
+
+    def state_dict(self):
+        state_dict = super(SparseBertAdam, self).state_dict()
+        params = [p for group in self.param_groups for p in group['params']]
+        state_dict['global_step'] = self.global_step
+        state_dict['masks'] = {i: self.masks[p] for i, p in enumerate(params) if p in self.masks}
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        state_dict = dict(state_dict)
+        self.global_step = state_dict.pop('global_step', 0)
+        masks = state_dict.pop('masks', {})
+        super(SparseBertAdam, self).load_state_dict(state_dict)
+        params = [p for group in self.param_groups for p in group['params']]
+        self.masks = {params[i]: mask.to(device=params[i].device, dtype=params[i].dtype) for i, mask in masks.items()}
+
+    def step(self, closure=None):
+        for group in self.param_groups:
+            if group['t_total'] != -1:
+                schedule_fct = SCHEDULES[group['schedule']]
+                group['lr'] = group['base_lr'] * schedule_fct(self.global_step/group['t_total'], group['warmup'])
+        rows = {p: p.grad.coalesce()._indices()[0] for p in self.masks if p.grad is not None}
+        loss = super(SparseBertAdam, self).step(closure)
+        for p, index in rows.items():
+            p.data[index] = p.data[index] * self.masks[p][index]
+        self.global_step += 1
         return loss
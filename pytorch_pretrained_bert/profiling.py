@@ -0,0 +1,217 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Low-overhead instrumentation of training steps: phase timings and on-device running sums."""
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class _NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.timer._synchronize()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.timer._synchronize()
+        self.timer.add(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class StepTimer(object):
+    """Aggregates the wall time of named phases of the training steps.
+
+    `with timer.phase('backward'): ...` times a phase; `timer.step()` closes a step and, every
+    `interval` steps, appends the percentiles of every phase over the last steps to `path` as a
+    JSON line. When `enabled` is False, `phase` returns a shared no-op context and nothing is
+    recorded.
+
+    Params:
+        enabled: record the phases. Default: True
+        synchronize: wait for the pending kernels of `device` around every phase, so that
+            asynchronous CUDA work is charged to the phase that launched it. Default: False
+        device: the training device (only used with `synchronize`).
+        path: file the JSON lines are appended to (None: only logged).
+        interval: number of steps between two JSON lines (0: only on `dump`). Default: 0
+    """
+    def __init__(self, enabled=True, synchronize=False, device=None, path=None, interval=0):
+        self.enabled = enabled
+        self.synchronize = synchronize and device is not None and torch.device(device).type == 'cuda'
+        self.device = device
+        self.path = path
+        self.interval = interval
+        self.reset()
+
+    def reset(self):
+        self.times = OrderedDict()
+        self.steps = 0
+
+    def phase(self, name):
+        if not self.enabled:
+            return _NULL_PHASE
+        return _Phase(self, name)
+
+    def add(self, name, seconds):
+        self.times.setdefault(name, []).append(seconds)
+
+    def iterate(self, iterable, name='data'):
+        """Yields the items of `iterable`, charging the time spent fetching each one to `name`."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def step(self, **info):
+        if not self.enabled:
+            return
+        self.steps += 1
+        if self.interval and self.steps % self.interval == 0:
+            self.dump(**info)
+
+    def summary(self):
+        """Returns, for every phase, its count, mean and 50/90/99th percentiles in ms, its
+        total in s and its share of the total time."""
+        total = sum(sum(times) for times in self.times.values()) or 1.
+        summary = OrderedDict()
+        for name, times in self.times.items():
+            times_ms = np.array(times) * 1000.
+            summary[name] = {'count': len(times),
+                             'mean_ms': float(times_ms.mean()),
+                             'p50_ms': float(np.percentile(times_ms, 50)),
+                             'p90_ms': float(np.percentile(times_ms, 90)),
+                             'p99_ms': float(np.percentile(times_ms, 99)),
+                             'total_s': float(times_ms.sum() / 1000.),
+                             'share': float(sum(times) / total)}
+        return summary
+
+    def dump(self, **info):
+        """Writes the summary of the steps since the last dump (with the `info` fields) and resets."""
+        if not self.enabled or not self.times:
+            return
+        record = OrderedDict(info)
+        record['steps'] = self.steps
+        record['phases'] = self.summary()
+        line = json.dumps(record)
+        logger.info("step times: %s", line)
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(line + '\n')
+        self.reset()
+
+    def _synchronize(self):
+        if self.synchronize:
+            torch.cuda.synchronize(self.device)
+
+
+class DeviceAccumulator(object):
+    """Running sums of scalar tensors (losses, metrics) kept on the training device.
+
+    `add` only queues an on-device addition, so it never waits for the device; the sums are
+    copied to the host (one synchronization) by `flush`, every `flush_every` calls of `add`
+    when it is set, and added to the host `totals`.
+
+    Params:
+        names: names of the accumulated values.
+        device: device of the running sums.
+        flush_every: number of `add` calls between two automatic flushes (0: only on `flush`). Default: 0
+    """
+    def __init__(self, names, device, flush_every=0):
+        self.names = list(names)
+        self.device = device
+        self.flush_every = flush_every
+        dtype = torch.float32 if torch.device(device).type == 'mps' else torch.float64
+        self._sums = torch.zeros(len(self.names), dtype=dtype, device=device)
+        self.reset()
+
+    def reset(self):
+        self._sums.zero_()
+        self._pending = 0
+        self.count = 0
+        self.totals = OrderedDict((name, 0.) for name in self.names)
+
+    def add(self, **values):
+        """Adds one value (a scalar tensor or a number) to each of the running sums.
+        Returns True when the sums were flushed to the host."""
+        stacked = torch.stack([torch.as_tensor(values[name]).detach().to(self._sums) for name in self.names])
+        self._sums.add_(stacked)
+        self._pending += 1
+        self.count += 1
+        if self.flush_every and self._pending >= self.flush_every:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        """Moves the pending sums to the host totals and returns the totals."""
+        if self._pending:
+            for name, value in zip(self.names, self._sums.tolist()):
+                self.totals[name] += value
+            self._sums.zero_()
+            self._pending = 0
+        return self.totals
+
+    def means(self):
+        """The means of every value over all the `add` calls since the last `reset`."""
+        totals = self.flush()
+        return OrderedDict((name, total / max(self.count, 1)) for name, total in totals.items())
+
+
+def profiler_window(start, num_steps, output_dir):
+    """A `torch.profiler.profile` recording the steps [start, start + num_steps) (counted by its
+    `step()` calls) and exporting them as a Chrome trace to `output_dir`, or None when `num_steps`
+    is 0. Enter it before the training loop and call `step()` after every step."""
+    if num_steps <= 0:
+        return None
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    path = os.path.join(output_dir, 'trace-{}-{}.json'.format(start, start + num_steps))
+
+    def export(profiler):
+        profiler.export_chrome_trace(path)
+        logger.info("profiler trace of steps %d-%d written to %s", start, start + num_steps - 1, path)
+
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=max(start - 1, 0), warmup=min(start, 1), active=num_steps, repeat=1),
+        on_trace_ready=export,
+        record_shapes=True)
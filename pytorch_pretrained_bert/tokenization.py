@@ -22,12 +22,11 @@ import os
 import unicodedata
 from io import open
 
-import numpy as np
 import random
-from tqdm import tqdm
 from pytorch_pretrained_bert.modeling import BertForSequenceClassification, BertConfig, WEIGHTS_NAME, CONFIG_NAME,BertForPreTraining
 import torch
 
+from .augmentation import GloveNeighbours
 from .file_utils import cached_path
 
 logger = logging.getLogger(__name__)
@@ -96,39 +95,12 @@ class BertTokenizer(object):
 
         #aug
         '''glove_file='/home/yujwang/maoyh/glove/glove.6B.50d.txt'
-        self.glove_model,self.glove_mapping,self.glove_mapping_rev=self.load_glove_model(glove_file)
-        self.bert_model=self.load_bert()
-        self.num_can=40'''
-
-    def load_glove_model(self,glove_file):
-        p=0.1
-        f=open(glove_file,'r')
-        n=0
-        for line in f:
-            n+=1
-        #n=1000
-        f.close()
-        f=open(glove_file,'r')
-        model=None
-        mapping=[]
-        mapping_rev={}
-        i=0
-        for _ in tqdm(range(n)):
-            line=f.readline()
-            if random.random()>p:
-                continue
-            split_line=line.split()
-            word=split_line[0]
-            embedding=np.array([float(val) for val in split_line[1:]])
-            if model is None:
-                model=np.array([embedding])
-            else:
-                model=np.append(model,[embedding],axis=0)
-            mapping.append(word)
-            mapping_rev[word]=i
-            i+=1
-        f.close()
-        return model,mapping,mapping_rev
+        self.num_can=40
+        self.glove=self.load_glove_model(glove_file)
+        self.bert_model=self.load_bert()'''
+
+    def load_glove_model(self, glove_file, vocab_limit=None):
+        return GloveNeighbours(glove_file, num_candidates=self.num_can, vocab_limit=vocab_limit)
 
     def load_bert(self):
         with torch.no_grad():
@@ -194,38 +166,25 @@ class BertTokenizer(object):
         return split_tokens
 
     def glove_close(self, token):
-        if token in self.glove_mapping_rev:
-            id=self.glove_mapping_rev[token]
-            dist=np.sum((self.glove_model-self.glove_model[id:id+1,:])**2,axis=-1)
-            candidates=dist.argsort()[:self.num_can]
-            chosen=int(self.num_can*random.random())
-            return self.glove_mapping[candidates[chosen]]
-        else:
-            return token
+        return self.glove.sample(token)
 
     def bert_close(self, tokens):
         max_seq_length=128
         tokens=tokens[:max_seq_length-2]
-        n=len(tokens)
+        chosen=list(tokens)
+        positions=[i+1 for i, token in enumerate(tokens) if token=='[MASK]']
+        if not positions:
+            return chosen
         tokens = ["[CLS]"] + tokens + ["[SEP]"]
-        segment_ids = [0] * len(tokens)
-        input_ids = self.convert_tokens_to_ids(tokens)
-        input_mask = [1] * len(input_ids)
-        padding = [0] * (max_seq_length - len(input_ids))
-        input_ids += padding
-        input_mask += padding
-        segment_ids += padding
-        input_ids = torch.tensor(input_ids, dtype=torch.long).unsqueeze(0).cuda()
-        input_mask = torch.tensor(input_mask, dtype=torch.long).unsqueeze(0).cuda()
-        segment_ids = torch.tensor(segment_ids, dtype=torch.long).unsqueeze(0).cuda()
+        device = next(self.bert_model.parameters()).device
+        input_ids = torch.tensor(self.convert_tokens_to_ids(tokens), dtype=torch.long, device=device).unsqueeze(0)
+        masked_positions = torch.tensor(positions, dtype=torch.long, device=device).unsqueeze(0)
         with torch.no_grad():
-            logits, _ = self.bert_model(input_ids, segment_ids, input_mask)
-        #print(logits.shape)
-        logits=logits.reshape(-1,30522).detach().cpu().numpy()[1:n+1]
-        candidates = logits.argsort(axis=-1)[:,-self.num_can:]
-        chosen=[]
-        for i in range(n):
-            chosen.append(self.ids_to_tokens[candidates[i,int(random.random()*self.num_can)]])
+            logits, _ = self.bert_model(input_ids, torch.zeros_like(input_ids), torch.ones_like(input_ids),
+                                        masked_positions=masked_positions)
+        candidates = torch.topk(logits[0], self.num_can, dim=-1)[1].cpu().numpy()
+        for position, row in zip(positions, candidates):
+            chosen[position-1]=self.ids_to_tokens[row[int(random.random()*self.num_can)]]
         return chosen
 
     def convert_tokens_to_ids(self, tokens):
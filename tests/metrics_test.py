@@ -0,0 +1,84 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import, division, print_function
+
+import unittest
+import warnings
+
+import torch
+from scipy.stats import pearsonr, spearmanr
+from sklearn.metrics import f1_score, matthews_corrcoef
+
+from pytorch_pretrained_bert.metrics import StreamingMetrics, _rank
+
+
+def one_hot_logits(preds, num_labels):
+    return torch.nn.functional.one_hot(torch.tensor(preds), num_labels).float()
+
+
+class StreamingMetricsTest(unittest.TestCase):
+    def classification(self, batches, num_labels):
+        metrics = StreamingMetrics(num_labels)
+        for preds, labels in batches:
+            metrics.update(one_hot_logits(preds, num_labels), torch.tensor(labels))
+        return metrics.compute()
+
+    def assertClassification(self, batches, num_labels):
+        preds = [p for batch_preds, _ in batches for p in batch_preds]
+        labels = [l for _, batch_labels in batches for l in batch_labels]
+        result = self.classification(batches, num_labels)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # undefined F1 / MCC of a single class
+            f1 = f1_score(labels, preds) if num_labels == 2 else f1_score(labels, preds, average='macro')
+            mcc = matthews_corrcoef(labels, preds)
+        self.assertAlmostEqual(result['acc'], sum(p == l for p, l in zip(preds, labels)) / len(labels))
+        self.assertAlmostEqual(result['f1'], f1)
+        self.assertAlmostEqual(result['mcc'], mcc)
+
+    def test_binary(self):
+        self.assertClassification([([1, 0, 1, 1], [1, 0, 0, 1]), ([0, 0, 1], [1, 0, 1])], 2)
+
+    def test_multiclass(self):
+        self.assertClassification([([0, 1, 2, 2, 1], [0, 2, 2, 1, 1]), ([2, 0, 0], [2, 0, 1]), ([1], [0])], 3)
+        # A label that is neither predicted nor true is left out of the macro F1.
+        self.assertClassification([([0, 1, 0], [0, 1, 1]), ([1, 1], [1, 0])], 4)
+
+    def test_single_class(self):
+        # One batch of a single class, then the whole set of a single class.
+        self.assertClassification([([0, 0, 0], [0, 0, 0]), ([1, 0], [1, 1])], 2)
+        self.assertClassification([([0, 0, 0], [0, 0, 0])], 2)
+        self.assertClassification([([1, 1], [2, 2])], 3)
+
+    def test_rank_ties(self):
+        ranks = _rank(torch.tensor([3., 1., 3., 2., 3., 1.]))
+        self.assertEqual(ranks.tolist(), [5., 1.5, 5., 3., 5., 1.5])
+
+    def test_regression(self):
+        preds = [0.5, 1.0, 1.0, 3.0, 2.5, 2.5, 2.5, 4.0, 0.0]
+        labels = [1.0, 1.0, 2.0, 4.0, 3.0, 3.0, 2.0, 5.0, 0.0]
+        metrics = StreamingMetrics(1)
+        for start in range(0, len(preds), 4):
+            metrics.update(torch.tensor(preds[start:start + 4]).view(-1, 1), torch.tensor(labels[start:start + 4]))
+        result = metrics.compute()
+        self.assertAlmostEqual(result['pearson'], pearsonr(preds, labels)[0])
+        self.assertAlmostEqual(result['spearmanr'], spearmanr(preds, labels)[0])
+        self.assertAlmostEqual(result['corr'], (result['pearson'] + result['spearmanr']) / 2)
+
+    def test_constant_regression(self):
+        metrics = StreamingMetrics(1)
+        metrics.update(torch.ones(4, 1), torch.tensor([1., 2., 3., 4.]))
+        self.assertEqual(metrics.compute(), {'pearson': 0., 'spearmanr': 0., 'corr': 0.})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import, division, print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import torch
+
+from pytorch_pretrained_bert import modeling, modeling_both
+
+
+class BertModelTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.config = modeling.BertConfig(vocab_size_or_config_json_file=99, hidden_size=32, num_hidden_layers=2,
+                                          num_attention_heads=4, intermediate_size=37)
+        self.model_dir = tempfile.mkdtemp()
+        with open(os.path.join(self.model_dir, modeling.CONFIG_NAME), 'w') as f:
+            f.write(self.config.to_json_string())
+
+    def tearDown(self):
+        shutil.rmtree(self.model_dir)
+
+    def save(self, state_dict):
+        torch.save(state_dict, os.path.join(self.model_dir, modeling.WEIGHTS_NAME))
+
+    def test_from_pretrained_keeps_decoder_tied(self):
+        for model_class in [modeling.BertForPreTraining, modeling.BertForMaskedLM]:
+            state_dict = model_class(self.config).state_dict()
+            word_embeddings = state_dict['bert.embeddings.word_embeddings.weight']
+            for drop_decoder in [False, True]:
+                if drop_decoder:
+                    del state_dict['cls.predictions.decoder.weight']
+                self.save(state_dict)
+                model = model_class.from_pretrained(self.model_dir)
+                decoder = model.cls.predictions.decoder.weight
+                self.assertIs(decoder, model.bert.embeddings.word_embeddings.weight)
+                self.assertTrue(torch.equal(decoder, word_embeddings))
+
+    def test_gradient_checkpointing(self):
+        model = modeling_both.BertForSequenceClassification(self.config, 3)
+        model.train()  # with dropout, which checkpointing replays
+        input_ids = torch.randint(0, self.config.vocab_size, (2, 7))
+        attention_mask = torch.ones_like(input_ids)
+        attention_mask[1, 4:] = 0
+
+        def run(every):
+            model.set_gradient_checkpointing(every)
+            model.zero_grad()
+            torch.manual_seed(1)
+            logits, atts, reps = model(input_ids, attention_mask=attention_mask)
+            (logits.sum() + sum(att.sum() for att in atts) + sum(rep.sum() for rep in reps)).backward()
+            grads = [param.grad.clone() for param in model.parameters() if param.grad is not None]
+            return [logits] + list(atts) + list(reps), grads
+
+        expected_outputs, expected_grads = run(0)
+        for every in [1, 2]:
+            outputs, grads = run(every)
+            self.assertEqual(len(grads), len(expected_grads))
+            for output, expected in zip(outputs + grads, expected_outputs + expected_grads):
+                self.assertTrue(torch.allclose(output, expected, atol=1e-6))
+
+    def test_projection_state_follows_weights(self):
+        model = modeling_both.BertForSequenceClassification(self.config, 3)
+        other = modeling_both.BertForSequenceClassification(self.config, 3)
+        model.eval()
+        other.eval()
+        input_ids = torch.randint(0, self.config.vocab_size, (2, 7))
+        for p_type in ['sparse', 'quantized']:
+            with torch.no_grad():
+                model(input_ids, p_type=p_type, p_rate=0.5)  # prepares the state of the current weights
+                model.load_state_dict(other.state_dict())
+                self.assertTrue(torch.equal(model(input_ids, p_type=p_type, p_rate=0.5)[0],
+                                            other(input_ids, p_type=p_type, p_rate=0.5)[0]))
+                for module in [model, other]:
+                    module.bert.encoder.layer[0].output.dense.weight.mul_(2)
+                self.assertTrue(torch.equal(model(input_ids, p_type=p_type, p_rate=0.5)[0],
+                                            other(input_ids, p_type=p_type, p_rate=0.5)[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
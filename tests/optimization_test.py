@@ -0,0 +1,196 @@
+# coding=utf-8
+# Copyright 2018 The Google AI Language Team Authors and The HugginFace Inc. team.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import, division, print_function
+
+import io
+import unittest
+
+import torch
+from torch.nn.utils import clip_grad_norm_
+from torch.optim import Optimizer
+
+from pytorch_pretrained_bert.optimization import SCHEDULES, BertAdam, _foreach_supported
+
+
+class ReferenceBertAdam(Optimizer):
+    """BertAdam as it was before the multi-tensor step: one parameter at a time, every
+    parameter clipped by its own norm."""
+    def __init__(self, params, lr, warmup=-1, t_total=-1, schedule='warmup_linear',
+                 b1=0.9, b2=0.999, e=1e-6, weight_decay=0.01, max_grad_norm=1.0):
+        defaults = dict(lr=lr, schedule=schedule, warmup=warmup, t_total=t_total,
+                        b1=b1, b2=b2, e=e, weight_decay=weight_decay,
+                        max_grad_norm=max_grad_norm)
+        super(ReferenceBertAdam, self).__init__(params, defaults)
+
+    def step(self, closure=None):
+        for group in self.param_groups:
+            for p in group['params']:
+                if p.grad is None:
+                    continue
+                grad = p.grad.data
+                state = self.state[p]
+                if len(state) == 0:
+                    state['step'] = 0
+                    state['next_m'] = torch.zeros_like(p.data)
+                    state['next_v'] = torch.zeros_like(p.data)
+                next_m, next_v = state['next_m'], state['next_v']
+                beta1, beta2 = group['b1'], group['b2']
+                if group['max_grad_norm'] > 0:
+                    clip_grad_norm_(p, group['max_grad_norm'])
+                next_m.mul_(beta1).add_(grad, alpha=1 - beta1)
+                next_v.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+                update = next_m / (next_v.sqrt() + group['e'])
+                if group['weight_decay'] > 0.0:
+                    update += group['weight_decay'] * p.data
+                if group['t_total'] != -1:
+                    schedule_fct = SCHEDULES[group['schedule']]
+                    lr_scheduled = group['lr'] * schedule_fct(state['step']/group['t_total'], group['warmup'])
+                else:
+                    lr_scheduled = group['lr']
+                p.data.add_(-lr_scheduled * update)
+                state['step'] += 1
+
+
+class OptimizationTest(unittest.TestCase):
+    num_steps = 20
+
+    def make_params(self):
+        torch.manual_seed(0)
+        return [torch.randn(4, 3), torch.randn(3), torch.randn(5, 2), torch.randn(2)]
+
+    def make_grads(self):
+        """Per step, one gradient per parameter; the third parameter gets none every third step
+        and the second one none at the first step. The gradients of the first are large enough
+        to be clipped."""
+        torch.manual_seed(1)
+        grads = []
+        for step in range(self.num_steps):
+            step_grads = [torch.randn(4, 3) * 10, torch.randn(3), torch.randn(5, 2), torch.randn(2)]
+            if step % 3 == 0:
+                step_grads[2] = None
+            if step == 0:
+                step_grads[1] = None
+            grads.append(step_grads)
+        return grads
+
+    def run_optimizer(self, optimizer_class, **kwargs):
+        params = [p.clone().requires_grad_() for p in self.make_params()]
+        groups = [{'params': params[:2], 'weight_decay': 0.01},
+                  {'params': params[2:], 'weight_decay': 0.0}]
+        optimizer = optimizer_class(groups, lr=0.1, warmup=0.25, t_total=self.num_steps, **kwargs)
+        for step_grads in self.make_grads():
+            for p, grad in zip(params, step_grads):
+                p.grad = None if grad is None else grad.clone()
+            optimizer.step()
+        return [p.detach() for p in params]
+
+    def assertAllClose(self, params1, params2):
+        for p1, p2 in zip(params1, params2):
+            self.assertTrue(torch.allclose(p1, p2, rtol=1e-5, atol=1e-6), (p1 - p2).abs().max())
+
+    def test_loop_matches_reference(self):
+        expected = self.run_optimizer(ReferenceBertAdam)
+        self.assertAllClose(self.run_optimizer(BertAdam, foreach=False), expected)
+
+    @unittest.skipUnless(_foreach_supported(), "multi-tensor kernels not available")
+    def test_foreach_matches_reference(self):
+        expected = self.run_optimizer(ReferenceBertAdam)
+        self.assertAllClose(self.run_optimizer(BertAdam, foreach=True), expected)
+
+    @unittest.skipUnless(_foreach_supported(), "multi-tensor kernels not available")
+    def test_foreach_matches_loop_global_grad_norm(self):
+        expected = self.run_optimizer(BertAdam, foreach=False, global_grad_norm=True)
+        self.assertAllClose(self.run_optimizer(BertAdam, foreach=True, global_grad_norm=True), expected)
+
+    def run_resumed(self, dtype, resume_at, **kwargs):
+        """Steps a masked (compact moments) parameter and a dense one, saving and reloading the
+        optimizer into a new one after `resume_at` steps when it is not None."""
+        torch.manual_seed(2)
+        params = [torch.randn(64, 80).to(dtype).requires_grad_(), torch.randn(64, 80).to(dtype).requires_grad_()]
+        mask = torch.rand(64, 80) > 0.3
+        grads = [[torch.randn(64, 80).to(dtype) for _ in params] for _ in range(6)]
+
+        def make_optimizer():
+            return BertAdam(params, lr=0.01, warmup=0.1, t_total=6, compact_state=True, **kwargs)
+
+        optimizer = make_optimizer()
+        optimizer.set_mask(params[0], mask)
+        for step, step_grads in enumerate(grads):
+            if step == resume_at:
+                buffer = io.BytesIO()
+                torch.save(optimizer.state_dict(), buffer)
+                buffer.seek(0)
+                optimizer = make_optimizer()
+                optimizer.load_state_dict(torch.load(buffer))
+            for p, grad in zip(params, step_grads):
+                p.grad = grad.clone()
+            optimizer.step()
+        return [p.detach().float() for p in params], optimizer
+
+    def test_resume_compact_half(self):
+        # fp16 stores integers exactly only up to 2048, below the 3584 or so compact indices.
+        expected, _ = self.run_resumed(torch.float16, None)
+        resumed, optimizer = self.run_resumed(torch.float16, 3)
+        self.assertAllClose(resumed, expected)
+        state = optimizer.state[next(iter(optimizer.state))]
+        self.assertEqual(state['index'].dtype, torch.int32)
+        self.assertEqual(state['mask'].dtype, torch.bool)
+
+    def test_resume_8bit(self):
+        expected, _ = self.run_resumed(torch.float32, None, state_bits=8, min_8bit_size=1024)
+        resumed, optimizer = self.run_resumed(torch.float32, 3, state_bits=8, min_8bit_size=1024)
+        self.assertAllClose(resumed, expected)
+        dtypes = [state['next_m_q'].dtype for state in optimizer.state.values() if 'next_m_q' in state]
+        self.assertEqual(dtypes, [torch.int8])
+
+    def run_masked(self, **kwargs):
+        """Steps a parameter masked with `set_mask` and an unmasked one, returns their initial and
+        final values and the mask."""
+        torch.manual_seed(3)
+        initial = [torch.randn(64, 80), torch.randn(80)]
+        params = [p.clone().requires_grad_() for p in initial]
+        mask = torch.rand(64, 80) > 0.4
+        optimizer = BertAdam(params, lr=0.01, warmup=0.1, t_total=self.num_steps, **kwargs)
+        optimizer.set_mask(params[0], mask)
+        for _ in range(self.num_steps):
+            for p in params:
+                p.grad = torch.randn_like(p)
+            optimizer.step()
+        return initial, [p.detach() for p in params], mask
+
+    def test_mask_keeps_pruned_entries_zero(self):
+        _, expected, mask = self.run_masked(foreach=False)
+        for kwargs in [dict(foreach=True), dict(compact_state=True), dict(state_bits=8, min_8bit_size=1024)]:
+            _, params, _ = self.run_masked(**kwargs)
+            self.assertEqual(params[0][~mask].abs().max().item(), 0.)
+            self.assertTrue((params[0][mask] != 0).all())
+            if 'state_bits' not in kwargs:
+                self.assertAllClose(params, expected)
+
+    def test_8bit_state_follows_fp32(self):
+        initial, expected, _ = self.run_masked(compact_state=False)
+        _, params, _ = self.run_masked(state_bits=8, min_8bit_size=1024, block_size=256)
+        for p0, p32, p8 in zip(initial, expected, params):
+            # The updates (lr 0.01 for 20 steps) agree to a few percent.
+            error = (p8 - p32).norm() / (p32 - p0).norm()
+            self.assertLess(error.item(), 0.05)
+
+    def test_foreach_falls_back(self):
+        optimizer = BertAdam([torch.zeros(1, requires_grad=True)], lr=0.1, foreach=True)
+        self.assertEqual(optimizer.foreach, _foreach_supported())
+
+
+if __name__ == '__main__':
+    unittest.main()
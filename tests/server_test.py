@@ -0,0 +1,105 @@
+# coding=utf-8
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+import torch
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'examples'))
+import run_finetune  # noqa: E402
+import run_server  # noqa: E402
+
+WORDS = ['the', 'a', 'movie', 'good', 'bad', 'great', 'film', 'is', 'was', 'not']
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        torch.manual_seed(0)
+        self.tmp_dir = tempfile.mkdtemp()
+        vocab_file = os.path.join(self.tmp_dir, 'vocab.txt')
+        with open(vocab_file, 'w') as f:
+            f.write('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + WORDS) + '\n')
+        config = run_finetune.modeling_fast.BertConfig(vocab_size_or_config_json_file=len(WORDS) + 5, hidden_size=32,
+                                                       num_hidden_layers=2, num_attention_heads=4,
+                                                       intermediate_size=37)
+        model = run_finetune.modeling_fast.BertForSequenceClassification(config, 2)
+        model_dir = os.path.join(self.tmp_dir, 'model')
+        os.makedirs(model_dir)
+        torch.save(model.state_dict(), os.path.join(model_dir, run_finetune.WEIGHTS_NAME))
+        with open(os.path.join(model_dir, run_finetune.CONFIG_NAME), 'w') as f:
+            f.write(config.to_json_string())
+        args = argparse.Namespace(model_dir=model_dir, bert_model=vocab_file, task_name='sst-2', max_seq_length=32,
+                                  do_lower_case=True, host='127.0.0.1', port=0, max_batch_size=8,
+                                  max_wait_ms=200., request_timeout=30., p_type='svd', p_rate=1., bf16=False,
+                                  threads=0, no_cuda=True)
+        self.server = run_server.build_server(args)
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_address[1])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.batcher.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def post(self, data):
+        request = Request(self.url + '/predict', data=data, headers={'Content-Type': 'application/json'})
+        return json.load(urlopen(request, timeout=30))
+
+    def test_concurrent_requests_are_batched(self):
+        sentences = [' '.join(WORDS[i % len(WORDS):] + WORDS[:i % 3]) for i in range(24)]
+        barrier = threading.Barrier(len(sentences))
+
+        def predict(sentence):
+            barrier.wait()
+            return self.post(json.dumps({'text_a': sentence}).encode('utf-8'))['predictions'][0]
+
+        with ThreadPoolExecutor(len(sentences)) as executor:
+            predictions = list(executor.map(predict, sentences))
+        expected = self.post(json.dumps({'instances': [{'text_a': s} for s in sentences]}).encode('utf-8'))
+        self.assertEqual([p['label'] for p in predictions], [p['label'] for p in expected['predictions']])
+
+        metrics = json.load(urlopen(self.url + '/metrics', timeout=30))
+        self.assertEqual(metrics['requests'], 2 * len(sentences))
+        self.assertGreater(metrics['batch_size']['max'], 1)
+
+    def test_malformed_json(self):
+        for data in [b'{"text_a": ', b'{"foo": 1}']:
+            with self.assertRaises(HTTPError) as context:
+                self.post(data)
+            self.assertEqual(context.exception.code, 400)
+
+    def test_close_resolves_queued_futures(self):
+        batcher = self.server.batcher
+        features = self.server.featurize({'text_a': 'a good movie'})
+        futures = [batcher.submit(*features) for _ in range(50)]
+        batcher.close()
+        self.assertTrue(all(future.done() and future.exception() is None for future in futures))
+        self.assertIsInstance(batcher.submit(*features).exception(), RuntimeError)
+
+
+if __name__ == '__main__':
+    unittest.main()